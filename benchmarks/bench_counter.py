@@ -0,0 +1,59 @@
+"""
+Measures how many values etcd.Counter hands out per second, against an
+in-process fake etcd, for several batch sizes. With "memory", the fake is
+reached through an in-memory transport instead of HTTP, to measure the
+client side alone.
+
+Usage: python benchmarks/bench_counter.py [values] [counters] [http|memory]
+"""
+import sys
+import threading
+import time
+
+import etcd
+from etcd.tests.unit.fake_server import FakeEtcd, FakeTransport, fake_cluster
+
+
+def run(client, batch_size, values, counters):
+    key = "/bench/%d" % batch_size
+    instances = [etcd.Counter(client, key, batch_size=batch_size) for _ in range(counters)]
+
+    def allocate(counter):
+        for _ in range(values // counters):
+            counter.next()
+
+    threads = [threading.Thread(target=allocate, args=(c,)) for c in instances]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    conflicts = sum(c.stats["conflicts"] for c in instances)
+    leases = sum(c.stats["transactions"] for c in instances)
+    return elapsed, leases, conflicts
+
+
+def main(values=20000, counters=4, transport="http"):
+    if transport == "memory":
+        servers = []
+        client = etcd.Client(transport=FakeTransport(FakeEtcd()))
+    else:
+        fake, servers = fake_cluster(1)
+        client = etcd.Client(port=servers[0].port, per_host_pool_size=counters)
+    try:
+        for batch_size in (1, 10, 100, 1000):
+            n = values if batch_size > 1 else values // 20
+            elapsed, leases, conflicts = run(client, batch_size, n, counters)
+            print(
+                "batch %5d: %10.0f values/s, %5d leases, %5d conflicts"
+                % (batch_size, n / elapsed, leases, conflicts)
+            )
+    finally:
+        for server in servers:
+            server.stop()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(*[int(arg) for arg in args[:2]], *args[2:])
@@ -0,0 +1,49 @@
+"""
+Measures the time it takes to "import etcd" in a fresh interpreter.
+
+Usage: python benchmarks/bench_import.py [runs]
+"""
+import subprocess
+import sys
+import time
+
+
+def import_time():
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, "-c", "import etcd"])
+    return time.perf_counter() - start
+
+
+def baseline_time():
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, "-c", "pass"])
+    return time.perf_counter() - start
+
+
+def heaviest_imports(count=10):
+    """The modules with the highest cumulative import time, from -X importtime"""
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import etcd"],
+        stderr=subprocess.PIPE,
+        check=True,
+    ).stderr.decode("utf-8")
+    timings = []
+    for line in out.splitlines()[1:]:
+        _, cumulative, name = line.split("|")
+        timings.append((int(cumulative), name.strip()))
+    return sorted(timings, reverse=True)[:count]
+
+
+def main(runs=20):
+    imports = sorted(import_time() for _ in range(runs))
+    baseline = sorted(baseline_time() for _ in range(runs))
+    print("python startup:    %.1f ms (median of %d)" % (baseline[runs // 2] * 1000, runs))
+    print("import etcd:       %.1f ms (median of %d)" % (imports[runs // 2] * 1000, runs))
+    print("cost of the import: %.1f ms" % ((imports[runs // 2] - baseline[runs // 2]) * 1000))
+    print("heaviest imports (cumulative us):")
+    for cumulative, name in heaviest_imports():
+        print("  %8d %s" % (cumulative, name))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,57 @@
+"""
+Measures the cost of etcd.Lock under contention, against an in-process
+fake etcd: N threads take the same lock in turn, and the requests the
+server saw are counted per acquisition.
+
+Usage: python benchmarks/bench_lock_contention.py [contenders] [rounds]
+"""
+import sys
+import threading
+import time
+
+import etcd
+from etcd.tests.unit.fake_server import fake_cluster
+
+
+def contend(client, rounds):
+    for _ in range(rounds):
+        lock = etcd.Lock(client, "bench")
+        lock.acquire(lock_ttl=60)
+        lock.release()
+
+
+def main(contenders=16, rounds=5):
+    fake, servers = fake_cluster(1)
+    try:
+        client = etcd.Client(port=servers[0].port, per_host_pool_size=contenders)
+        threads = [
+            threading.Thread(target=contend, args=(client, rounds)) for _ in range(contenders)
+        ]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        log = servers[0].log
+    finally:
+        for server in servers:
+            server.stop()
+
+    acquisitions = contenders * rounds
+    listings = len(
+        [
+            1
+            for (method, path, params) in log
+            if method == "GET" and path == "/v2/keys/_locks/bench" and params.get("wait") != "true"
+        ]
+    )
+    watches = len([1 for (_, _, params) in log if params.get("wait") == "true"])
+    print("%d contenders, %d acquisitions in %.2f s" % (contenders, acquisitions, elapsed))
+    print("requests per acquisition: %.2f" % (len(log) / float(acquisitions)))
+    print("listings per acquisition: %.2f" % (listings / float(acquisitions)))
+    print("watches per acquisition:  %.2f" % (watches / float(acquisitions)))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
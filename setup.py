@@ -10,7 +10,9 @@ version = "0.5.0"
 
 install_requires = ["urllib3>=1.7.1", "dnspython>=1.13.0"]
 
-test_requires = ["mock", "pytest", "pyOpenSSL>=0.14"]
+test_requires = ["mock", "pytest"]
+
+extras_require = {"http2": ["httpx[http2]"]}
 
 setup(
     name="python-etcd",
@@ -34,6 +36,7 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=install_requires,
+    extras_require=extras_require,
     tests_require=test_requires,
     test_suite="nose.collector",
 )
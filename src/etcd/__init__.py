@@ -1,6 +1,11 @@
 import logging
 from .client import Client
-from .lock import Lock
+from .lock import Lock, LeaseKeeper, RWLock, Semaphore, SharedLock
+from .election import Election
+from .queue import Queue
+from .counter import Counter
+from .retry import RetryPolicy, RetryBudget
+from .cache import ReadCache
 
 _log = logging.getLogger(__name__)
 
@@ -228,6 +233,14 @@ class EtcdWatchTimedOut(EtcdConnectionFailed):
     pass
 
 
+class EtcdDeadlineExceeded(EtcdConnectionFailed):
+    """
+    The deadline of an operation was reached before it could complete.
+    """
+
+    pass
+
+
 class EtcdWatcherCleared(EtcdException):
     """
     Watcher is cleared due to etcd recovery.
@@ -322,13 +335,3 @@ class EtcdError(object):
             raise exc(msg, payload)
         else:
             raise exc(msg)
-
-
-# Attempt to enable urllib3's SNI support, if possible
-# Blatantly copied from requests.
-try:
-    from urllib3.contrib import pyopenssl
-
-    pyopenssl.inject_into_urllib3()
-except ImportError:
-    pass
@@ -0,0 +1,574 @@
+"""
+asyncio versions of the recipes, so that waiting for a lock does not pin
+a thread.
+
+This module is not imported by "import etcd", import it explicitly:
+
+>>> from etcd.aio import AsyncLock
+"""
+
+import asyncio
+import contextvars
+import functools
+import logging
+from urllib.parse import urlencode, urljoin
+
+from urllib3.util import parse_url
+
+import etcd
+from etcd.lock import _LockBase
+from etcd.transport import ConnectError, ReadTimeout, Response, TransportError
+
+_log = logging.getLogger(__name__)
+
+# The redirects urllib3 follows, and how many of them.
+_REDIRECT_STATUSES = frozenset((301, 302, 303, 307, 308))
+_MAX_REDIRECTS = 3
+
+
+def _in_executor(func, *args):
+    """
+    Runs func in the default executor of the running loop, in the context
+    of the caller, so that its deadline still applies.
+    """
+    context = contextvars.copy_context()
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(None, functools.partial(context.run, func, *args))
+
+
+class AsyncTransport(object):
+    """
+    Base of the transports of the asyncio clients, returned by
+    etcd.transport.Transport.async_transport. The responses they return have
+    their data read already.
+    """
+
+    async def request(self, method, url, fields=None, body=None, headers=None, timeout=None):
+        """
+        Sends a request, see etcd.transport.Transport.request.
+
+        Raises:
+            etcd.transport.TransportError: If the request failed.
+        """
+        raise NotImplementedError()
+
+    async def close(self):
+        """Closes the connections. The transport can still be used after."""
+
+
+class ExecutorTransport(AsyncTransport):
+    """
+    Sends the requests with a synchronous transport, in the default executor
+    of the event loop: each request takes a thread while it waits.
+    """
+
+    def __init__(self, transport):
+        """
+        Args:
+            transport (etcd.transport.Transport): The transport sending the
+                                                  requests.
+        """
+        self.transport = transport
+
+    async def request(self, method, url, fields=None, body=None, headers=None, timeout=None):
+        def send():
+            response = self.transport.request(
+                method, url, fields=fields, body=body, headers=headers, timeout=timeout
+            )
+            # Read in the executor too
+            _ = response.data
+            return response
+
+        return await _in_executor(send)
+
+
+class StreamTransport(AsyncTransport):
+    """
+    The asyncio version of etcd.transport.Urllib3Transport: HTTP/1.1 over
+    asyncio streams, with the same settings. Idle connections are kept for
+    reuse, up to maxsize per member.
+    """
+
+    def __init__(self, ssl_context=None, maxsize=1, allow_redirect=True):
+        """
+        Args:
+            ssl_context (ssl.SSLContext): The context of the https
+                                          connections.
+
+            maxsize (int): The idle connections kept per member.
+
+            allow_redirect (bool): Follow redirects.
+        """
+        self.ssl_context = ssl_context
+        self.maxsize = maxsize
+        self.allow_redirect = allow_redirect
+        self._idle = {}
+
+    async def request(self, method, url, fields=None, body=None, headers=None, timeout=None):
+        headers = dict(headers or {})
+        if body is None:
+            body = ""
+            if method in ("GET", "DELETE"):
+                if fields:
+                    url += "?" + urlencode(fields)
+            else:
+                body = urlencode(fields or {})
+                headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+        redirects = 0
+        while True:
+            response = await self._send(method, url, body, headers, timeout)
+            location = response.getheader("location")
+            if not (self.allow_redirect and location and response.status in _REDIRECT_STATUSES):
+                return response
+            redirects += 1
+            if redirects > _MAX_REDIRECTS:
+                raise TransportError("Too many redirects, last one to %s" % location)
+            url = urljoin(url, location)
+            if response.status == 303:
+                method, body = "GET", b""
+                headers.pop("Content-Type", None)
+
+    async def close(self):
+        idle, self._idle = self._idle, {}
+        writers = [writer for connections in idle.values() for _, writer in connections]
+        for writer in writers:
+            writer.close()
+        for writer in writers:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def _send(self, method, url, body, headers, timeout):
+        url = parse_url(url)
+        request_headers = {"Host": url.netloc, "Content-Length": str(len(body))}
+        request_headers.update(headers)
+        # Quoted as urllib3 does, for keys with spaces or non-ASCII names.
+        head = "%s %s HTTP/1.1\r\n" % (method, url.request_uri)
+        head += "".join("%s: %s\r\n" % item for item in request_headers.items())
+        request = head.encode("latin-1") + b"\r\n" + body
+
+        while True:
+            reader, writer, reused = await self._connect(url, timeout)
+            try:
+                writer.write(request)
+                await writer.drain()
+                response, keep_alive = await asyncio.wait_for(self._read_response(reader), timeout)
+                break
+            except (EOFError, ConnectionResetError) as e:
+                writer.close()
+                if not reused:
+                    raise TransportError(repr(e), cause=e)
+                # The server closed the idle connection, try a new one.
+                _log.debug("Idle connection to %s was closed, reconnecting", url.netloc)
+            except asyncio.TimeoutError as e:
+                writer.close()
+                raise ReadTimeout(repr(e), cause=e)
+            except (OSError, ValueError) as e:
+                writer.close()
+                raise TransportError(repr(e), cause=e)
+            except BaseException:
+                # Don't leave a half-read response on the connection.
+                writer.close()
+                raise
+        if keep_alive:
+            self._release(url, reader, writer)
+        else:
+            writer.close()
+        return response
+
+    async def _connect(self, url, timeout):
+        idle = self._idle.get(url.netloc)
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        ssl_context = None
+        port = url.port or 80
+        if url.scheme == "https":
+            ssl_context = self.ssl_context or True
+            port = url.port or 443
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(url.host.strip("[]"), port, ssl=ssl_context), timeout
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            raise ConnectError(repr(e), cause=e)
+        return reader, writer, False
+
+    def _release(self, url, reader, writer):
+        idle = self._idle.setdefault(url.netloc, [])
+        if len(idle) < self.maxsize:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def _read_response(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise EOFError("Connection closed by the server")
+        status = int(status_line.split(None, 2)[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if not size:
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            # Skip the trailers
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            data = b"".join(chunks)
+        elif "content-length" in headers:
+            data = await reader.readexactly(int(headers["content-length"]))
+        else:
+            data = await reader.read()
+            headers["connection"] = "close"
+        keep_alive = headers.get("connection", "").lower() != "close"
+        return Response(status, headers, lambda: data), keep_alive
+
+
+class HTTPXTransport(AsyncTransport):
+    """
+    The asyncio version of etcd.transport.HTTP2Transport, with an
+    httpx.AsyncClient.
+    """
+
+    def __init__(self, transport):
+        """
+        Args:
+            transport (etcd.transport.HTTP2Transport): The transport to take
+                                                       the settings from.
+        """
+        self.transport = transport
+        self._client = None
+
+    async def request(self, method, url, fields=None, body=None, headers=None, timeout=None):
+        transport = self.transport
+        if self._client is None:
+            self._client = transport._httpx.AsyncClient(**transport._options)
+        try:
+            request = transport._build_request(
+                self._client, method, url, fields, body, headers, timeout
+            )
+            response = await self._client.send(request, follow_redirects=transport._allow_redirect)
+        except transport._httpx.HTTPError as e:
+            raise transport._error(e)
+        data = response.content
+        headers = dict((k.lower(), v) for k, v in response.headers.items())
+        return Response(response.status_code, headers, lambda: data)
+
+    async def close(self):
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
+
+
+class AsyncClient(object):
+    """
+    The subset of the keys API used by the asyncio recipes.
+
+    It takes its settings (members, credentials, timeouts) and its transport
+    from an etcd.Client, and handles the responses and the failures the
+    same way: failed requests are retried on the next member according to
+    the retry_policy of the client, within the deadline set with
+    Client.deadline by the coroutine (or the task that started it). The
+    requests are sent by the asyncio version of the transport of the client,
+    see etcd.transport.Transport.async_transport.
+    """
+
+    def __init__(self, client):
+        """
+        Args:
+            client (etcd.Client): The client to take the settings from.
+        """
+        self.client = client
+        self._transport = client._transport.async_transport()
+
+    @property
+    def lock_prefix(self):
+        return self.client.lock_prefix
+
+    async def read(self, key, **kwdargs):
+        """Same as etcd.Client.read."""
+        params = {}
+        for k, v in kwdargs.items():
+            if k in self.client._read_options:
+                if type(v) == bool:
+                    params[k] = v and "true" or "false"
+                elif v is not None:
+                    params[k] = v
+        return await self._execute("GET", self._path(key), params, timeout=kwdargs.get("timeout"))
+
+    async def write(self, key, value, ttl=None, append=False, **kwdargs):
+        """Same as etcd.Client.write, without directories."""
+        params = {}
+        if value is not None:
+            params["value"] = value
+        if ttl is not None:
+            params["ttl"] = ttl
+        for k, v in kwdargs.items():
+            if k in self.client._comparison_conditions:
+                if type(v) == bool:
+                    params[k] = v and "true" or "false"
+                else:
+                    params[k] = v
+        method = append and "POST" or "PUT"
+        return await self._execute(method, self._path(key), params)
+
+    async def delete(self, key, **kwdargs):
+        """Same as etcd.Client.delete, without directories."""
+        params = dict((k, v) for k, v in kwdargs.items() if k in self.client._del_conditions)
+        return await self._execute("DELETE", self._path(key), params)
+
+    async def watch(self, key, index=None, timeout=None, recursive=None):
+        """Same as etcd.Client.watch, but only the coroutine waits."""
+        if index:
+            return await self.read(
+                key, wait=True, waitIndex=index, timeout=timeout, recursive=recursive
+            )
+        return await self.read(key, wait=True, timeout=timeout, recursive=recursive)
+
+    async def close(self):
+        """Closes the connections of the transport, see AsyncTransport.close."""
+        await self._transport.close()
+
+    def _path(self, key):
+        return self.client.key_endpoint + self.client._sanitize_key(key)
+
+    async def _execute(self, method, path, params, timeout=None, reloading_credentials=False):
+        client = self.client
+        if timeout is None:
+            timeout = client.read_timeout
+        if timeout == 0:
+            timeout = None
+        watch = params.get("wait") == "true"
+        if not client._connected:
+            # SRV discovery and the listing of the members block.
+            await _in_executor(client.connect)
+        attempt = 0
+        cause = None
+        while True:
+            attempt += 1
+            base_uri = client._base_uri
+            attempt_timeout = client._remaining_timeout(timeout, cause=cause)
+            try:
+                response = await self._transport.request(
+                    method,
+                    base_uri + path,
+                    fields=params,
+                    headers=client._get_headers(),
+                    timeout=attempt_timeout,
+                )
+            except TransportError as e:
+                cause = e
+                read_timeout = isinstance(e, ReadTimeout)
+                if attempt_timeout != timeout and read_timeout:
+                    # The deadline was shorter than the timeout
+                    client._remaining_timeout(cause=e)
+                if watch and read_timeout:
+                    raise etcd.EtcdWatchTimedOut("Watch timed out: %r" % e, cause=e)
+            else:
+                client._check_cluster_id(response, path)
+                if (
+                    response.status == 401
+                    and client._credentials_provider is not None
+                    and not reloading_credentials
+                    and client._load_credentials()
+                ):
+                    _log.info("Credentials rejected, retrying with new ones")
+                    return await self._execute(
+                        method, path, params, timeout=timeout, reloading_credentials=True
+                    )
+                client._handle_server_response(response)
+                return client._result_from_response(response)
+            _log.error("Request to server %s failed: %r", base_uri, cause)
+            if not client._allow_reconnect:
+                raise etcd.EtcdConnectionFailed(
+                    "Connection to etcd failed due to %r" % cause, cause=cause
+                )
+            if not client.retry_policy.should_retry(attempt, method, params, cause):
+                raise etcd.EtcdConnectionFailed(
+                    "Connection to etcd failed due to %r, not retrying" % cause, cause=cause
+                )
+            # Raises EtcdConnectionFailed if there are no machines left.
+            client._failover(base_uri, cause)
+            backoff = client.retry_policy.backoff(attempt)
+            remaining = client._remaining_timeout(cause=cause)
+            if remaining is not None and backoff >= remaining:
+                raise etcd.EtcdDeadlineExceeded(
+                    "Deadline exceeded before the next attempt", cause=cause
+                )
+            await asyncio.sleep(backoff)
+            if not client._use_proxies:
+                # The cluster may have changed since last invocation
+                await _in_executor(client._refresh_machines)
+
+
+class AsyncLock(_LockBase):
+    """
+    asyncio version of etcd.Lock, for use with "async with".
+
+    Waiting for the lock only takes a coroutine, watching the key right
+    before ours, so thousands of contenders can wait cheaply. It takes the
+    same keys as etcd.Lock, so both kinds of contenders can share a lock.
+
+    >>> async with AsyncLock(client, 'customer1'):
+    ...     await do_stuff()
+    """
+
+    def __init__(self, client, lock_name):
+        """
+        Args:
+            client (etcd.Client or etcd.aio.AsyncClient): The client to use.
+                   Locks sharing an AsyncClient share its connections. Given
+                   an etcd.Client, the lock makes an AsyncClient of its own,
+                   and closes it when the lock is released or not acquired.
+
+            lock_name (str): Name of the lock, shared by all the contenders.
+        """
+        self._own_client = isinstance(client, etcd.Client)
+        if self._own_client:
+            client = AsyncClient(client)
+        super(AsyncLock, self).__init__(client, lock_name)
+
+    async def is_acquired(self):
+        """
+        tells us if the lock is acquired
+        """
+        if not self.is_taken:
+            return False
+        try:
+            await self.client.read(self.lock_key)
+            return True
+        except etcd.EtcdKeyNotFound:
+            _log.warning("Lock was supposedly taken, but we cannot find it")
+            self.is_taken = False
+            return False
+
+    async def acquire(self, blocking=True, lock_ttl=3600, timeout=0):
+        """
+        Acquire the lock, see etcd.Lock.acquire.
+
+        Raises:
+            etcd.EtcdLockExpired: If lock expired when try to acquire.
+
+            etcd.EtcdWatchTimedOut: If timeout is reached.
+        """
+        try:
+            if not ((self._sequence or self._written) and await self._find_lock()):
+                self._written = True
+                res = await self.client.write(self.path, self.uuid, ttl=lock_ttl, append=True)
+                self._set_sequence(res.key)
+                _log.debug("Lock key %s written, sequence is %s", res.key, self._sequence)
+            elif lock_ttl:
+                await self.client.write(self.lock_key, self.uuid, ttl=lock_ttl)
+            acquired = await self._acquired(blocking=blocking, timeout=timeout)
+        except BaseException:
+            await self._close_client()
+            raise
+        if not acquired:
+            await self._close_client()
+        return acquired
+
+    async def release(self):
+        """
+        Release the lock
+        """
+        try:
+            if not self._sequence:
+                await self._find_lock()
+            await self.client.delete(self.lock_key)
+        except etcd.EtcdKeyNotFound:
+            _log.info("Lock %s not found, nothing to release", self.lock_key)
+        finally:
+            self.is_taken = False
+            await self._close_client()
+
+    async def __aenter__(self):
+        await self.acquire(blocking=True, lock_ttl=None)
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.release()
+        return False
+
+    async def _close_client(self):
+        if self._own_client:
+            await self.client.close()
+
+    async def _acquired(self, blocking=True, timeout=0):
+        t = max(0, timeout)
+        locker, nearest = await self._get_locker()
+        while True:
+            if self.lock_key == locker:
+                _log.debug("Lock acquired!")
+                self.is_taken = True
+                return True
+            self.is_taken = False
+            if not blocking:
+                return False
+            await self._wait(nearest, t)
+            if self._takeover:
+                try:
+                    await self.client.read(self.lock_key)
+                except etcd.EtcdKeyNotFound:
+                    raise etcd.EtcdLockExpired("Lock not found")
+                locker, nearest = self._take_over()
+            else:
+                locker, nearest = await self._get_locker()
+
+    async def _wait(self, nearest, timeout):
+        index = nearest.modifiedIndex + 1
+        while True:
+            try:
+                r = await self.client.watch(nearest.key, timeout=timeout, index=index)
+            except etcd.EtcdKeyNotFound:
+                return
+            except etcd.EtcdEventIndexCleared:
+                try:
+                    index = (await self.client.read(nearest.key)).etcd_index + 1
+                except etcd.EtcdKeyNotFound:
+                    return
+                continue
+            except (etcd.EtcdLockExpired, etcd.EtcdConnectionFailed):
+                # Timeouts, deadlines, and no member left to ask
+                raise
+            except etcd.EtcdException:
+                _log.exception("Unexpected exception")
+                continue
+            if r.action not in self._update_actions:
+                return
+            index = r.modifiedIndex + 1
+
+    async def _find_lock(self):
+        if self._sequence:
+            try:
+                res = await self.client.read(self.lock_key)
+                self._uuid = res.value
+                return True
+            except etcd.EtcdKeyNotFound:
+                return False
+        try:
+            res = await self.client.read(self.path, recursive=True)
+        except etcd.EtcdKeyNotFound:
+            return False
+        return self._find_uuid(res.leaves)
+
+    async def _get_locker(self):
+        """See etcd.Lock._get_locker."""
+        if not self._sequence:
+            await self._find_lock()
+        return self._locate(await self.client.read(self.path, sorted=True))
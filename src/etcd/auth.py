@@ -1,6 +1,9 @@
 import json
 
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import etcd
 
 _log = logging.getLogger(__name__)
@@ -13,26 +16,27 @@ class EtcdAuthBase(object):
         self.client = client
         self.name = name
         self.uri = "{}/auth/{}s/{}".format(self.client.version_prefix, self.entity, self.name)
-        # This will be lazily evaluated if not manually set
+        # This will follow the capabilities of the cluster if not manually set
         self._legacy_api = None
 
     @property
     def legacy_api(self):
         if self._legacy_api is None:
-            # The auth API has changed between 2.2 and 2.3, true story!
-            major, minor = map(int, self.client.version[:3].split("."))
-            self._legacy_api = major < 3 and minor < 3
+            return self.client.capabilities.legacy_auth
         return self._legacy_api
 
     @property
     def names(self):
+        if self.legacy_api:
+            return self._listing()
+        else:
+            return [obj[self.entity] for obj in self._listing()]
+
+    def _listing(self):
         key = "{}s".format(self.entity)
         uri = "{}/auth/{}".format(self.client.version_prefix, key)
         response = self.client.api_execute(uri, self.client._MGET)
-        if self.legacy_api:
-            return json.loads(response.data.decode("utf-8"))[key]
-        else:
-            return [obj[self.entity] for obj in json.loads(response.data.decode("utf-8"))[key]]
+        return json.loads(response.data.decode("utf-8"))[key] or []
 
     def read(self):
         try:
@@ -61,8 +65,12 @@ class EtcdAuthBase(object):
             r.read()
         except etcd.EtcdKeyNotFound:
             r = None
+        self._apply(self._to_net(r))
+
+    def _apply(self, payloads):
+        """Writes the payloads of _to_net, and returns how many there were."""
         try:
-            for payload in self._to_net(r):
+            for payload in payloads:
                 response = self.client.api_execute_json(self.uri, self.client._MPUT, params=payload)
                 # This will fail if the response is an error
                 self._from_net(response.data)
@@ -75,6 +83,7 @@ class EtcdAuthBase(object):
             raise etcd.EtcdException(
                 "Could not write {} '{}': {}".format(self.entity, self.name, e)
             )
+        return len(payloads)
 
     def delete(self):
         try:
@@ -89,13 +98,16 @@ class EtcdAuthBase(object):
             _log.error(
                 "Failed to delete %s in %s%s: %r",
                 self.entity,
-                self._base_uri,
-                self.version_prefix,
+                self.client._base_uri,
+                self.client.version_prefix,
                 e,
             )
             raise etcd.EtcdException("Could not delete {} '{}'".format(self.entity, self.name))
 
     def _from_net(self, data):
+        self._from_dict(json.loads(data.decode("utf-8")))
+
+    def _from_dict(self, d):
         raise NotImplementedError()
 
     def _to_net(self, old=None):
@@ -104,10 +116,53 @@ class EtcdAuthBase(object):
     @classmethod
     def new(cls, client, data):
         c = cls(client, data[cls.entity])
-        c._from_net(data)
+        c._from_dict(data)
         return c
 
 
+class PermissionIndex(object):
+    """
+    Compiled etcd permission patterns: keys, or prefixes if they end with
+    a "*". Whether a key matches any of them is found in a single walk of
+    a trie of the patterns, in O(len(key)).
+    """
+
+    # Marks, in a node of the trie, the end of a key or of a prefix
+    _KEY = None
+    _PREFIX = 0
+
+    def __init__(self, patterns=()):
+        self._root = {}
+        self.update(patterns)
+
+    def add(self, pattern):
+        mark = self._KEY
+        if pattern.endswith("*"):
+            pattern, mark = pattern[:-1], self._PREFIX
+        node = self._root
+        for char in pattern:
+            node = node.setdefault(char, {})
+        node[mark] = True
+
+    def update(self, patterns):
+        for pattern in patterns:
+            self.add(pattern)
+
+    def matches(self, key, recursive=False):
+        """
+        Whether a pattern matches key. With recursive, only prefixes match,
+        as for the recursive operations on a directory.
+        """
+        node = self._root
+        for char in key:
+            if self._PREFIX in node:
+                return True
+            node = node.get(char)
+            if node is None:
+                return False
+        return self._PREFIX in node or (not recursive and self._KEY in node)
+
+
 class EtcdUser(EtcdAuthBase):
     """Class to manage in a orm-like way etcd users"""
 
@@ -117,10 +172,12 @@ class EtcdUser(EtcdAuthBase):
         super(EtcdUser, self).__init__(client, name)
         self._roles = set()
         self._password = None
+        # The roles we know the permissions of, by name
+        self._role_objects = {}
+        self._indexes = None
 
-    def _from_net(self, data):
-        d = json.loads(data.decode("utf-8"))
-        roles = d.get("roles", [])
+    def _from_dict(self, d):
+        roles = d.get("roles") or []
         try:
             self.roles = roles
         except TypeError:
@@ -130,6 +187,10 @@ class EtcdUser(EtcdAuthBase):
             if self.legacy_api:
                 raise
             self.roles = [obj["role"] for obj in roles]
+            # ...and GET responses come with the permissions of the roles.
+            self._role_objects = dict(
+                (obj["role"], EtcdRole.new(self.client, obj)) for obj in roles
+            )
         self.name = d.get("user")
 
     def _to_net(self, prevobj=None):
@@ -163,6 +224,33 @@ class EtcdUser(EtcdAuthBase):
     @roles.setter
     def roles(self, val):
         self._roles = set(val)
+        self._indexes = None
+
+    def can_read(self, key, recursive=False):
+        """Whether one of the roles of the user allows reading key."""
+        return self._permission_indexes()[0].matches(key, recursive)
+
+    def can_write(self, key, recursive=False):
+        """Whether one of the roles of the user allows writing key."""
+        return self._permission_indexes()[1].matches(key, recursive)
+
+    def _permission_indexes(self):
+        """
+        The read and write PermissionIndex of all the roles of the user. The
+        roles whose permissions did not come with the user are read once.
+        """
+        if self._indexes is None:
+            read, write = PermissionIndex(), PermissionIndex()
+            for name in self.roles:
+                role = self._role_objects.get(name)
+                if role is None:
+                    role = EtcdRole(self.client, name)
+                    role.read()
+                    self._role_objects[name] = role
+                read.update(role._read_paths)
+                write.update(role._write_paths)
+            self._indexes = read, write
+        return self._indexes
 
     @property
     def password(self):
@@ -185,10 +273,16 @@ class EtcdRole(EtcdAuthBase):
         super(EtcdRole, self).__init__(client, name)
         self._read_paths = set()
         self._write_paths = set()
+        self._changed()
 
-    def _from_net(self, data):
-        d = json.loads(data.decode("utf-8"))
+    def _changed(self):
+        # The ACLs and indexes are computed again when needed
+        self._acls = None
+        self._read_index = self._write_index = None
+
+    def _from_dict(self, d):
         self.name = d.get("role")
+        self._changed()
 
         try:
             kv = d["permissions"]["kv"]
@@ -197,8 +291,8 @@ class EtcdRole(EtcdAuthBase):
             self._write_paths = set()
             return
 
-        self._read_paths = set(kv.get("read", []))
-        self._write_paths = set(kv.get("write", []))
+        self._read_paths = set(kv.get("read") or [])
+        self._write_paths = set(kv.get("write") or [])
 
     def _to_net(self, prevobj=None):
         retval = []
@@ -230,21 +324,35 @@ class EtcdRole(EtcdAuthBase):
         return retval
 
     def grant(self, path, permission):
+        self._changed()
         if permission.upper().find("R") >= 0:
             self._read_paths.add(path)
         if permission.upper().find("W") >= 0:
             self._write_paths.add(path)
 
     def revoke(self, path, permission):
+        self._changed()
         if permission.upper().find("R") >= 0 and path in self._read_paths:
             self._read_paths.remove(path)
         if permission.upper().find("W") >= 0 and path in self._write_paths:
             self._write_paths.remove(path)
 
+    def can_read(self, key, recursive=False):
+        """Whether the role allows reading key (a directory, if recursive)."""
+        if self._read_index is None:
+            self._read_index = PermissionIndex(self._read_paths)
+        return self._read_index.matches(key, recursive)
+
+    def can_write(self, key, recursive=False):
+        """Whether the role allows writing key (a directory, if recursive)."""
+        if self._write_index is None:
+            self._write_index = PermissionIndex(self._write_paths)
+        return self._write_index.matches(key, recursive)
+
     @property
     def acls(self):
-        perms = {}
-        try:
+        if self._acls is None:
+            perms = {}
             for path in self._read_paths:
                 perms[path] = "R"
             for path in self._write_paths:
@@ -252,12 +360,12 @@ class EtcdRole(EtcdAuthBase):
                     perms[path] += "W"
                 else:
                     perms[path] = "W"
-        except:
-            pass
-        return perms
+            self._acls = perms
+        return dict(self._acls)
 
     @acls.setter
     def acls(self, acls):
+        self._changed()
         self._read_paths = set()
         self._write_paths = set()
         for path, permission in acls.items():
@@ -282,3 +390,114 @@ class Auth(object):
         if value != self.active:
             method = value and self.client._MPUT or self.client._MDELETE
             self.client.api_execute(self.uri, method)
+
+    # What apply() never deletes
+    _protected = frozenset(["root"])
+
+    def apply(self, users=(), roles=(), prune=False, concurrency=10, progress=None):
+        """
+        Brings the users and roles to the given state, with as few
+        requests as possible.
+
+        The current users and roles are fetched once, from their listings
+        (plus concurrent reads of the desired ones that exist with the
+        auth API of etcd < 2.3); an entity is not listed if none are given
+        and not pruning. Only the differences are then written, in one
+        request per user or role, with up to concurrency requests in
+        flight: roles first, then the users they are granted to, then the
+        deletions if pruning.
+
+        Args:
+            users (list): EtcdUser objects as they should be. Passwords are
+                          only written for the users they are set on.
+
+            roles (list): EtcdRole objects as they should be.
+
+            prune (bool): Also delete the users and roles that are not
+                          given, but root.
+
+            concurrency (int): Maximum number of requests in flight.
+
+            progress (callable): Called as progress(done, total) after each
+                                 user or role written or deleted.
+
+        Returns:
+            dict with the number of users and roles created, updated,
+            deleted and unchanged, and of requests made.
+
+        Raises:
+            etcd.EtcdException: The first change that failed. The other
+                                changes of the same step are still made, but
+                                not those of the next steps.
+        """
+        users = list(users)
+        roles = list(roles)
+        stats = {"created": 0, "updated": 0, "deleted": 0, "unchanged": 0, "requests": 0}
+        lock = threading.Lock()
+        done = [0]
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            current_roles = self._current(EtcdRole, roles, prune, executor, stats)
+            current_users = self._current(EtcdUser, users, prune, executor, stats)
+
+            steps = []
+            for wanted, current in ((roles, current_roles), (users, current_users)):
+                step = []
+                for obj in wanted:
+                    prevobj = current.get(obj.name)
+                    payloads = obj._to_net(prevobj)
+                    if len(payloads) > 1:
+                        # etcd merges the password, grants and revokes
+                        # of a single PUT.
+                        merged = {}
+                        for payload in payloads:
+                            merged.update(payload)
+                        payloads = [merged]
+                    if payloads:
+                        step.append((prevobj is None and "created" or "updated", obj, payloads))
+                    else:
+                        stats["unchanged"] += 1
+                steps.append(step)
+            if prune:
+                for wanted, current in ((users, current_users), (roles, current_roles)):
+                    names = set(obj.name for obj in wanted) | self._protected
+                    step = [("deleted", obj, None) for obj in current.values()]
+                    steps.append([change for change in step if change[1].name not in names])
+            total = sum(len(step) for step in steps)
+
+            def run(change):
+                action, obj, payloads = change
+                if action == "deleted":
+                    obj.delete()
+                    requests = 1
+                else:
+                    requests = obj._apply(payloads)
+                with lock:
+                    stats[action] += 1
+                    stats["requests"] += requests
+                    done[0] += 1
+                    if progress is not None:
+                        progress(done[0], total)
+
+            for step in steps:
+                futures = [executor.submit(run, change) for change in step]
+                errors = [f.exception() for f in futures if f.exception() is not None]
+                if errors:
+                    raise errors[0]
+        return stats
+
+    def _current(self, cls, wanted, prune, executor, stats):
+        """The existing objects of an entity that matter, by name."""
+        if not wanted and not prune:
+            return {}
+        listed = cls(self.client, "")
+        listing = listed._listing()
+        stats["requests"] += 1
+        if not listed.legacy_api:
+            return dict((obj[cls.entity], cls.new(self.client, obj)) for obj in listing)
+        # The legacy API only lists names, read the objects we'll compare.
+        current = dict((name, cls(self.client, name)) for name in listing)
+        to_read = [current[obj.name] for obj in wanted if obj.name in current]
+        for _ in executor.map(lambda obj: obj.read(), to_read):
+            stats["requests"] += 1
+        return current
@@ -0,0 +1,175 @@
+"""
+Read cache of a client, bounded in entries, bytes and age.
+"""
+
+import copy
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+_log = logging.getLogger(__name__)
+
+
+class ReadCache(object):
+    """
+    LRU cache of the results of Client.read, for the reads that tolerate
+    some staleness.
+
+    All the reads of the client, watches aside, fill the cache; a read is
+    only answered from it if it allows a max_staleness, in seconds, and a
+    result of the same read is at most that old. Quorum reads, which ask
+    for linearizable results, are never answered from it. Writes and deletes done
+    through the client drop the results of their key, of its parents and
+    of its children; results read from a member that had not seen a write
+    yet, by their X-Etcd-Index, are not cached. Changes made by others are
+    only seen once the results expire.
+
+    Callers get copies of the results, which they may modify.
+
+    >>> client = etcd.Client(read_cache=etcd.ReadCache(max_entries=1000))
+    >>> client.read('/config/x', max_staleness=1.0).value
+    'value'
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024, ttl=60, max_staleness=0):
+        """
+        Args:
+            max_entries (int): Maximum number of results kept.
+
+            max_bytes (int): Maximum size of the results kept, in bytes of
+                             their responses.
+
+            ttl (float): Seconds after which a result is dropped, whatever
+                         the staleness reads allow.
+
+            max_staleness (float): Staleness allowed to the reads that don't
+                                   give theirs. It is 0 by default, as the
+                                   recipes (locks, elections...) need
+                                   fresh reads.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_staleness = max_staleness
+        self._lock = threading.Lock()
+        # (key, options) -> (result, size, time read), oldest used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # Results older than the last write we know of are not cached.
+        self._min_index = 0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    @property
+    def stats(self):
+        """
+        Counters of the cache: hits, misses, evictions (to stay within the
+        bounds), expirations, and the current entries and bytes.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        return stats
+
+    def get(self, key, options, max_staleness=None):
+        """
+        The cached result of a read, or None if there is none recent
+        enough.
+
+        Args:
+            key (str): The key read.
+
+            options (dict): The options of the read.
+
+            max_staleness (float): Age allowed to the result, in seconds.
+                                   Defaults to the max_staleness of the
+                                   cache.
+        """
+        if max_staleness is None:
+            max_staleness = self.max_staleness
+        if max_staleness <= 0 or options.get("quorum") == "true":
+            return None
+        entry_key = self._entry_key(key, options)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is not None and now - entry[2] > self.ttl:
+                self._remove(entry_key)
+                self._stats["expirations"] += 1
+                entry = None
+            if entry is None or now - entry[2] > max_staleness:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(entry_key)
+            self._stats["hits"] += 1
+        return copy.deepcopy(entry[0])
+
+    def put(self, key, options, result, size):
+        """
+        Caches the result of a read.
+
+        Args:
+            key (str): The key read.
+
+            options (dict): The options of the read.
+
+            result (etcd.EtcdResult): Its result.
+
+            size (int): The size of its response, in bytes.
+        """
+        if size > self.max_bytes or self.max_entries < 1:
+            return
+        entry_key = self._entry_key(key, options)
+        with self._lock:
+            if result.etcd_index < self._min_index:
+                _log.debug("Not caching %s, read before index %d", key, self._min_index)
+                return
+            if entry_key in self._entries:
+                self._remove(entry_key)
+            self._entries[entry_key] = (copy.deepcopy(result), size, time.monotonic())
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def invalidate(self, key, index=None):
+        """
+        Drops the results of key, of its parent directories and of its
+        children, as it changed.
+
+        All the entries are checked, under the lock of the cache: each
+        write costs O(max_entries).
+
+        Args:
+            key (str): The key written or deleted.
+
+            index (int): The modifiedIndex of the change, if known: results
+                         read before it are not cached anymore.
+        """
+        key = key.rstrip("/")
+        with self._lock:
+            if index is not None and index > self._min_index:
+                self._min_index = index
+            for entry_key in list(self._entries):
+                cached = entry_key[0].rstrip("/")
+                if _is_within(key, cached) or _is_within(cached, key):
+                    self._remove(entry_key)
+
+    def clear(self):
+        """Drops all the results."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, entry_key):
+        self._bytes -= self._entries.pop(entry_key)[1]
+
+    @staticmethod
+    def _entry_key(key, options):
+        # The results of quorum reads can answer the other reads.
+        return (key, tuple(sorted((k, v) for k, v in options.items() if k != "quorum")))
+
+
+def _is_within(key, directory):
+    return key == directory or key.startswith(directory + "/")
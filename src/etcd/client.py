@@ -6,25 +6,23 @@
 
 
 """
+import contextvars
 import logging
 
-try:
-    # Python 3
-    from http.client import HTTPException
-except ImportError:
-    # Python 2
-    from httplib import HTTPException
-import socket
+import random
+import threading
+import time
+import weakref
+from collections import namedtuple
+from contextlib import contextmanager
+from types import MappingProxyType
 import urllib3
-from urllib3.exceptions import HTTPError
-from urllib3.exceptions import ReadTimeoutError
 import json
-import ssl
-import dns.resolver
 from functools import wraps
 import etcd
-from dns.resolver import NXDOMAIN
-import re
+from etcd.discovery import SrvDiscovery
+from etcd.retry import RetryPolicy
+from etcd.transport import ReadTimeout, TransportError, Urllib3Transport, ssl_context
 
 try:
     from urlparse import urlparse
@@ -35,10 +33,75 @@ except ImportError:
 _log = logging.getLogger(__name__)
 
 
+class _Flight(object):
+    """A read in progress, and the threads waiting for its outcome."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.followers = 0
+        self.result = None
+        self.error = None
+
+
+def _close_idle_connections(transport_ref, max_idle):
+    """Closes the idle connections of a transport, until it is gone."""
+    while True:
+        time.sleep(max_idle / 2.0)
+        transport = transport_ref()
+        if transport is None:
+            return
+        try:
+            closed = transport.close_idle(max_idle)
+            if closed:
+                _log.debug("Closed %d idle connections", closed)
+        except Exception:
+            _log.exception("Could not close the idle connections")
+        del transport
+
+
+def _version_tuple(version):
+    """(major, minor) of a version string, or None if it isn't one."""
+    try:
+        return tuple(int(part) for part in version.split(".")[:2])
+    except (AttributeError, ValueError):
+        return None
+
+
+class Capabilities(object):
+    """
+    What the etcd cluster supports, as detected from its version.
+
+    Features are gated on the cluster version, the one all members
+    support, or the version of the server if the cluster didn't decide
+    one yet.
+    """
+
+    def __init__(self, server_version, cluster_version, v2=True):
+        self.server_version = server_version
+        self.cluster_version = cluster_version
+        version = _version_tuple(cluster_version) or _version_tuple(server_version) or (0, 0)
+        # The auth API has changed between 2.2 and 2.3, true story!
+        self.legacy_auth = version < (2, 3)
+        # Since 3.4, the v2 API is only served if enabled
+        self.v2 = v2
+
+    def __repr__(self):
+        return "<Capabilities of etcd {}: legacy_auth={}, v2={}>".format(
+            self.cluster_version, self.legacy_auth, self.v2
+        )
+
+
+# The credentials of a client, and the headers of its requests
+_Credentials = namedtuple("_Credentials", ["username", "password", "headers", "json_headers"])
+
+
 class Client(object):
 
     """
     Client for etcd, the distributed log service using raft.
+
+    A client is thread-safe: a single instance, and its connection pool,
+    can be shared by all the threads of a process.
     """
 
     _MGET = "GET"
@@ -69,6 +132,15 @@ class Client(object):
         expected_cluster_id=None,
         per_host_pool_size=10,
         lock_prefix="/_locks",
+        srv_resolver=None,
+        lazy=False,
+        retry_policy=None,
+        credentials_provider=None,
+        transport=None,
+        prewarm_connections=0,
+        max_idle_time=None,
+        coalesce_reads=False,
+        read_cache=None,
     ):
         """
         Initialize the client.
@@ -118,17 +190,151 @@ class Client(object):
                                       connections.
             lock_prefix (str): Set the key prefix at etcd when client to lock object.
                                       By default this will be use /_locks.
+            srv_resolver (object): resolver used for the SRV lookups, an object
+                                   with a resolve(qname, rdtype) method like
+                                   dns.resolver.Resolver. Defaults to the
+                                   system resolver.
+            lazy (bool): If true, the constructor does no network I/O; the
+                         SRV discovery and the fetching of the cluster
+                         members happen on the first request, or when
+                         connect() is called.
+            retry_policy (etcd.RetryPolicy): how requests that fail are
+                                             retried on the other members of
+                                             the cluster, when allow_reconnect
+                                             is true. By default there is no
+                                             limit on the attempts, but
+                                             retries are backed off and taken
+                                             from a per-client budget.
+            credentials_provider (callable): returns the (username, password)
+                                             to authenticate with, instead of
+                                             username and password. It is
+                                             called upon first usage, and
+                                             again when etcd rejects the
+                                             credentials, so that rotated
+                                             ones are picked up; the request
+                                             is then retried once.
+            transport (etcd.transport.Transport): sends the requests, e.g. an
+                                                  etcd.transport.HTTP2Transport
+                                                  to multiplex them on one
+                                                  connection per member. By
+                                                  default, an Urllib3Transport
+                                                  sends them with http, a pool
+                                                  of urllib3 connections.
+            prewarm_connections (int): Number of connections to open to each
+                                       known member when connecting, so that
+                                       the first requests don't wait for
+                                       them.
+            max_idle_time (float): If set, connections idle for longer are
+                                   closed by a background thread. Set it
+                                   below the keep-alive timeout of the
+                                   members (and of the proxies in between),
+                                   so that requests don't go to connections
+                                   they are about to close.
+            coalesce_reads (bool): If true, identical reads made at the same
+                                   time by several threads share a single
+                                   request, and its EtcdResult, which must
+                                   then not be modified. Watches are not
+                                   coalesced, and reads under a deadline
+                                   only join the reads of others.
+            read_cache (etcd.ReadCache): caches the results of the reads, for
+                                         the ones that tolerate some
+                                         staleness. Writes and deletes done
+                                         with this client invalidate it.
         """
+        # Protects the endpoint state (_base_uri, _machines_cache and
+        # expected_cluster_id), which is shared by all the threads using
+        # the client. Never held while doing network I/O, except for the
+        # DNS lookups of the SRV discovery.
+        self._endpoint_lock = threading.RLock()
+        # The server each thread is currently sending its request to.
+        self._local = threading.local()
+        # The deadline of the current thread, or asyncio task, see deadline().
+        self._deadline = contextvars.ContextVar("etcd_deadline", default=None)
 
-        # If a DNS record is provided, use it to get the hosts list
+        self._protocol = protocol
+        self._allow_reconnect = allow_reconnect
+        self._srv_domain = srv_domain
+        self._srv_discovery = None
         if srv_domain is not None:
-            try:
-                host = self._discover(srv_domain)
-            except Exception as e:
-                _log.error("Could not discover the etcd hosts from %s: %s", srv_domain, e)
+            self._srv_discovery = SrvDiscovery(srv_domain, resolver=srv_resolver)
 
-        self._protocol = protocol
+        self._set_hosts(host, port)
+
+        self.expected_cluster_id = expected_cluster_id
+        self.version_prefix = version_prefix
+
+        self._read_timeout = read_timeout
+        self._allow_redirect = allow_redirect
+        self._use_proxies = use_proxies
+        self._lock_prefix = lock_prefix
+        self.retry_policy = retry_policy or RetryPolicy()
+        self._stats_lock = threading.Lock()
+        self._transaction_stats = {"transactions": 0, "conflicts": 0, "failures": 0, "backoff": 0.0}
+
+        self._prewarm_connections = prewarm_connections
+
+        # The reads in progress, by key and options, when they are coalesced
+        self._coalesce_reads = coalesce_reads
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+
+        self.read_cache = read_cache
 
+        kw = {"maxsize": per_host_pool_size}
+
+        if self._read_timeout > 0:
+            kw["timeout"] = self._read_timeout
+
+        # SSL Client certificate support: the certificates are loaded once,
+        # in a context shared by all the connections, which resumes the
+        # TLS sessions of the previous connections to a member. The SRV
+        # records of a domain may turn out to be the secure ones.
+        self.ssl_context = None
+        if protocol == "https" or srv_domain is not None:
+            self.ssl_context = kw["ssl_context"] = ssl_context(cert, ca_cert)
+        if not ca_cert:
+            urllib3.disable_warnings()
+
+        self._credentials_provider = credentials_provider
+        self._credentials = None
+        if credentials_provider is None:
+            if username and not password:
+                _log.warning(
+                    "Username provided without password, both are required for authentication"
+                )
+                username = None
+            elif password and not username:
+                _log.warning(
+                    "Password provided without username, both are required for authentication"
+                )
+                password = None
+            self.set_credentials(username, password)
+
+        self.http = urllib3.PoolManager(num_pools=10, **kw)
+        self._transport = transport or Urllib3Transport(self.http, allow_redirect)
+        if max_idle_time:
+            # The thread doesn't keep the transport alive, and stops once
+            # it is gone.
+            t = threading.Thread(
+                target=_close_idle_connections,
+                args=(weakref.ref(self._transport), max_idle_time),
+                name="etcd-idle-connections",
+            )
+            t.daemon = True
+            t.start()
+
+        # Versions and capabilities, detected upon first usage.
+        self._capabilities = None
+
+        self._connected = False
+        self._connect_lock = threading.Lock()
+        if lazy:
+            _log.debug("New lazy etcd client created for %s", self.base_uri)
+        else:
+            self.connect()
+            _log.debug("New etcd client created for %s", self.base_uri)
+
+    def _set_hosts(self, host, port):
         def uri(protocol, host, port):
             return "%s://%s:%d" % (protocol, host, port)
 
@@ -136,7 +342,7 @@ class Client(object):
             self._machines_cache = []
             self._base_uri = uri(self._protocol, host, port)
         else:
-            if not allow_reconnect:
+            if not self._allow_reconnect:
                 _log.error("List of hosts incompatible with allow_reconnect.")
                 raise etcd.EtcdException(
                     "A list of hosts to connect to was given, but reconnection not allowed?"
@@ -144,120 +350,165 @@ class Client(object):
             self._machines_cache = [uri(self._protocol, *conn) for conn in host]
             self._base_uri = self._machines_cache.pop(0)
 
-        self.expected_cluster_id = expected_cluster_id
-        self.version_prefix = version_prefix
-
-        self._read_timeout = read_timeout
-        self._allow_redirect = allow_redirect
-        self._use_proxies = use_proxies
-        self._allow_reconnect = allow_reconnect
-        self._lock_prefix = lock_prefix
-
-        # SSL Client certificate support
+    def connect(self, background=False):
+        """
+        Does the network setup of the client: discovers the hosts from the
+        SRV records, and fetches the members of the cluster if reconnection
+        is allowed.
 
-        kw = {"maxsize": per_host_pool_size}
+        This is done in the constructor, unless the client was created with
+        lazy=True; in that case it happens on the first request, or when
+        this method is called. Calling it again has no effect.
 
-        if self._read_timeout > 0:
-            kw["timeout"] = self._read_timeout
-
-        if cert:
-            if isinstance(cert, tuple):
-                # Key and cert are separate
-                kw["cert_file"] = cert[0]
-                kw["key_file"] = cert[1]
-            else:
-                # combined certificate
-                kw["cert_file"] = cert
+        Args:
+            background (bool): If true, connect in a daemon thread and
+                               return it without waiting.
 
-        if ca_cert:
-            kw["ca_certs"] = ca_cert
-            kw["cert_reqs"] = ssl.CERT_REQUIRED
-        else:
-            kw["cert_reqs"] = ssl.CERT_NONE
-            urllib3.disable_warnings()
+        Returns:
+            threading.Thread if background is true, None otherwise.
+        """
+        if background:
+            t = threading.Thread(target=self._connect_in_background, name="etcd-connect")
+            t.daemon = True
+            t.start()
+            return t
+
+        with self._connect_lock:
+            if self._connected:
+                return
+            # If a DNS record is provided, use it to get the hosts list
+            if self._srv_domain is not None:
+                try:
+                    hosts = self._discover(self._srv_domain)
+                except Exception as e:
+                    _log.error("Could not discover the etcd hosts from %s: %s", self._srv_domain, e)
+                else:
+                    self._set_hosts(hosts, None)
+
+            if self._allow_reconnect:
+                # we need the set of servers in the cluster in order to try
+                # reconnecting upon error. The cluster members will be
+                # added to the hosts list you provided. If you are using
+                # proxies, set all
+                #
+                # Beware though: if you input '127.0.0.1' as your host and
+                # etcd advertises 'localhost', both will be in the
+                # resulting list.
+
+                # If we're connecting to the original cluster, we can
+                # extend the list given to the client with what we get
+                # from self.machines
+                if not self._use_proxies:
+                    self._machines_cache = list(set(self._machines_cache) | set(self.machines))
+                if self._base_uri in self._machines_cache:
+                    self._machines_cache.remove(self._base_uri)
+                _log.debug("Machines cache initialised to %s", self._machines_cache)
+            self._connected = True
+            if self._prewarm_connections:
+                self._warm_up(self._prewarm_connections)
+
+    def warm_up(self, connections_per_member=1):
+        """
+        Opens connections to all the known members ahead of the requests,
+        and opens again the idle ones that were closed by their member.
 
-        self.username = None
-        self.password = None
-        if username and password:
-            self.username = username
-            self.password = password
-        elif username:
-            _log.warning("Username provided without password, both are required for authentication")
-        elif password:
-            _log.warning("Password provided without username, both are required for authentication")
+        Args:
+            connections_per_member (int): Number of connections to have open
+                                          to each member, up to the size of
+                                          the pools.
 
-        self.http = urllib3.PoolManager(num_pools=10, **kw)
+        Returns:
+            dict of the number of connections opened, by member. Members
+            that can't be reached are logged and left out.
+        """
+        if not self._connected:
+            self.connect()
+        return self._warm_up(connections_per_member)
+
+    def _warm_up(self, count):
+        with self._endpoint_lock:
+            members = [self._base_uri] + self._machines_cache
+        opened = {}
+        for member in members:
+            try:
+                opened[member] = self._transport.warm_up(member, count)
+                _log.debug("Opened %d connections to %s", opened[member], member)
+            except TransportError as e:
+                _log.warning("Could not open connections to %s: %r", member, e)
+        return opened
 
-        _log.debug("New etcd client created for %s", self.base_uri)
-
-        if self._allow_reconnect:
-            # we need the set of servers in the cluster in order to try
-            # reconnecting upon error. The cluster members will be
-            # added to the hosts list you provided. If you are using
-            # proxies, set all
-            #
-            # Beware though: if you input '127.0.0.1' as your host and
-            # etcd advertises 'localhost', both will be in the
-            # resulting list.
-
-            # If we're connecting to the original cluster, we can
-            # extend the list given to the client with what we get
-            # from self.machines
-            if not self._use_proxies:
-                self._machines_cache = list(set(self._machines_cache) | set(self.machines))
-            if self._base_uri in self._machines_cache:
-                self._machines_cache.remove(self._base_uri)
-            _log.debug("Machines cache initialised to %s", self._machines_cache)
-
-        # Versions set to None. They will be set upon first usage.
-        self._version = self._cluster_version = None
+    def _connect_in_background(self):
+        try:
+            self.connect()
+        except Exception as e:
+            _log.error("Could not connect to etcd in the background: %r", e)
 
     def _set_version_info(self):
         """
-        Sets the version information provided by the server.
+        Sets the version information provided by the server, and the
+        capabilities of the cluster.
         """
         # Set the version
         data = self.api_execute("/version", self._MGET).data
         version_info = json.loads(data.decode("utf-8"))
-        self._version = version_info["etcdserver"]
-        self._cluster_version = version_info["etcdcluster"]
+        server_version = version_info["etcdserver"]
+        cluster_version = version_info["etcdcluster"]
+        v2 = True
+        if (_version_tuple(server_version) or (0, 0)) >= (3, 4):
+            v2 = self._serves_v2()
+        self._capabilities = Capabilities(server_version, cluster_version, v2=v2)
+        _log.debug("Detected %r", self._capabilities)
+        return self._capabilities
+
+    def _serves_v2(self):
+        """Whether the server answers on the v2 keys API."""
+        try:
+            # A key that is most likely missing, rather than a listing
+            self.api_execute(self.version_prefix + "/keys/_python_etcd_v2_probe", self._MGET)
+        except (etcd.EtcdKeyNotFound, etcd.EtcdInsufficientPermissions):
+            pass
+        except (etcd.EtcdConnectionFailed, etcd.EtcdClusterIdChanged):
+            raise
+        except etcd.EtcdException:
+            # A v3 server without the v2 API answers "404 page not found"
+            return False
+        return True
 
     def _discover(self, domain):
-        srv_names = [
-            "_etcd-client-ssl._tcp.{}".format(domain),
-            "_etcd-client._tcp.{}".format(domain),
-            "_etcd-ssl._tcp.{}".format(domain),
-            "_etcd._tcp.{}".format(domain),
-        ]
-        found = False
-        for srv_name in srv_names:
-            try:
-                answers = dns.resolver.query(srv_name, "SRV")
-                if len(answers):
-                    found = True
-                    break
-            except NXDOMAIN:
-                continue
-
-        if not found:
-            raise ValueError("Could not find SRV record for domain {}.".format(domain))
-
-        if re.search("-ssl", srv_name):
+        if self._srv_discovery is None or self._srv_discovery.domain != domain:
+            self._srv_discovery = SrvDiscovery(domain)
+        hosts = self._srv_discovery.hosts()
+        if self._srv_discovery.secure:
             self._protocol = "https"
+        return hosts
 
-        hosts = []
-        for answer in answers:
-            hosts.append((answer.target.to_text(omit_final_dot=True), answer.port))
-        _log.debug("Found %s", hosts)
-        if not len(hosts):
-            raise ValueError("The SRV record is present but no hosts were found")
-        return tuple(hosts)
+    def _rediscover(self):
+        """
+        Resolves the SRV records again, if they have expired, and returns the
+        machines that were not known by the previous resolution.
+        """
+        if self._srv_discovery is None:
+            return []
+        previous = self._srv_discovery.cached_hosts
+        try:
+            hosts = self._srv_discovery.hosts()
+        except Exception as e:
+            _log.error("Could not rediscover the etcd hosts: %s", e)
+            return []
+        if previous is not None and set(hosts) == set(previous):
+            return []
+        if self._srv_discovery.secure:
+            self._protocol = "https"
+        machines = ["%s://%s:%d" % (self._protocol, host, port) for (host, port) in hosts]
+        _log.info("SRV records changed, new machines: %s", machines)
+        return [m for m in machines if m != self._base_uri]
 
     def __del__(self):
         """Clean up open connections"""
-        if self.http is not None:
+        transport = getattr(self, "_transport", None)
+        if transport is not None:
             try:
-                self.http.clear()
+                transport.clear()
             except ReferenceError:
                 # this may hit an already-cleared weakref
                 pass
@@ -309,14 +560,14 @@ class Client(object):
         ['http://127.0.0.1:4001', 'http://127.0.0.1:4002']
         """
         # We can't use api_execute here, or it causes a logical loop
+        base_uri = self._base_uri
         try:
-            uri = self._base_uri + self.version_prefix + "/machines"
-            response = self.http.request(
+            uri = base_uri + self.version_prefix + "/machines"
+            response = self._send(
                 self._MGET,
                 uri,
                 headers=self._get_headers(),
-                timeout=self.read_timeout,
-                redirect=self.allow_redirect,
+                timeout=self._remaining_timeout(self.read_timeout or None),
             )
 
             machines = [
@@ -325,17 +576,26 @@ class Client(object):
             ]
             _log.debug("Retrieved list of machines: %s", machines)
             return machines
-        except (HTTPError, HTTPException, socket.error) as e:
+        except TransportError as e:
             # We can't get the list of machines, if one server is in the
             # machines cache, try on it
             _log.error(
                 "Failed to get list of machines from %s%s: %r",
-                self._base_uri,
+                base_uri,
                 self.version_prefix,
                 e,
             )
-            if self._machines_cache:
-                self._base_uri = self._machines_cache.pop(0)
+            with self._endpoint_lock:
+                if self._base_uri != base_uri:
+                    # Another thread already moved to another server
+                    retry = True
+                else:
+                    if not self._machines_cache:
+                        self._machines_cache = self._rediscover()
+                    retry = bool(self._machines_cache)
+                    if retry:
+                        self._base_uri = self._machines_cache.pop(0)
+            if retry:
                 _log.info("Retrying on %s", self._base_uri)
                 # Call myself
                 return self.machines
@@ -421,24 +681,30 @@ class Client(object):
         except (TypeError, ValueError):
             raise etcd.EtcdException("Cannot parse json data in the response")
 
+    @property
+    def capabilities(self):
+        """
+        What the cluster supports (etcd.client.Capabilities). It is
+        detected upon first usage, and again if the cluster ID changes.
+        """
+        capabilities = self._capabilities
+        if capabilities is None:
+            capabilities = self._set_version_info()
+        return capabilities
+
     @property
     def version(self):
         """
         Version of etcd.
         """
-        if not self._version:
-            self._set_version_info()
-        return self._version
+        return self.capabilities.server_version
 
     @property
     def cluster_version(self):
         """
         Version of the etcd cluster.
         """
-        if not self._cluster_version:
-            self._set_version_info()
-
-        return self._cluster_version
+        return self.capabilities.cluster_version
 
     @property
     def key_endpoint(self):
@@ -491,6 +757,9 @@ class Client(object):
 
             refresh (bool): since 2.3.0, If true, only update the ttl, prev key must existed(prevExist=True).
 
+            deadline (float): max seconds for the whole operation, including
+                              retries and failover to other members.
+
         Returns:
             client.EtcdResult
 
@@ -525,8 +794,15 @@ class Client(object):
         else:
             path = self.key_endpoint + key
 
-        response = self.api_execute(path, method, params=params)
-        return self._result_from_response(response)
+        try:
+            with self.deadline(kwdargs.get("deadline")):
+                response = self.api_execute(path, method, params=params)
+            result = self._result_from_response(response)
+        except Exception:
+            self._invalidate(key)
+            raise
+        self._invalidate(key, result.modifiedIndex)
+        return result
 
     def refresh(self, key, ttl, **kwdargs):
         """
@@ -571,6 +847,120 @@ class Client(object):
             kwdargs["prevIndex"] = obj.modifiedIndex
         return self.write(obj.key, obj.value, **kwdargs)
 
+    def transact(self, key, fn, max_retries=10, backoff=None, prev=None, stats=None):
+        """
+        Atomically replaces the value of a key by fn(value), retrying if
+        someone else changed the key in the meantime. Typical usage would be:
+
+        c = etcd.Client()
+        c.transact("/somekey", lambda value: str(int(value or 0) + 1))
+
+        The key is read, fn is applied to its value (None if the key does
+        not exist), and the result is written if the key was not changed
+        since it was read. On a conflict, only this key is read again,
+        from the leader if the member we read from is behind the index of
+        the conflict.
+
+        Args:
+            key (str):  Key.
+
+            fn (callable): Gets the current value, returns the new one.
+
+            max_retries (int): Retries after a conflict before giving up,
+                               None to retry forever.
+
+            backoff (float): Delay before the first retry after a conflict,
+                             doubled at each retry and drawn at random below
+                             it. Defaults to the backoff of the retry policy.
+
+            prev (etcd.EtcdResult): The last known state of the key, to
+                                    skip the first read if it is still
+                                    current.
+
+            stats (dict): Counters of this transaction are added to it, on
+                          top of the ones of the client.
+
+        Returns:
+            client.EtcdResult of the write.
+
+        Raises:
+            etcd.EtcdCompareFailed, etcd.EtcdAlreadyExist, etcd.EtcdKeyNotFound:
+                If there are still conflicts after max_retries retries.
+        """
+        counts = {"conflicts": 0, "backoff": 0.0}
+        conflicts = 0
+        fresh = prev is None
+        current = prev
+        try:
+            while True:
+                if current is None:
+                    current = self._transact_read(key)
+                try:
+                    if current.modifiedIndex is None:
+                        result = self.write(key, fn(None), prevExist=False)
+                    else:
+                        result = self.write(key, fn(current.value), prevIndex=current.modifiedIndex)
+                    self._record_transaction(stats, counts, transactions=1)
+                    return result
+                except (etcd.EtcdCompareFailed, etcd.EtcdAlreadyExist, etcd.EtcdKeyNotFound) as e:
+                    counts["conflicts"] += 1
+                    error_index = (e.payload or {}).get("index", 0)
+                    if fresh:
+                        conflicts += 1
+                        if max_retries is not None and conflicts > max_retries:
+                            raise
+                        if backoff is None:
+                            delay = self.retry_policy.backoff(conflicts)
+                        else:
+                            delay = random.uniform(0, backoff * (2 ** (conflicts - 1)))
+                        _log.debug("Conflict on %s, retrying in %.3fs", key, delay)
+                        counts["backoff"] += delay
+                        time.sleep(delay)
+                    # A guessed state costs a read, not a backoff.
+                    fresh = True
+                    current = self._transact_read(key, error_index)
+        except Exception:
+            self._record_transaction(stats, counts, failures=1)
+            raise
+
+    def _transact_read(self, key, min_index=0):
+        """
+        Reads key for a transaction, from the leader if the member is
+        behind min_index. The result has no modifiedIndex if the key does
+        not exist.
+        """
+        for quorum in (False, True):
+            try:
+                result = self.read(key, quorum=True) if quorum else self.read(key)
+            except etcd.EtcdKeyNotFound as e:
+                result = etcd.EtcdResult(node={"key": key})
+                result.etcd_index = (e.payload or {}).get("index", 0)
+            if result.etcd_index >= min_index:
+                break
+            _log.debug("Member is behind index %d, reading %s from the leader", min_index, key)
+        return result
+
+    def _record_transaction(self, stats, counts, **outcome):
+        counts = dict(counts, **outcome)
+        with self._stats_lock:
+            for name, value in counts.items():
+                self._transaction_stats[name] += value
+                if stats is not None:
+                    stats[name] = stats.get(name, 0) + value
+
+    @property
+    def transaction_stats(self):
+        """
+        Counters of the transactions done with transact(): successful ones,
+        failed ones, conflicts, and seconds spent in backoff. conflict_rate
+        is the ratio of conflicts to writes attempted.
+        """
+        with self._stats_lock:
+            stats = dict(self._transaction_stats)
+        attempts = stats["transactions"] + stats["conflicts"]
+        stats["conflict_rate"] = float(stats["conflicts"]) / attempts if attempts else 0.0
+        return stats
+
     def read(self, key, **kwdargs):
         """
         Returns the value of the key 'key'.
@@ -590,6 +980,13 @@ class Client(object):
 
             timeout (int):  max seconds to wait for a read.
 
+            deadline (float): max seconds for the whole operation, including
+                              retries and failover to other members.
+
+            max_staleness (float): with a read_cache, how old, in seconds, a
+                                   cached result may be. Defaults to the
+                                   max_staleness of the cache.
+
         Returns:
             client.EtcdResult (or an array of client.EtcdResult if a
             subtree is queried)
@@ -599,6 +996,8 @@ class Client(object):
 
             urllib3.exceptions.TimeoutError: If timeout is reached.
 
+            etcd.EtcdDeadlineExceeded: If the deadline is reached.
+
         >>> print client.get('/key').value
         'value'
 
@@ -615,11 +1014,69 @@ class Client(object):
                     params[k] = v
 
         timeout = kwdargs.get("timeout", None)
+        watch = params.get("wait") == "true"
+
+        if self.read_cache is not None and not watch:
+            result = self.read_cache.get(key, params, kwdargs.get("max_staleness"))
+            if result is not None:
+                _log.debug("Read %s from the cache", key)
+                return result
+
+        with self.deadline(kwdargs.get("deadline")):
+            if self._coalesce_reads and not watch:
+                return self._coalesced_read(key, params, timeout)
+            return self._read(key, params, timeout)
 
+    def _read(self, key, params, timeout):
         response = self.api_execute(
             self.key_endpoint + key, self._MGET, params=params, timeout=timeout
         )
-        return self._result_from_response(response)
+        result = self._result_from_response(response)
+        if self.read_cache is not None and params.get("wait") != "true":
+            self.read_cache.put(key, params, result, len(response.data))
+        return result
+
+    def _coalesced_read(self, key, params, timeout):
+        """
+        Joins the identical read in progress, if any, and returns its result
+        or raises its error; otherwise, makes the read for all the threads
+        joining it. Reads under a deadline don't make it for the others, as
+        the others would get its EtcdDeadlineExceeded.
+        """
+        flight_key = (key, tuple(sorted(params.items())), timeout)
+        with self._flights_lock:
+            flight = self._flights.get(flight_key)
+            if flight is not None:
+                flight.followers += 1
+                leader = False
+            elif self._deadline.get() is None:
+                flight = self._flights[flight_key] = _Flight()
+                leader = True
+            else:
+                leader = None
+
+        if leader is None:
+            return self._read(key, params, timeout)
+        if not leader:
+            _log.debug("Joining the read of %s in progress", key)
+            # Only our own deadline bounds the wait, the read has its timeouts.
+            if not flight.done.wait(self._remaining_timeout()):
+                raise etcd.EtcdDeadlineExceeded("Deadline exceeded")
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._read(key, params, timeout)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            # Reads starting from now get a result at least as recent.
+            with self._flights_lock:
+                del self._flights[flight_key]
+            flight.done.set()
 
     def delete(self, key, recursive=None, dir=None, **kwdargs):
         """
@@ -640,6 +1097,9 @@ class Client(object):
             prevIndex (int): modify key only if actual modifiedIndex matches the
                              provided one (optional).
 
+            deadline (float): max seconds for the whole operation, including
+                              retries and failover to other members.
+
         Returns:
             client.EtcdResult
 
@@ -670,8 +1130,24 @@ class Client(object):
                 kwds[k] = kwdargs[k]
         _log.debug("Calculated params = %s", kwds)
 
-        response = self.api_execute(self.key_endpoint + key, self._MDELETE, params=kwds)
-        return self._result_from_response(response)
+        try:
+            with self.deadline(kwdargs.get("deadline")):
+                response = self.api_execute(self.key_endpoint + key, self._MDELETE, params=kwds)
+            result = self._result_from_response(response)
+        except Exception:
+            self._invalidate(key)
+            raise
+        self._invalidate(key, result.modifiedIndex)
+        return result
+
+    def _invalidate(self, key, index=None):
+        """
+        Drops the cached reads a change of key made stale. Failed changes
+        invalidate too: a failed compare-and-swap shows that our results
+        are stale, and a change that timed out may have been made.
+        """
+        if self.read_cache is not None:
+            self.read_cache.invalidate(key, index)
 
     def pop(self, key, recursive=None, dir=None, **kwdargs):
         """
@@ -821,12 +1297,59 @@ class Client(object):
             local_index = response.modifiedIndex + 1
             yield response
 
+    @contextmanager
+    def deadline(self, seconds):
+        """
+        Context manager bounding the time taken by all the requests done in
+        its scope by the current thread, or the current asyncio task,
+        including the retries and the failover to other members. Each attempt
+        only gets the time left. Tasks started in its scope inherit it.
+
+        Nested deadlines can only shorten the current one. None means no
+        deadline.
+
+        >>> with client.deadline(0.5):
+        ...     client.read('/key')
+        ...     client.write('/other', 'value')
+
+        Raises:
+            etcd.EtcdDeadlineExceeded: If the deadline is reached.
+        """
+        previous = self._deadline.get()
+        token = None
+        if seconds is not None:
+            deadline = time.monotonic() + seconds
+            if previous is None or deadline < previous:
+                token = self._deadline.set(deadline)
+        try:
+            yield
+        finally:
+            if token is not None:
+                self._deadline.reset(token)
+
+    def _remaining_timeout(self, timeout=None, cause=None):
+        """
+        The timeout for the next attempt of a request: timeout, capped to the
+        time left before the current deadline, if any.
+        """
+        deadline = self._deadline.get()
+        if deadline is None:
+            return timeout
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise etcd.EtcdDeadlineExceeded("Deadline exceeded", cause=cause)
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
     def get_lock(self, *args, **kwargs):
         raise NotImplementedError("Lock primitives were removed from etcd 2.0")
 
     @property
     def election(self):
-        raise NotImplementedError("Election primitives were removed from etcd 2.0")
+        raise NotImplementedError(
+            "Election primitives were removed from etcd 2.0, use etcd.Election instead"
+        )
 
     def _result_from_response(self, response):
         """Creates an EtcdResult from json dictionary"""
@@ -844,14 +1367,36 @@ class Client(object):
         except Exception as e:
             raise etcd.EtcdException("Unable to decode server response: %r" % e)
 
+    def _failover(self, failed_uri, cause=None):
+        """
+        Moves the client away from failed_uri, unless another thread has
+        already done so.
+        """
+        with self._endpoint_lock:
+            if self._base_uri != failed_uri:
+                _log.debug("Already moved from %s to %s", failed_uri, self._base_uri)
+                return
+            # _next_server() raises EtcdException if there are no
+            # machines left to try.
+            self._base_uri = self._next_server(cause=cause)
+
+    def _refresh_machines(self):
+        """Refreshes the machines cache from the cluster."""
+        machines = self.machines
+        with self._endpoint_lock:
+            self._machines_cache = [m for m in machines if m != self._base_uri]
+
     def _next_server(self, cause=None):
         """Selects the next server in the list, refreshes the server list."""
         _log.debug(
             "Selecting next machine in cache. Available machines: %s",
             self._machines_cache,
         )
+        if not self._machines_cache:
+            # The cluster may have been moved to other addresses.
+            self._machines_cache = self._rediscover()
         try:
-            mach = self._machines_cache.pop()
+            mach = self._machines_cache.pop(0)
         except IndexError:
             _log.error("Machines cache is empty, no machines to try.")
             raise etcd.EtcdConnectionFailed("No more machines in the cluster", cause=cause)
@@ -873,10 +1418,18 @@ class Client(object):
             if not path.startswith("/"):
                 raise ValueError("Path does not start with /")
 
+            if not self._connected:
+                self.connect()
+
+            attempt = 0
+            cause = None
             while not response:
                 some_request_failed = False
+                attempt += 1
+                base_uri = self._local.base_uri = self._base_uri
+                attempt_timeout = self._remaining_timeout(timeout, cause=cause)
                 try:
-                    response = payload(self, path, method, params=params, timeout=timeout)
+                    response = payload(self, path, method, params=params, timeout=attempt_timeout)
                     # Check the cluster ID hasn't changed under us.  We use
                     # preload_content=False above so we can read the headers
                     # before we wait for the content of a watch.
@@ -885,23 +1438,35 @@ class Client(object):
                     # IO-related errors in this method rather than when we try to
                     # access it later.
                     _ = response.data
-                    # urllib3 doesn't wrap all httplib exceptions and earlier versions
-                    # don't wrap socket errors either.
-                except (HTTPError, HTTPException, socket.error) as e:
-                    if (
-                        isinstance(params, dict)
-                        and params.get("wait") == "true"
-                        and isinstance(e, ReadTimeoutError)
-                    ):
+                    # The transport maps the errors of its HTTP library.
+                except TransportError as e:
+                    cause = e
+                    read_timeout = isinstance(e, ReadTimeout)
+                    if attempt_timeout != timeout and read_timeout:
+                        # The deadline was shorter than the timeout
+                        self._remaining_timeout(cause=e)
+                    if isinstance(params, dict) and params.get("wait") == "true" and read_timeout:
                         _log.debug("Watch timed out.")
                         raise etcd.EtcdWatchTimedOut("Watch timed out: %r" % e, cause=e)
-                    _log.error("Request to server %s failed: %r", self._base_uri, e)
+                    _log.error("Request to server %s failed: %r", base_uri, e)
                     if self._allow_reconnect:
+                        if not self.retry_policy.should_retry(attempt, method, params, e):
+                            raise etcd.EtcdConnectionFailed(
+                                "Connection to etcd failed due to %r, not retrying" % e,
+                                cause=e,
+                            )
                         _log.info("Reconnection allowed, looking for another " "server.")
-                        # _next_server() raises EtcdException if there are no
+                        # _failover() raises EtcdException if there are no
                         # machines left to try, breaking out of the loop.
-                        self._base_uri = self._next_server(cause=e)
+                        self._failover(base_uri, cause=e)
                         some_request_failed = True
+                        backoff = self.retry_policy.backoff(attempt)
+                        remaining = self._remaining_timeout(cause=e)
+                        if remaining is not None and backoff >= remaining:
+                            raise etcd.EtcdDeadlineExceeded(
+                                "Deadline exceeded before the next attempt", cause=e
+                            )
+                        time.sleep(backoff)
 
                         # if exception is raised on _ = response.data
                         # the condition for while loop will be False
@@ -922,8 +1487,20 @@ class Client(object):
                 if some_request_failed:
                     if not self._use_proxies:
                         # The cluster may have changed since last invocation
-                        self._machines_cache = self.machines
-                        self._machines_cache.remove(self._base_uri)
+                        self._refresh_machines()
+            if (
+                response.status == 401
+                and self._credentials_provider is not None
+                and not getattr(self._local, "reloading_credentials", False)
+                and self._load_credentials()
+            ):
+                # The credentials were rotated, try again with the new ones.
+                _log.info("Credentials rejected, retrying with new ones")
+                self._local.reloading_credentials = True
+                try:
+                    return wrapper(self, path, method, params=params, timeout=timeout)
+                finally:
+                    self._local.reloading_credentials = False
             return self._handle_server_response(response)
 
         return wrapper
@@ -931,63 +1508,49 @@ class Client(object):
     @_wrap_request
     def api_execute(self, path, method, params=None, timeout=None):
         """Executes the query."""
-        url = self._base_uri + path
-
-        if (method == self._MGET) or (method == self._MDELETE):
-            return self.http.request(
-                method,
-                url,
-                timeout=timeout,
-                fields=params,
-                redirect=self.allow_redirect,
-                headers=self._get_headers(),
-                preload_content=False,
-            )
-
-        elif (method == self._MPUT) or (method == self._MPOST):
-            return self.http.request_encode_body(
-                method,
-                url,
-                fields=params,
-                timeout=timeout,
-                encode_multipart=False,
-                redirect=self.allow_redirect,
-                headers=self._get_headers(),
-                preload_content=False,
-            )
-        else:
+        if method not in (self._MGET, self._MDELETE, self._MPUT, self._MPOST):
             raise etcd.EtcdException("HTTP method {} not supported".format(method))
+        url = self._request_uri() + path
+        return self._send(method, url, fields=params, headers=self._get_headers(), timeout=timeout)
 
     @_wrap_request
     def api_execute_json(self, path, method, params=None, timeout=None):
-        url = self._base_uri + path
+        url = self._request_uri() + path
         json_payload = json.dumps(params)
-        headers = self._get_headers()
-        headers["Content-Type"] = "application/json"
-        return self.http.urlopen(
+        return self._send(
             method,
             url,
             body=json_payload,
+            headers=self._get_credentials().json_headers,
             timeout=timeout,
-            redirect=self.allow_redirect,
-            headers=headers,
-            preload_content=False,
         )
 
+    def _send(self, method, url, fields=None, body=None, headers=None, timeout=None):
+        """Sends a request with the transport."""
+        return self._transport.request(
+            method, url, fields=fields, body=body, headers=headers, timeout=timeout
+        )
+
+    def _request_uri(self):
+        """The server the current thread is sending its request to."""
+        return getattr(self._local, "base_uri", None) or self._base_uri
+
     def _check_cluster_id(self, response, path):
         cluster_id = response.getheader("x-etcd-cluster-id")
         if not cluster_id:
             if self.version_prefix in path:
                 _log.warning("etcd response did not contain a cluster ID")
             return
-        id_changed = self.expected_cluster_id and cluster_id != self.expected_cluster_id
-        # Update the ID so we only raise the exception once.
-        old_expected_cluster_id = self.expected_cluster_id
-        self.expected_cluster_id = cluster_id
+        with self._endpoint_lock:
+            id_changed = self.expected_cluster_id and cluster_id != self.expected_cluster_id
+            # Update the ID so we only raise the exception once.
+            old_expected_cluster_id = self.expected_cluster_id
+            self.expected_cluster_id = cluster_id
         if id_changed:
             # Defensive: clear the pool so that we connect afresh next
-            # time.
-            self.http.clear()
+            # time, and detect what the new cluster supports.
+            self._transport.clear()
+            self._capabilities = None
             raise etcd.EtcdClusterIdChanged(
                 "The UUID of the cluster changed from {} to "
                 "{}.".format(old_expected_cluster_id, cluster_id)
@@ -1008,10 +1571,61 @@ class Client(object):
             except (TypeError, ValueError):
                 # Bad JSON, make a response locally.
                 r = {"message": "Bad response", "cause": str(resp)}
+                capabilities = self._capabilities
+                if response.status == 404 and capabilities is not None and not capabilities.v2:
+                    r["message"] = "etcd {} does not serve the v2 API, see --enable-v2".format(
+                        capabilities.server_version
+                    )
             etcd.EtcdError.handle(r)
 
+    def set_credentials(self, username, password):
+        """
+        Sets the credentials of the next requests, e.g. after they were
+        rotated. Both are kept, but requests are only authenticated once
+        both are set.
+        """
+        headers = {}
+        if username and password:
+            headers = urllib3.make_headers(basic_auth=":".join((username, password)))
+        json_headers = dict(headers)
+        json_headers["Content-Type"] = "application/json"
+        # Headers are computed once, and shared by all the requests.
+        self._credentials = _Credentials(
+            username, password, MappingProxyType(headers), MappingProxyType(json_headers)
+        )
+
+    def _load_credentials(self):
+        """
+        Asks the credentials provider for its credentials, and returns
+        whether they changed.
+        """
+        old = self._credentials
+        self.set_credentials(*self._credentials_provider())
+        new = self._credentials
+        return old is None or (old.username, old.password) != (new.username, new.password)
+
+    def _get_credentials(self):
+        credentials = self._credentials
+        if credentials is None:
+            self._load_credentials()
+            credentials = self._credentials
+        return credentials
+
+    @property
+    def username(self):
+        return self._get_credentials().username
+
+    @username.setter
+    def username(self, username):
+        self.set_credentials(username, self._get_credentials().password)
+
+    @property
+    def password(self):
+        return self._get_credentials().password
+
+    @password.setter
+    def password(self, password):
+        self.set_credentials(self._get_credentials().username, password)
+
     def _get_headers(self):
-        if self.username and self.password:
-            credentials = ":".join((self.username, self.password))
-            return urllib3.make_headers(basic_auth=credentials)
-        return {}
+        return self._get_credentials().headers
@@ -0,0 +1,95 @@
+"""
+Distributed counter recipe, leasing ranges of values.
+"""
+
+import logging
+import threading
+
+_log = logging.getLogger(__name__)
+
+
+class Counter(object):
+    """
+    Allocator of unique, increasing integers (ids, sequence numbers).
+
+    The key holds the next value nobody leased yet. A counter takes a
+    range of batch_size values from it with a single compare-and-swap,
+    then hands them out from memory, so etcd is only involved once every
+    batch_size values. Values are unique across counters, and increasing
+    for each counter, but not across counters; the values left in the
+    range of a counter that goes away are never used.
+
+    Leases are done with Client.transact: conflicting leases are retried
+    after a backoff, and counted in stats.
+
+    >>> ids = etcd.Counter(client, '/ids', batch_size=1000)
+    >>> ids.next()
+    0
+    >>> ids.next()
+    1
+    """
+
+    def __init__(self, client, key, batch_size=1000, retry_policy=None):
+        """
+        Args:
+            client (etcd.Client): The client to use.
+
+            key (str): The key holding the counter. It is created, starting
+                       at 0, if needed.
+
+            batch_size (int): How many values to lease at once.
+
+            retry_policy (etcd.RetryPolicy): Gives the backoff between two
+                                             conflicting leases, and their
+                                             maximum number of attempts.
+                                             Defaults to the client's.
+        """
+        if batch_size < 1:
+            raise ValueError("The batch size must be at least 1")
+        self.client = client
+        self.key = key
+        self.batch_size = batch_size
+        self.retry_policy = retry_policy or client.retry_policy
+        self._lock = threading.Lock()
+        self._next = self._end = 0
+        # Last known state of the key, to try a lease without reading it
+        self._known = None
+        # The counters of Client.transact for our leases, and the number
+        # of values handed out
+        self.stats = {"transactions": 0, "conflicts": 0, "failures": 0, "backoff": 0.0, "issued": 0}
+
+    def next(self):
+        """Returns the next value."""
+        with self._lock:
+            if self._next == self._end:
+                self._next, self._end = self._lease(self.batch_size)
+            value = self._next
+            self._next += 1
+            self.stats["issued"] += 1
+            return value
+
+    def next_range(self, count):
+        """
+        Returns the range of the next count values, leased from etcd
+        directly, as a (start, end) tuple.
+        """
+        with self._lock:
+            start, end = self._lease(count)
+            self.stats["issued"] += count
+            return start, end
+
+    def _lease(self, count):
+        max_attempts = self.retry_policy.max_attempts
+        res = self.client.transact(
+            self.key,
+            lambda value: int(value or 0) + count,
+            max_retries=max_attempts - 1 if max_attempts is not None else None,
+            backoff=self.retry_policy.backoff_base,
+            prev=self._known,
+            stats=self.stats,
+        )
+        # Next time, try to lease without reading the key first.
+        self._known = res
+        end = int(res.value)
+        _log.debug("Leased [%d, %d) from %s", end - count, end, self.key)
+        return end - count, end
@@ -0,0 +1,143 @@
+"""
+SRV record based discovery of the etcd cluster members.
+"""
+
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+_log = logging.getLogger(__name__)
+
+
+class SrvDiscovery(object):
+    """
+    Looks up the etcd cluster members in the SRV records of a domain.
+
+    All the well-known SRV names are queried concurrently, and the first one
+    (in order of preference) that has an answer wins. The answer is cached
+    for the TTL of the record set, so calling hosts() again only goes to the
+    DNS once the record has expired.
+    """
+
+    # Used when the resolver does not tell us the TTL of the answer.
+    default_ttl = 60
+
+    def __init__(self, domain, resolver=None, rng=None):
+        """
+        Args:
+            domain (str): Domain to search the SRV records in.
+
+            resolver (object): Object with a resolve(qname, rdtype) method,
+                               like dns.resolver.Resolver. Defaults to the
+                               system resolver.
+
+            rng (random.Random): Source of randomness for the weighted
+                                 ordering of the records.
+        """
+        self.domain = domain
+        self.srv_names = [
+            "_etcd-client-ssl._tcp.{}".format(domain),
+            "_etcd-client._tcp.{}".format(domain),
+            "_etcd-ssl._tcp.{}".format(domain),
+            "_etcd._tcp.{}".format(domain),
+        ]
+        self._resolver = resolver
+        self._random = rng or random.Random()
+        self._lock = threading.Lock()
+        self._hosts = None
+        self._secure = False
+        self._expires_at = 0
+
+    @property
+    def cached_hosts(self):
+        """The hosts found by the last resolution, or None."""
+        return self._hosts
+
+    @property
+    def secure(self):
+        """True if the hosts were found in one of the -ssl records."""
+        return self._secure
+
+    @property
+    def expired(self):
+        return self._hosts is None or time.monotonic() >= self._expires_at
+
+    def hosts(self, refresh=False):
+        """
+        Returns the discovered hosts as a tuple of (host, port) tuples,
+        ordered by priority and weight.
+
+        The DNS is only queried if the cached answer has expired, or if
+        refresh is true.
+
+        Raises:
+            ValueError: if no SRV record could be found.
+        """
+        with self._lock:
+            if refresh or self.expired:
+                self._resolve()
+            return self._hosts
+
+    def _query(self, srv_name):
+        # dnspython is only needed when discovery is used, so don't make
+        # "import etcd" pay for it.
+        import dns.resolver
+        from dns.resolver import NXDOMAIN, NoAnswer
+
+        try:
+            if self._resolver is not None:
+                return self._resolver.resolve(srv_name, "SRV")
+            resolve = getattr(dns.resolver, "resolve", None) or dns.resolver.query
+            return resolve(srv_name, "SRV")
+        except (NXDOMAIN, NoAnswer):
+            return None
+
+    def _resolve(self):
+        with ThreadPoolExecutor(max_workers=len(self.srv_names)) as executor:
+            futures = [(name, executor.submit(self._query, name)) for name in self.srv_names]
+            for srv_name, future in futures:
+                answers = future.result()
+                if answers is not None and len(answers):
+                    break
+            else:
+                raise ValueError("Could not find SRV record for domain {}.".format(self.domain))
+
+        hosts = tuple(
+            (answer.target.to_text(omit_final_dot=True), answer.port)
+            for answer in self._order(list(answers))
+        )
+        _log.debug("Found %s in %s", hosts, srv_name)
+        if not len(hosts):
+            raise ValueError("The SRV record is present but no hosts were found")
+
+        try:
+            ttl = answers.rrset.ttl
+        except AttributeError:
+            ttl = self.default_ttl
+        self._hosts = hosts
+        self._secure = "-ssl" in srv_name
+        self._expires_at = time.monotonic() + ttl
+
+    def _order(self, records):
+        """
+        Orders the records as described in RFC 2782: lowest priority first,
+        and a weighted random choice among records of the same priority.
+        """
+        ordered = []
+        for priority in sorted(set(r.priority for r in records)):
+            group = [r for r in records if r.priority == priority]
+            while group:
+                total = sum(r.weight for r in group)
+                if not total:
+                    # Only zero-weight records left, keep the DNS order.
+                    ordered.extend(group)
+                    break
+                pick = self._random.random() * total
+                for i, record in enumerate(group):
+                    pick -= record.weight
+                    if pick < 0:
+                        break
+                ordered.append(group.pop(i))
+        return ordered
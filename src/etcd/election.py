@@ -0,0 +1,141 @@
+"""
+Leader election recipe, built on the lock recipe.
+"""
+
+import logging
+import uuid
+
+import etcd
+from etcd.lock import Lock
+
+_log = logging.getLogger(__name__)
+
+
+class Election(Lock):
+    """
+    Leader election recipe: the candidates queue up like the contenders of
+    an etcd.Lock, and the leader is the one holding the lock.
+
+    The value of a candidate's key is its value (e.g. "host:port"), so
+    anybody can find the leader with a single read, or follow its changes
+    with observe(). The key of a candidate is kept alive with a short TTL,
+    so a crashed leader is replaced quickly.
+
+    >>> election = etcd.Election(client, 'scheduler', value='10.0.0.1:8080')
+    >>> election.campaign()  # blocks until we are the leader
+    >>> election.is_leader
+    True
+    >>> election.resign()
+
+    >>> for leader in etcd.Election(client, 'scheduler').observe():
+    ...     print(leader)
+    """
+
+    _leave_actions = frozenset(("delete", "expire", "compareAndDelete"))
+
+    def __init__(self, client, name, value=None, ttl=10, on_lease_lost=None):
+        """
+        Args:
+            client (etcd.Client): The client to use.
+
+            name (str): Name of the election.
+
+            value (str): What the other candidates and observers see of us
+                         when we lead. It must be unique among candidates;
+                         a random one is used by default.
+
+            ttl (int): TTL of our key, kept alive while we campaign and lead.
+
+            on_lease_lost (callable): Called with the election, from the
+                                      keepalive thread, if our key could not
+                                      be kept alive: we may not lead anymore.
+        """
+        super(Election, self).__init__(client, name, on_lease_lost=on_lease_lost)
+        self._uuid = value if value is not None else uuid.uuid4().hex
+        self.ttl = ttl
+
+    @property
+    def value(self):
+        return self._uuid
+
+    @property
+    def is_leader(self):
+        """True if we won the election and still hold our key."""
+        return self.is_taken and not self.lease_lost
+
+    def campaign(self, timeout=0):
+        """
+        Runs for leader, and blocks until we are elected.
+
+        Args:
+            timeout (int): Seconds to wait before giving up, 0 to wait
+                           forever.
+
+        Raises:
+            etcd.EtcdLockExpired: If our key went away while we waited.
+
+            etcd.EtcdWatchTimedOut: If timeout is reached.
+        """
+        return self.acquire(blocking=True, lock_ttl=self.ttl, timeout=timeout, keepalive=True)
+
+    def resign(self):
+        """Steps down, or stops running for leader."""
+        self.release()
+
+    def leader(self):
+        """The value of the current leader, or None if there is none."""
+        try:
+            nodes = self.client.read(self.path, sorted=True)._children
+        except etcd.EtcdKeyNotFound:
+            return None
+        return nodes[0].get("value") if nodes else None
+
+    def observe(self):
+        """
+        Generator yielding the value of the leader (None when there is no
+        leader) now, then every time it changes.
+
+        The candidates are listed once, then followed with a single stream
+        of watch requests on the election dir.
+        """
+        candidates, index = self._candidates()
+        leader = self._leader_of(candidates)
+        yield leader
+        while True:
+            try:
+                r = self.client.watch(self.path, index=index, timeout=0, recursive=True)
+            except etcd.EtcdWatchTimedOut:
+                continue
+            except etcd.EtcdEventIndexCleared:
+                # We fell too far behind the history of events, start over.
+                _log.debug("Lost track of the events of %s, listing it again", self.path)
+                candidates, index = self._candidates()
+            else:
+                index = r.modifiedIndex + 1
+                if r.key == self.path:
+                    if r.action in self._leave_actions:
+                        candidates = {}
+                elif r.action in self._leave_actions:
+                    candidates.pop(r.key, None)
+                elif not r.dir:
+                    candidates[r.key] = r.value
+            new_leader = self._leader_of(candidates)
+            if new_leader != leader:
+                leader = new_leader
+                yield leader
+
+    def _candidates(self):
+        try:
+            res = self.client.read(self.path, sorted=True)
+        except etcd.EtcdKeyNotFound as e:
+            # Watch from the index of the error, or from now if unknown.
+            index = (e.payload or {}).get("index")
+            return {}, index + 1 if index is not None else None
+        candidates = dict((node["key"], node.get("value")) for node in res._children)
+        return candidates, res.etcd_index + 1
+
+    @staticmethod
+    def _leader_of(candidates):
+        if not candidates:
+            return None
+        return candidates[min(candidates)]
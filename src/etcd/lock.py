@@ -1,15 +1,25 @@
+import collections
 import logging
+import threading
+import time
 import etcd
 import uuid
+import weakref
 
 _log = logging.getLogger(__name__)
 
 
-class Lock(object):
+class _LockBase(object):
     """
-    Locking recipe for etcd, inspired by the kazoo recipe for zookeeper
+    The keys of a lock, shared by Lock and etcd.aio.AsyncLock: each contender
+    appends a key to the lock dir, and waits for the key right before its
+    own to go away. Only keeps track of our key, the subclasses make the
+    requests.
     """
 
+    # Watch events telling that the watched key is still there
+    _update_actions = frozenset(("set", "update", "compareAndSwap"))
+
     def __init__(self, client, lock_name):
         self.client = client
         self.name = lock_name
@@ -21,7 +31,14 @@ class Lock(object):
         self.path = "{}/{}".format(client.lock_prefix, lock_name)
         self.is_taken = False
         self._sequence = None
-        _log.debug("Initiating lock for %s with uuid %s", self.path, self._uuid)
+        # Our position in the lock dir when we last listed it, and the
+        # etcd index of that listing
+        self._position = None
+        self._index = None
+        # Whether the key we watch going away gives us the lock
+        self._takeover = False
+        # Whether we ever tried to write our key
+        self._written = False
 
     @property
     def uuid(self):
@@ -30,7 +47,104 @@ class Lock(object):
         """
         return self._uuid
 
-    @uuid.setter
+    @property
+    def lock_key(self):
+        if not self._sequence:
+            raise ValueError("No sequence present.")
+        return self.path + "/" + str(self._sequence)
+
+    def _set_sequence(self, key):
+        self._sequence = key.replace(self.path, "").lstrip("/")
+        self._position = None
+
+    def _find_uuid(self, leaves):
+        """Looks for our uuid in the keys of the lock dir."""
+        for r in leaves:
+            if r.value == self._uuid:
+                self._set_sequence(r.key)
+                return True
+        return False
+
+    def _locate(self, res):
+        """
+        Returns the key holding the lock, and the node of the key right
+        before ours (None if we hold the lock), given the listing of the
+        lock dir.
+
+        The lock dir is listed sorted by the server. Only our predecessor is
+        turned into an EtcdResult, and our key is found with a binary search
+        bounded by our last known position, as keys are only ever added
+        after ours.
+        """
+        nodes = res._children
+        self._index = res.etcd_index
+        lock_key = self.lock_key
+        hi = len(nodes)
+        if self._position is not None:
+            hi = min(hi, self._position + 1)
+        i = _bisect_key(nodes, lock_key, hi)
+        if (i == len(nodes) or nodes[i]["key"] != lock_key) and hi < len(nodes):
+            i = _bisect_key(nodes, lock_key, len(nodes))
+        if i == len(nodes) or nodes[i]["key"] != lock_key:
+            # Something very wrong is going on, most probably
+            # our lock has expired
+            raise etcd.EtcdLockExpired("Lock not found")
+        self._position = i
+        j = self._blocker(nodes, i)
+        self._takeover = j == 0
+        if j is None:
+            _log.debug("No key blocking our one, we are the locker")
+            return (lock_key, None)
+        _log.debug("Locker: %s, key to watch: %s", nodes[0]["key"], nodes[j]["key"])
+        return (nodes[0]["key"], etcd.EtcdResult(None, nodes[j]))
+
+    def _take_over(self):
+        """
+        The key we watched was the last one between us and the lock, and
+        new keys can only come after ours: we hold the lock, provided our
+        key is still there. Returns the key holding the lock, and None.
+        """
+        _log.debug("The key we watched was blocking us, we are the locker now")
+        self._position -= 1
+        self._takeover = False
+        return (self.lock_key, None)
+
+    def _blocker(self, nodes, i):
+        """
+        Position of the key to watch, given the sorted nodes of the lock
+        dir and the position of ours, or None if we hold the lock.
+        """
+        return i - 1 if i else None
+
+
+class Lock(_LockBase):
+    """
+    Locking recipe for etcd, inspired by the kazoo recipe for zookeeper
+    """
+
+    def __init__(self, client, lock_name, keepalive_ttl=None, on_lease_lost=None):
+        """
+        Args:
+            client (etcd.Client): The client to use.
+
+            lock_name (str): Name of the lock, shared by all the contenders.
+
+            keepalive_ttl (int): If set, using the lock as a context manager
+                                 gives our key this TTL and keeps it alive
+                                 in the background, see acquire().
+
+            on_lease_lost (callable): Called with the lock, from the keepalive
+                                      thread, if our key could not be kept
+                                      alive.
+        """
+        super(Lock, self).__init__(client, lock_name)
+        self._ttl = None
+        self.keepalive_ttl = keepalive_ttl
+        self.on_lease_lost = on_lease_lost
+        self._keeper = None
+        _log.debug("Initiating lock for %s with uuid %s", self.path, self._uuid)
+
+    @_LockBase.uuid.setter
     def uuid(self, value):
         old_uuid = self._uuid
         self._uuid = value
@@ -55,22 +169,40 @@ class Lock(object):
             self.is_taken = False
             return False
 
-    def acquire(self, blocking=True, lock_ttl=3600, timeout=0):
+    @property
+    def lease_lost(self):
+        """
+        True if the keepalive could not refresh our key in time: the lock
+        may have been given to someone else.
+        """
+        return self._keeper is not None and self._keeper.lost
+
+    def acquire(self, blocking=True, lock_ttl=3600, timeout=0, keepalive=False):
         """
         Acquire the lock.
 
         :param blocking Block until the lock is obtained, or timeout is reached
         :param lock_ttl The duration of the lock we acquired, set to None for eternal locks
         :param timeout The time to wait before giving up on getting a lock
+        :param keepalive Refresh the TTL of our key in the background, while we
+                         wait for the lock and until it is released. This
+                         allows a short lock_ttl, so the lock of a crashed
+                         holder is quickly given to the next contender.
 
         Raises:
             etcd.EtcdLockExpired: If lock expired when try to acquire.
 
-            etcd.EtcdWatchTimeOut: If timeout is reached.
+            etcd.EtcdWatchTimedOut: If timeout is reached.
         """
-        # First of all try to write, if our lock is not present.
-        if not self._find_lock():
+        if keepalive and not lock_ttl:
+            raise ValueError("A lock_ttl is needed to keep the lock alive")
+        self._stop_keepalive()
+        self._ttl = lock_ttl
+        # First of all try to write, if our lock is not present. There is no
+        # need to look for it if we never tried to write it.
+        if not ((self._sequence or self._written) and self._find_lock()):
             _log.debug("Lock not found, writing it to %s", self.path)
+            self._written = True
             res = self.client.write(self.path, self.uuid, ttl=lock_ttl, append=True)
             self._set_sequence(res.key)
             _log.debug("Lock key %s written, sequence is %s", res.key, self._sequence)
@@ -78,13 +210,34 @@ class Lock(object):
             # Renew our lock if already here!
             self.client.write(self.lock_key, self.uuid, ttl=lock_ttl)
 
+        if keepalive:
+            self._keeper = LeaseKeeper(
+                self.client, self.lock_key, lock_ttl, on_lost=self._lease_lost
+            ).start()
         # now get the owner of the lock, and the next lowest sequence
-        return self._acquired(blocking=blocking, timeout=timeout)
+        try:
+            acquired = self._acquired(blocking=blocking, timeout=timeout)
+        except Exception:
+            self._stop_keepalive()
+            raise
+        if not acquired:
+            self._stop_keepalive()
+        return acquired
+
+    def _lease_lost(self):
+        _log.warning("Could not keep lock %s alive", self.lock_key)
+        if self.on_lease_lost is not None:
+            self.on_lease_lost(self)
+
+    def _stop_keepalive(self):
+        if self._keeper is not None:
+            self._keeper.stop()
 
     def release(self):
         """
         Release the lock
         """
+        self._stop_keepalive()
         if not self._sequence:
             self._find_lock()
         try:
@@ -100,7 +253,10 @@ class Lock(object):
         """
         You can use the lock as a contextmanager
         """
-        self.acquire(blocking=True, lock_ttl=None)
+        if self.keepalive_ttl:
+            self.acquire(blocking=True, lock_ttl=self.keepalive_ttl, keepalive=True)
+        else:
+            self.acquire(blocking=True, lock_ttl=None)
         return self
 
     def __exit__(self, type, value, traceback):
@@ -108,42 +264,59 @@ class Lock(object):
         return False
 
     def _acquired(self, blocking=True, timeout=0):
+        t = max(0, timeout)
         locker, nearest = self._get_locker()
-        self.is_taken = False
-        if self.lock_key == locker:
-            _log.debug("Lock acquired!")
-            # We own the lock, yay!
-            self.is_taken = True
-            return True
-        else:
+        while True:
+            if self.lock_key == locker:
+                _log.debug("Lock acquired!")
+                # We own the lock, yay!
+                self.is_taken = True
+                return True
             self.is_taken = False
             if not blocking:
                 return False
-            # Let's look for the lock
-            watch_key = nearest.key
-            _log.debug("Lock not acquired, now watching %s", watch_key)
-            t = max(0, timeout)
-            while True:
+            self._wait(nearest, t)
+            if self._takeover:
+                # No need to list the lock dir, just check our own key is
+                # still there.
                 try:
-                    r = self.client.watch(watch_key, timeout=t, index=nearest.modifiedIndex + 1)
-                    _log.debug("Detected variation for %s: %s", r.key, r.action)
-                    return self._acquired(blocking=True, timeout=timeout)
+                    self.client.read(self.lock_key)
                 except etcd.EtcdKeyNotFound:
-                    _log.debug("Key %s not present anymore, moving on", watch_key)
-                    return self._acquired(blocking=True, timeout=timeout)
-                except (etcd.EtcdLockExpired, etcd.EtcdWatchTimeOut) as e:
-                    raise e
-                except etcd.EtcdException:
-                    _log.exception("Unexpected exception")
-
-    @property
-    def lock_key(self):
-        if not self._sequence:
-            raise ValueError("No sequence present.")
-        return self.path + "/" + str(self._sequence)
+                    raise etcd.EtcdLockExpired("Lock not found")
+                locker, nearest = self._take_over()
+            else:
+                locker, nearest = self._get_locker()
 
-    def _set_sequence(self, key):
-        self._sequence = key.replace(self.path, "").lstrip("/")
+    def _wait(self, nearest, timeout):
+        """Waits for the key we watch to go away."""
+        watch_key = nearest.key
+        _log.debug("Lock not acquired, now watching %s", watch_key)
+        index = nearest.modifiedIndex + 1
+        while True:
+            try:
+                r = self.client.watch(watch_key, timeout=timeout, index=index)
+                _log.debug("Detected variation for %s: %s", r.key, r.action)
+                if r.action in self._update_actions:
+                    # The key is still there, keep watching it.
+                    index = r.modifiedIndex + 1
+                    continue
+                return
+            except etcd.EtcdKeyNotFound:
+                _log.debug("Key %s not present anymore, moving on", watch_key)
+                return
+            except etcd.EtcdEventIndexCleared:
+                # The history of events moved past our index, see if the
+                # key is still there and watch it from now.
+                _log.debug("Lost track of the events of %s, reading it again", watch_key)
+                try:
+                    index = self.client.read(watch_key).etcd_index + 1
+                except etcd.EtcdKeyNotFound:
+                    return
+            except (etcd.EtcdLockExpired, etcd.EtcdConnectionFailed):
+                # Timeouts, deadlines, and no member left to ask
+                raise
+            except etcd.EtcdException:
+                _log.exception("Unexpected exception")
 
     def _find_lock(self):
         if self._sequence:
@@ -155,29 +328,447 @@ class Lock(object):
                 return False
         elif self._uuid:
             try:
-                for r in self.client.read(self.path, recursive=True).leaves:
-                    if r.value == self._uuid:
-                        self._set_sequence(r.key)
-                        return True
+                return self._find_uuid(self.client.read(self.path, recursive=True).leaves)
             except etcd.EtcdKeyNotFound:
                 pass
         return False
 
     def _get_locker(self):
-        results = [res for res in self.client.read(self.path, recursive=True).leaves]
+        """
+        Returns the key holding the lock, and the node of the key right
+        before ours (None if we hold the lock), see _locate().
+        """
         if not self._sequence:
             self._find_lock()
-        l = sorted([r.key for r in results])
-        _log.debug("Lock keys found: %s", l)
-        try:
-            i = l.index(self.lock_key)
-            if i == 0:
-                _log.debug("No key before our one, we are the locker")
-                return (l[0], None)
+        return self._locate(self.client.read(self.path, sorted=True))
+
+
+class ReadLock(Lock):
+    """
+    The shared side of an etcd.RWLock: it is held as long as no write lock
+    was asked for before it.
+
+    While waiting, it watches the nearest write lock key before its own,
+    so all the readers queued behind a writer get in when it leaves.
+    """
+
+    prefix = "read-"
+
+    def __init__(self, client, lock_name, **kwargs):
+        super(ReadLock, self).__init__(client, lock_name, **kwargs)
+        self._uuid = self.prefix + self._uuid
+
+    def _blocker(self, nodes, i):
+        for j in range(i - 1, -1, -1):
+            if not nodes[j].get("value", "").startswith(self.prefix):
+                return j
+        return None
+
+
+class WriteLock(Lock):
+    """
+    The exclusive side of an etcd.RWLock: it is held once all the keys
+    before its own, of readers or writers, are gone.
+    """
+
+    prefix = "write-"
+
+    def __init__(self, client, lock_name, **kwargs):
+        super(WriteLock, self).__init__(client, lock_name, **kwargs)
+        self._uuid = self.prefix + self._uuid
+
+
+class RWLock(object):
+    """
+    Readers-writer lock recipe: any number of readers, or a single writer,
+    hold the lock at a time.
+
+    Readers and writers queue in order in the same lock dir, so a writer
+    is not starved by a stream of readers, and plain etcd.Lock holders of
+    the same name count as writers.
+
+    >>> rwlock = etcd.RWLock(client, 'config')
+    >>> with rwlock.read_lock:
+    ...     read_config()
+    >>> with rwlock.write_lock:
+    ...     update_config()
+    """
+
+    def __init__(self, client, lock_name, **kwargs):
+        """
+        Args:
+            client (etcd.Client): The client to use.
+
+            lock_name (str): Name of the lock, shared by all the contenders.
+
+            Other parameters are passed to both etcd.Lock objects.
+        """
+        self.name = lock_name
+        self.read_lock = ReadLock(client, lock_name, **kwargs)
+        self.write_lock = WriteLock(client, lock_name, **kwargs)
+
+
+class Semaphore(Lock):
+    """
+    Counting semaphore recipe: the first limit keys of the lock dir hold
+    the semaphore.
+
+    The first waiter watches the whole lock dir, and gets in when any key
+    before its own goes away. The other waiters watch their predecessor,
+    which rewrites its key once it gets in, to hand the first place in the
+    queue over.
+
+    >>> with etcd.Semaphore(client, 'workers', 4):
+    ...     do_work()
+    """
+
+    _release_actions = frozenset(("delete", "expire", "compareAndDelete"))
+
+    def __init__(self, client, lock_name, limit, **kwargs):
+        """
+        Args:
+            client (etcd.Client): The client to use.
+
+            lock_name (str): Name of the semaphore, shared by all the
+                             contenders.
+
+            limit (int): How many contenders may hold the semaphore at once.
+
+            Other parameters are accepted as for etcd.Lock.
+        """
+        if limit < 1:
+            raise ValueError("The limit of a semaphore must be at least 1")
+        super(Semaphore, self).__init__(client, lock_name, **kwargs)
+        self.limit = limit
+
+    def _blocker(self, nodes, i):
+        return i - 1 if i >= self.limit else None
+
+    def _get_locker(self):
+        locker, nearest = super(Semaphore, self)._get_locker()
+        # The first waiter gets in as soon as any key before its own goes.
+        self._takeover = self._position == self.limit
+        return locker, nearest
+
+    def _acquired(self, blocking=True, timeout=0):
+        acquired = super(Semaphore, self)._acquired(blocking=blocking, timeout=timeout)
+        if acquired:
+            # Our successor may have listed the dir while we were the first
+            # waiter, and be watching our key: wake it up.
+            self.client.write(self.lock_key, self.uuid, ttl=self._ttl, prevExist=True)
+        return acquired
+
+    def _wait(self, nearest, timeout):
+        if not self._takeover:
+            # Any change of our predecessor's key, even an update, can
+            # make us the first waiter.
+            index = nearest.modifiedIndex + 1
+            while True:
+                try:
+                    self.client.watch(nearest.key, timeout=timeout, index=index)
+                    return
+                except etcd.EtcdKeyNotFound:
+                    return
+                except etcd.EtcdEventIndexCleared:
+                    _log.debug("Lost track of the events of %s, reading it again", nearest.key)
+                    try:
+                        read = self.client.read(nearest.key)
+                    except etcd.EtcdKeyNotFound:
+                        return
+                    if read.modifiedIndex != nearest.modifiedIndex:
+                        return
+                    index = read.etcd_index + 1
+        _log.debug("First waiter, now watching %s", self.path)
+        index = self._index + 1
+        while True:
+            try:
+                r = self.client.watch(self.path, timeout=timeout, index=index, recursive=True)
+            except etcd.EtcdEventIndexCleared:
+                # A key before ours may have gone in the events we lost:
+                # list the dir again to find out.
+                _log.debug("Lost track of the events of %s, listing it again", self.path)
+                self._get_locker()
+                if not self._takeover:
+                    return
+                index = self._index + 1
+                continue
+            if r.action in self._release_actions and r.key < self.lock_key:
+                _log.debug("%s went away, our turn", r.key)
+                return
+            index = r.modifiedIndex + 1
+
+
+class _LocalQueue(object):
+    """
+    The state shared by the etcd.SharedLock objects of a process for the
+    same lock: a single etcd.Lock, and the threads waiting for it.
+    """
+
+    def __init__(self, client, lock_name):
+        self.lock = Lock(client, lock_name)
+        self.cond = threading.Condition()
+        # Thread holding the lock, and how many times it took it
+        self.owner = None
+        self.depth = 0
+        # Whether a thread is talking to etcd for the others
+        self.busy = False
+        # Threads waiting, in order, and the one whose turn it is to get
+        # the lock from etcd
+        self.waiters = collections.deque()
+        self.turn = None
+        # Local hand-overs since the etcd lock was taken
+        self.handoffs = 0
+
+    def next_turn(self):
+        """Lets the first waiter get the lock from etcd, if any."""
+        if self.waiters:
+            self.turn = self.waiters.popleft()
+            self.busy = True
+            self.cond.notify_all()
+
+
+class SharedLock(object):
+    """
+    etcd.Lock front queueing the threads of a process in memory.
+
+    All the SharedLock objects of a process for the same client and lock
+    name share a single etcd lock key. When the holder releases the lock
+    while other local threads wait for it, the lock is handed over to the
+    first of them without going through etcd, up to max_handoffs times in
+    a row so that other hosts get their turn. The etcd traffic of a busy
+    lock then depends on the number of hosts, not of threads.
+
+    >>> lock = etcd.SharedLock(client, 'customer1')
+    >>> with lock:
+    ...     do_stuff()
+    """
+
+    _queues = weakref.WeakValueDictionary()
+    _queues_lock = threading.Lock()
+
+    def __init__(self, client, lock_name, reentrant=False, max_handoffs=10):
+        """
+        Args:
+            client (etcd.Client): The client to use.
+
+            lock_name (str): Name of the lock, shared by all the contenders.
+
+            reentrant (bool): If true, the thread holding the lock can take
+                              it again, and has to release it as many times.
+
+            max_handoffs (int): How many times in a row the lock is handed
+                                over to a local thread before being given
+                                back to etcd. None for no limit.
+        """
+        self.name = lock_name
+        self.reentrant = reentrant
+        self.max_handoffs = max_handoffs
+        key = (id(client), lock_name)
+        with self._queues_lock:
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = _LocalQueue(client, lock_name)
+        self._queue = queue
+
+    @property
+    def is_taken(self):
+        """True if the current thread holds the lock."""
+        return self._queue.owner == threading.get_ident()
+
+    def acquire(self, blocking=True, timeout=0, **kwargs):
+        """
+        Acquire the lock.
+
+        :param blocking Block until the lock is obtained, or timeout is reached
+        :param timeout The time to wait before giving up on getting a lock
+        Other parameters (lock_ttl, keepalive) are passed to etcd.Lock.acquire
+        when the lock has to be taken from etcd. keepalive defaults to True
+        when there is a lock_ttl, as the local hand-overs don't refresh the
+        key: without it, they could outlive its TTL.
+
+        Raises:
+            etcd.EtcdLockExpired: If lock expired when try to acquire.
+
+            etcd.EtcdWatchTimedOut: If timeout is reached.
+
+            RuntimeError: If the lock is not reentrant and already held by
+                          the current thread.
+        """
+        q = self._queue
+        me = threading.get_ident()
+        deadline = time.monotonic() + timeout if timeout else None
+        with q.cond:
+            if q.owner == me:
+                if not self.reentrant:
+                    raise RuntimeError("Lock %s already held by this thread" % self.name)
+                q.depth += 1
+                return True
+            if q.owner is None and not q.busy and not q.waiters:
+                # Nobody here holds or waits for the lock, get it from etcd.
+                q.busy = True
+            elif not blocking:
+                return False
             else:
-                _log.debug("Locker: %s, key to watch: %s", l[0], l[i - 1])
-                return (l[0], next(x for x in results if x.key == l[i - 1]))
-        except ValueError:
-            # Something very wrong is going on, most probably
-            # our lock has expired
-            raise etcd.EtcdLockExpired("Lock not found")
+                q.waiters.append(me)
+                while q.owner != me and q.turn != me:
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            q.waiters.remove(me)
+                            raise etcd.EtcdWatchTimedOut(
+                                "Timed out waiting for lock %s" % self.name
+                            )
+                    q.cond.wait(remaining)
+                if q.owner == me:
+                    _log.debug("Lock %s handed over locally", self.name)
+                    return True
+                q.turn = None
+
+        acquired = False
+        kwargs.setdefault("keepalive", bool(kwargs.get("lock_ttl", 3600)))
+        try:
+            if deadline is not None:
+                kwargs["timeout"] = max(deadline - time.monotonic(), 0.001)
+            acquired = q.lock.acquire(blocking=blocking, **kwargs)
+            if not acquired:
+                # Don't stay in the etcd queue.
+                q.lock.release()
+        except etcd.EtcdWatchTimedOut:
+            try:
+                q.lock.release()
+            except etcd.EtcdException as e:
+                _log.warning("Could not leave the queue of lock %s: %r", self.name, e)
+            raise
+        finally:
+            with q.cond:
+                q.busy = False
+                if acquired:
+                    q.owner = me
+                    q.depth = 1
+                    q.handoffs = 0
+                else:
+                    q.next_turn()
+        return acquired
+
+    def release(self):
+        """
+        Release the lock
+
+        Raises:
+            RuntimeError: If the current thread does not hold the lock.
+        """
+        q = self._queue
+        with q.cond:
+            if q.owner != threading.get_ident():
+                raise RuntimeError("Lock %s is not held by this thread" % self.name)
+            q.depth -= 1
+            if q.depth:
+                return
+            q.owner = None
+            if q.waiters and (self.max_handoffs is None or q.handoffs < self.max_handoffs):
+                q.owner = q.waiters.popleft()
+                q.depth = 1
+                q.handoffs += 1
+                q.cond.notify_all()
+                return
+            q.busy = True
+        try:
+            q.lock.release()
+        finally:
+            with q.cond:
+                q.busy = False
+                q.next_turn()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+        return False
+
+
+class LeaseKeeper(object):
+    """
+    Keeps a key with a TTL alive from a background thread.
+
+    The key is refreshed, without notifying its watchers, every interval
+    seconds. If the key is gone, or could not be refreshed before its TTL
+    ran out, the lease is lost: lost becomes True, on_lost is called and
+    the keeper stops.
+    """
+
+    def __init__(self, client, key, ttl, interval=None, on_lost=None):
+        """
+        Args:
+            client (etcd.Client): The client to refresh the key with.
+
+            key (str): The key to keep alive.
+
+            ttl (int): The TTL the key is refreshed with.
+
+            interval (float): Seconds between two refreshes, a third of
+                              the TTL by default.
+
+            on_lost (callable): Called without arguments when the lease is
+                                lost.
+        """
+        self.client = client
+        self.key = key
+        self.ttl = ttl
+        self.interval = interval if interval is not None else ttl / 3.0
+        self.on_lost = on_lost
+        self._lost = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def lost(self):
+        return self._lost.is_set()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="etcd-keepalive %s" % self.key)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops refreshing the key, without waiting for the thread."""
+        self._stopped.set()
+
+    def _run(self):
+        expires = time.monotonic() + self.ttl
+        while not self._stopped.wait(self.interval):
+            try:
+                with self.client.deadline(max(0, expires - time.monotonic())):
+                    self.client.refresh(self.key, self.ttl)
+                expires = time.monotonic() + self.ttl
+                _log.debug("Refreshed %s for %d seconds", self.key, self.ttl)
+                continue
+            except etcd.EtcdKeyNotFound:
+                _log.error("Key %s is gone, lease lost", self.key)
+            except etcd.EtcdException as e:
+                if time.monotonic() < expires and not isinstance(e, etcd.EtcdDeadlineExceeded):
+                    _log.warning("Could not refresh %s, will retry: %r", self.key, e)
+                    continue
+                _log.error("Could not refresh %s before it expired: %r", self.key, e)
+            if self._stopped.is_set():
+                # Released in the meantime, nothing was lost.
+                return
+            self._lost.set()
+            self._stopped.set()
+            if self.on_lost is not None:
+                self.on_lost()
+
+
+def _bisect_key(nodes, key, hi):
+    """Position of key in the first hi nodes, sorted by key."""
+    lo = 0
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if nodes[mid]["key"] < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
@@ -0,0 +1,136 @@
+"""
+Distributed queue recipe, on in-order keys.
+"""
+
+import logging
+
+import etcd
+
+_log = logging.getLogger(__name__)
+
+
+class Queue(object):
+    """
+    FIFO queue in an etcd directory.
+
+    Producers append in-order keys to the directory. Consumers list the
+    lowest keys and claim them with a compare-and-delete on their index,
+    so each item goes to a single consumer; a batch of n items costs one
+    listing and n deletes. An empty queue is waited on with a watch.
+
+    >>> q = etcd.Queue(client, '/jobs')
+    >>> q.put('job1')
+    >>> q.put_many(['job2', 'job3'])
+    >>> [item.value for item in q.get_batch(10)]
+    ['job1', 'job2', 'job3']
+    """
+
+    # Watch events telling that something may have been queued
+    _put_actions = frozenset(("create", "set", "update", "compareAndSwap"))
+
+    def __init__(self, client, path):
+        """
+        Args:
+            client (etcd.Client): The client to use.
+
+            path (str): The directory holding the items.
+        """
+        self.client = client
+        self.path = path.rstrip("/")
+
+    def put(self, value, ttl=None):
+        """
+        Appends an item to the queue.
+
+        Returns:
+            client.EtcdResult of the new key.
+        """
+        return self.client.write(self.path, value, ttl=ttl, append=True)
+
+    def put_many(self, values, ttl=None):
+        """
+        Appends items to the queue, in order: one request after the other,
+        as etcd orders the keys by their arrival.
+
+        Returns:
+            list of client.EtcdResult of the new keys.
+        """
+        return [self.put(value, ttl=ttl) for value in values]
+
+    def qsize(self):
+        """The number of items in the queue."""
+        return len(self._head()[0])
+
+    def get(self, block=True, timeout=0):
+        """
+        Takes the first item of the queue.
+
+        Returns:
+            client.EtcdResult of the item, or None if the queue is empty
+            and block is false.
+
+        Raises:
+            etcd.EtcdWatchTimedOut: If block is true and timeout is reached.
+        """
+        items = self.get_batch(1, block=block, timeout=timeout)
+        return items[0] if items else None
+
+    def get_batch(self, max_items=100, block=True, timeout=0):
+        """
+        Takes up to max_items items from the head of the queue.
+
+        Args:
+            max_items (int): Maximum number of items to take.
+
+            block (bool): Wait for an item if the queue is empty.
+
+            timeout (int): Seconds to wait for an item, 0 to wait forever.
+
+        Returns:
+            list of client.EtcdResult, in queue order. It is only empty if
+            the queue was and block is false.
+
+        Raises:
+            etcd.EtcdWatchTimedOut: If block is true and timeout is reached.
+        """
+        while True:
+            nodes, index = self._head()
+            claimed = []
+            for node in nodes:
+                if len(claimed) == max_items:
+                    break
+                if self._claim(node):
+                    claimed.append(etcd.EtcdResult(None, node))
+            if claimed:
+                return claimed
+            if nodes:
+                # Other consumers took them all, look again.
+                continue
+            if not block:
+                return []
+            self._wait(index, timeout)
+
+    def _head(self):
+        """The items of the queue in order, and the index to watch from."""
+        try:
+            res = self.client.read(self.path, sorted=True, recursive=True)
+        except etcd.EtcdKeyNotFound as e:
+            index = (e.payload or {}).get("index")
+            return [], index + 1 if index is not None else None
+        return [node for node in res._children if not node.get("dir")], res.etcd_index + 1
+
+    def _claim(self, node):
+        try:
+            self.client.delete(node["key"], prevIndex=node["modifiedIndex"])
+            return True
+        except (etcd.EtcdKeyNotFound, etcd.EtcdCompareFailed):
+            _log.debug("Item %s was taken by someone else", node["key"])
+            return False
+
+    def _wait(self, index, timeout):
+        _log.debug("Queue %s is empty, waiting", self.path)
+        while True:
+            r = self.client.watch(self.path, index=index, timeout=timeout, recursive=True)
+            if r.action in self._put_actions and not r.dir:
+                return
+            index = r.modifiedIndex + 1
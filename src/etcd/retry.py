@@ -0,0 +1,159 @@
+"""
+Retry policies for requests that failed at the connection level.
+"""
+
+import logging
+import random
+import threading
+import time
+
+from etcd.transport import ConnectError, urllib3_error
+
+_log = logging.getLogger(__name__)
+
+
+class RetryBudget(object):
+    """
+    Token bucket limiting how many retries a client may do.
+
+    Every retry takes a token; tokens come back at a fixed rate, up to the
+    capacity of the bucket. When a part of the cluster is down, this stops
+    a client from multiplying the load on the surviving members.
+    """
+
+    def __init__(self, capacity=100, refill_rate=10.0):
+        """
+        Args:
+            capacity (int): Maximum number of tokens, i.e. of retries in a burst.
+
+            refill_rate (float): Tokens given back per second.
+        """
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self):
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.refill_rate)
+        self._last = now
+
+    def acquire(self):
+        """Takes a token if there is one left, returns True if so."""
+        with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class RetryPolicy(object):
+    """
+    Decides if, and when, a failed request is tried again on the next
+    member of the cluster.
+
+    Retries are delayed by an exponential backoff with full jitter, and
+    limited by a maximum number of attempts and by a retry budget.
+
+    Requests that are not idempotent (appends, and writes or deletes
+    with a prevValue, prevIndex or prevExist=false condition) are only
+    retried if they could not have reached the server.
+    """
+
+    idempotent_methods = frozenset(("GET", "HEAD", "PUT", "DELETE"))
+
+    def __init__(
+        self,
+        max_attempts=None,
+        backoff_base=0.05,
+        backoff_max=2.0,
+        jitter=True,
+        budget=None,
+        retry_non_idempotent=False,
+        rng=None,
+    ):
+        """
+        Args:
+            max_attempts (int): Maximum number of attempts of a request,
+                                including the first one. By default, a
+                                request is tried until there are no more
+                                machines to fail over to.
+
+            backoff_base (float): Delay, in seconds, before the first retry.
+                                  It doubles at every following retry.
+
+            backoff_max (float): Maximum delay between two attempts.
+
+            jitter (bool): If true, the delay is drawn at random between 0
+                           and the exponential backoff.
+
+            budget (etcd.RetryBudget): Budget the retries are taken from.
+                                       Each policy gets its own by default,
+                                       so a policy shared by several clients
+                                       shares its budget too.
+
+            retry_non_idempotent (bool): Retry non-idempotent requests even
+                                         if they could have been applied.
+
+            rng (random.Random): Source of randomness for the jitter.
+        """
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.budget = budget if budget is not None else RetryBudget()
+        self.retry_non_idempotent = retry_non_idempotent
+        self._random = rng or random.Random()
+
+    def is_idempotent(self, method, params=None):
+        """True if sending the request twice has the same effect as once."""
+        if method not in self.idempotent_methods:
+            return False
+        if not isinstance(params, dict):
+            return True
+        if "prevValue" in params or "prevIndex" in params:
+            return False
+        return params.get("prevExist") not in (False, "false")
+
+    def backoff(self, attempt):
+        """Delay in seconds before the given retry (starting from 1)."""
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+        if self.jitter:
+            delay = self._random.uniform(0, delay)
+        return delay
+
+    def should_retry(self, attempt, method, params, error):
+        """
+        Tells if a request that failed with error after the given number of
+        attempts should be tried again. A True answer takes a token from
+        the retry budget.
+        """
+        if self.max_attempts is not None and attempt >= self.max_attempts:
+            _log.debug("Giving up after %d attempts", attempt)
+            return False
+        if (
+            not self.retry_non_idempotent
+            and not self.is_idempotent(method, params)
+            and not request_not_sent(error)
+        ):
+            _log.debug(
+                "Not retrying a non-idempotent %s request that may have been applied", method
+            )
+            return False
+        if not self.budget.acquire():
+            _log.warning("Retry budget exhausted, not retrying")
+            return False
+        return True
+
+
+def request_not_sent(error):
+    """True if error means the request could not have reached the server."""
+    return isinstance(urllib3_error(error), ConnectError)
@@ -8,6 +8,8 @@ try:
 except ImportError:
     from unittest import mock
 
+from etcd.tests.unit.fake_server import fake_cluster
+
 
 class TestClientApiBase(unittest.TestCase):
     def setUp(self):
@@ -31,3 +33,30 @@ class TestClientApiBase(unittest.TestCase):
 
     def _mock_exception(self, exc, msg):
         self.client.api_execute = mock.Mock(side_effect=exc(msg))
+
+
+class FakeClusterTestBase(unittest.TestCase):
+    """
+    Runs each test against a fresh fake etcd cluster, in self.etcd and
+    self.servers, with a client of it in self.client.
+    """
+
+    cluster_size = 1
+    client_options = {}
+
+    def setUp(self):
+        self.etcd, self.servers = self.start_cluster()
+        self.client = self.make_client(**self.client_options)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def start_cluster(self):
+        return fake_cluster(self.cluster_size)
+
+    def make_client(self, **kwargs):
+        if len(self.servers) == 1:
+            return etcd.Client(port=self.servers[0].port, **kwargs)
+        kwargs.setdefault("allow_reconnect", True)
+        return etcd.Client(host=tuple(("127.0.0.1", s.port) for s in self.servers), **kwargs)
@@ -0,0 +1,441 @@
+"""
+A minimal etcd v2 server, running in a thread, for tests that need real
+HTTP connections; and a transport answering from it in memory, for those
+that don't.
+"""
+
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+from etcd.transport import ReadTimeout, Response, Transport
+
+
+class FakeEtcdHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._handle()
+
+    def do_PUT(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def do_DELETE(self):
+        self._handle()
+
+    def _handle(self):
+        server = self.server
+        if server.down:
+            # Drop the connection without answering.
+            self.close_connection = True
+            return
+        url = urlparse(self.path)
+        path = unquote(url.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode("utf-8")
+        params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        if self.headers.get("Content-Type") == "application/json":
+            params.update(json.loads(body))
+        else:
+            params.update((k, v[0]) for k, v in parse_qs(body).items())
+        with server.lock:
+            server.requests += 1
+            server.log.append((self.command, path, params))
+        status, data = server.etcd.handle(self.command, path, params)
+        if not isinstance(data, str):
+            data = json.dumps(data)
+        data = data.encode("utf-8")
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("X-Etcd-Cluster-Id", server.etcd.cluster_id)
+            self.send_header("X-Etcd-Index", str(server.etcd.index))
+            self.end_headers()
+            self.wfile.write(data)
+        except (OSError, ValueError):
+            # The client went away, e.g. a watch that timed out.
+            self.close_connection = True
+
+
+class FakeEtcdError(Exception):
+    statuses = {100: 404, 101: 412, 102: 403, 104: 403, 105: 412, 108: 403, 401: 400}
+
+    def __init__(self, code, message, cause, index):
+        self.status = self.statuses.get(code, 400)
+        self.payload = {"errorCode": code, "message": message, "cause": cause, "index": index}
+
+
+class FakeEtcd(object):
+    """
+    The keyspace, shared by all the members of a fake cluster.
+
+    It implements the parts of the v2 keys API used by the client and the
+    recipes: directories, in-order keys, TTLs, conditions, and watches; and
+    the users and roles of the etcd 2.3 auth API.
+    """
+
+    def __init__(self, cluster_id="abcdef1234"):
+        self.cluster_id = cluster_id
+        self.index = 1
+        self.nodes = {"/": {"key": "/", "dir": True, "modifiedIndex": 1, "createdIndex": 1}}
+        self.history = []
+        # Like etcd, only the last events can be watched
+        self.history_size = 1000
+        self.members = []
+        self.version = {"etcdserver": "2.3.7", "etcdcluster": "2.3.0"}
+        # etcd >= 3.4 doesn't serve the v2 API by default
+        self.v2 = True
+        self.users = {}
+        self.roles = {"root": {"read": set(["/*"]), "write": set(["/*"])}}
+        self.stopped = False
+        self.cond = threading.Condition()
+
+    def handle(self, method, path, params, timeout=None):
+        if path == "/version":
+            return 200, self.version
+        if path == "/v2/machines":
+            return 200, ", ".join(m.base_uri for m in self.members)
+        if path.startswith("/v2/auth/"):
+            with self.cond:
+                return self.auth(method, path[len("/v2/auth/") :].split("/", 1), params)
+        if not path.startswith("/v2/keys") or not self.v2:
+            return 404, "404 page not found\n"
+        key = "/" + path[len("/v2/keys") :].strip("/")
+        try:
+            if method == "GET" and params.get("wait") == "true":
+                return 200, self.wait(key, params, timeout)
+            with self.cond:
+                self._expire()
+                if method == "GET":
+                    return 200, self.get(key, params)
+                if method == "DELETE":
+                    return 200, self.delete(key, params)
+                if method == "POST":
+                    self.index += 1
+                    key = "%s/%020d" % (key.rstrip("/"), self.index)
+                    return 201, self.set(key, params, create=True)
+                return 200, self.set(key, params)
+        except FakeEtcdError as e:
+            return e.status, e.payload
+
+    def _error(self, code, message, cause):
+        raise FakeEtcdError(code, message, cause, self.index)
+
+    def _parent(self, key):
+        return key.rsplit("/", 1)[0] or "/"
+
+    def _children(self, key):
+        prefix = key.rstrip("/") + "/"
+        return [
+            k
+            for k in self.nodes
+            if k.startswith(prefix) and "/" not in k[len(prefix) :] and k != "/"
+        ]
+
+    def _render(self, key, recursive=False, sorted_keys=False, depth=0):
+        node = dict(self.nodes[key])
+        expires = node.pop("_expires", None)
+        if expires is not None:
+            node["ttl"] = max(1, int(round(expires - time.monotonic())))
+        if node.get("dir") and (depth == 0 or recursive):
+            children = self._children(key)
+            if sorted_keys:
+                children.sort()
+            node["nodes"] = [self._render(k, recursive, sorted_keys, depth + 1) for k in children]
+        return node
+
+    def _event(self, action, key, node, prev=None):
+        event = {"action": action, "node": node}
+        if prev is not None:
+            event["prevNode"] = prev
+        self.history.append((self.index, key, event))
+        self.cond.notify_all()
+        return event
+
+    def _expire(self):
+        now = time.monotonic()
+        for key in sorted(self.nodes):
+            expires = self.nodes.get(key, {}).get("_expires")
+            if expires is not None and expires <= now:
+                self.index += 1
+                prev = self._render(key)
+                self._remove(key)
+                node = {
+                    "key": key,
+                    "modifiedIndex": self.index,
+                    "createdIndex": prev["createdIndex"],
+                }
+                self._event("expire", key, node, prev)
+
+    def _remove(self, key):
+        for k in list(self.nodes):
+            if k == key or k.startswith(key + "/"):
+                del self.nodes[k]
+
+    def _check(self, key, params):
+        node = self.nodes.get(key)
+        prev_exist = params.get("prevExist")
+        if prev_exist == "false" and node is not None:
+            self._error(105, "Key already exists", key)
+        if node is None and (
+            prev_exist == "true" or "prevIndex" in params or "prevValue" in params
+        ):
+            self._error(100, "Key not found", key)
+        cause = []
+        if "prevValue" in params and node.get("value") != params["prevValue"]:
+            cause.append("[%s != %s]" % (params["prevValue"], node.get("value")))
+        if "prevIndex" in params and str(node["modifiedIndex"]) != params["prevIndex"]:
+            cause.append("[%s != %s]" % (params["prevIndex"], node["modifiedIndex"]))
+        if cause:
+            self._error(101, "Compare failed", " ".join(cause))
+        return node
+
+    def get(self, key, params):
+        if key not in self.nodes:
+            self._error(100, "Key not found", key)
+        return {
+            "action": "get",
+            "node": self._render(
+                key, params.get("recursive") == "true", params.get("sorted") == "true"
+            ),
+        }
+
+    def set(self, key, params, create=False):
+        prev = self._check(key, params)
+        if prev is not None and prev.get("dir") and params.get("dir") != "true":
+            self._error(102, "Not a file", key)
+        parent = self._parent(key)
+        while parent not in self.nodes:
+            self.nodes[parent] = {
+                "key": parent,
+                "dir": True,
+                "modifiedIndex": self.index,
+                "createdIndex": self.index,
+            }
+            parent = self._parent(parent)
+        if not create:
+            self.index += 1
+        rendered_prev = self._render(key) if prev is not None else None
+        node = {"key": key, "modifiedIndex": self.index}
+        node["createdIndex"] = prev["createdIndex"] if prev is not None else self.index
+        if params.get("dir") == "true":
+            node["dir"] = True
+        elif params.get("refresh") == "true":
+            node["value"] = prev.get("value")
+        else:
+            node["value"] = params.get("value", "")
+        if params.get("ttl"):
+            node["_expires"] = time.monotonic() + int(params["ttl"])
+        self.nodes[key] = node
+        if create or params.get("prevExist") == "false":
+            action = "create"
+        elif "prevIndex" in params or "prevValue" in params:
+            action = "compareAndSwap"
+        elif params.get("prevExist") == "true":
+            action = "update"
+        else:
+            action = "set"
+        event = {"action": action, "node": self._render(key)}
+        if rendered_prev is not None:
+            event["prevNode"] = rendered_prev
+        if params.get("refresh") != "true":
+            # Refreshing a TTL does not notify the watchers.
+            self._event(action, key, event["node"], rendered_prev)
+        return event
+
+    def delete(self, key, params):
+        prev = self._check(key, dict(params, prevExist="true"))
+        if prev.get("dir"):
+            if params.get("dir") != "true" and params.get("recursive") != "true":
+                self._error(102, "Not a file", key)
+            if self._children(key) and params.get("recursive") != "true":
+                self._error(108, "Directory not empty", key)
+        self.index += 1
+        rendered_prev = self._render(key)
+        self._remove(key)
+        node = {"key": key, "modifiedIndex": self.index, "createdIndex": prev["createdIndex"]}
+        if prev.get("dir"):
+            node["dir"] = True
+        action = (
+            "compareAndDelete" if ("prevIndex" in params or "prevValue" in params) else "delete"
+        )
+        return self._event(action, key, node, rendered_prev)
+
+    def _role(self, name):
+        perms = self.roles[name]
+        kv = {"read": sorted(perms["read"]), "write": sorted(perms["write"])}
+        return {"role": name, "permissions": {"kv": kv}}
+
+    def _user(self, name):
+        roles = [self._role(r) for r in sorted(self.users[name]["roles"]) if r in self.roles]
+        return {"user": name, "roles": roles}
+
+    def auth(self, method, path, params):
+        entity = path[0]
+        if entity not in ("users", "roles"):
+            return 404, "404 page not found\n"
+        objects = self.users if entity == "users" else self.roles
+        render = self._user if entity == "users" else self._role
+        if len(path) == 1:
+            return 200, {entity: [render(name) for name in sorted(objects)]}
+        name = path[1]
+        missing = 404, {"message": "auth: %s %s does not exist." % (entity[:-1], name)}
+        if method == "GET":
+            return (200, render(name)) if name in objects else missing
+        if method == "DELETE":
+            if name not in objects:
+                return missing
+            del objects[name]
+            return 200, ""
+        status = 200
+        if name not in objects:
+            status = 201
+            if entity == "users":
+                if not params.get("password"):
+                    message = "auth: Cannot create user %s with an empty password" % name
+                    return 400, {"message": message}
+                objects[name] = {"password": params.get("password"), "roles": set()}
+            else:
+                objects[name] = {"read": set(), "write": set()}
+        obj = objects[name]
+        if entity == "users":
+            if params.get("password"):
+                obj["password"] = params["password"]
+            obj["roles"] |= set(params.get("roles") or []) | set(params.get("grant") or [])
+            obj["roles"] -= set(params.get("revoke") or [])
+            return status, {"user": name, "roles": sorted(obj["roles"])}
+        for kv, change in (
+            (params.get("permissions"), set.update),
+            (params.get("grant"), set.update),
+            (params.get("revoke"), set.difference_update),
+        ):
+            for perm in ("read", "write"):
+                change(obj[perm], ((kv or {}).get("kv") or {}).get(perm) or [])
+        return status, self._role(name)
+
+    def _matches(self, watched, key, recursive):
+        return key == watched or (recursive and key.startswith(watched.rstrip("/") + "/"))
+
+    def wait(self, key, params, timeout=None):
+        """The next event on key, or None once timeout is reached."""
+        recursive = params.get("recursive") == "true"
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self.cond:
+            self._expire()
+            since = int(params.get("waitIndex") or self.index + 1)
+            if len(self.history) > self.history_size:
+                oldest = self.history[-self.history_size][0]
+                if since < oldest:
+                    self._error(
+                        401,
+                        "The event in requested index is outdated and cleared",
+                        "the requested history has been cleared [%d/%d]" % (oldest, since),
+                    )
+            while not self.stopped:
+                for index, k, event in self.history:
+                    if index >= since and self._matches(key, k, recursive):
+                        return event
+                since = max(since, self.index + 1)
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+                # Wake up regularly, to expire the keys with a TTL.
+                self.cond.wait(0.1)
+                self._expire()
+        return {}
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+
+class FakeEtcdServer(object):
+    """
+    A member of a fake etcd cluster, listening on a random local port, with
+    TLS if given a server ssl_context.
+    """
+
+    def __init__(self, etcd, ssl_context=None):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), FakeEtcdHandler)
+        if ssl_context is not None:
+            self.httpd.socket = ssl_context.wrap_socket(self.httpd.socket, server_side=True)
+        self.httpd.daemon_threads = True
+        self.httpd.etcd = etcd
+        self.httpd.lock = threading.Lock()
+        self.httpd.down = False
+        self.httpd.requests = 0
+        self.httpd.log = []
+        self.port = self.httpd.server_address[1]
+        self.base_uri = "%s://127.0.0.1:%d" % ("https" if ssl_context else "http", self.port)
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+        etcd.members.append(self)
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    @property
+    def log(self):
+        """The (method, path, params) of all the requests received."""
+        return self.httpd.log
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def go_down(self):
+        """The member keeps accepting connections, but drops them."""
+        self.httpd.down = True
+
+    def stop(self):
+        self.httpd.etcd.stop()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeTransport(Transport):
+    """
+    Transport answering from a FakeEtcd in memory, without sockets nor
+    threads, to test or benchmark the client side alone.
+    """
+
+    def __init__(self, etcd):
+        self.etcd = etcd
+        self.log = []
+
+    def request(self, method, url, fields=None, body=None, headers=None, timeout=None):
+        path = urlparse(url).path
+        # What the form encoding would send
+        params = dict((k, str(v)) for k, v in (fields or {}).items())
+        if body is not None:
+            params.update(json.loads(body))
+        self.log.append((method, path, params))
+        status, data = self.etcd.handle(method, path, params, timeout=timeout)
+        if data is None:
+            raise ReadTimeout("Fake watch timed out")
+        if not isinstance(data, str):
+            data = json.dumps(data)
+        data = data.encode("utf-8")
+        headers = {
+            "content-type": "application/json",
+            "x-etcd-cluster-id": self.etcd.cluster_id,
+            "x-etcd-index": str(self.etcd.index),
+        }
+        return Response(status, headers, lambda: data)
+
+
+def fake_cluster(size=3, ssl_context=None, **kwargs):
+    etcd = FakeEtcd(**kwargs)
+    return etcd, [FakeEtcdServer(etcd, ssl_context).start() for _ in range(size)]
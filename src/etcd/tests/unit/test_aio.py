@@ -0,0 +1,384 @@
+import asyncio
+import gc
+import threading
+import unittest
+import warnings
+
+import etcd
+from etcd import aio
+from etcd.aio import AsyncClient, AsyncLock
+from etcd.tests.unit import FakeClusterTestBase
+from etcd.tests.unit.fake_server import FakeEtcd, FakeTransport, fake_cluster
+from etcd.transport import Response
+
+try:
+    import httpx
+    import h2
+except ImportError:
+    httpx = h2 = None
+
+
+def client_threads():
+    """The threads running, but those of the fake server"""
+    return [t for t in threading.enumerate() if "process_request" not in t.name]
+
+
+class TestAsyncLock(FakeClusterTestBase):
+    def run_async(self, coro):
+        return asyncio.run(asyncio.wait_for(coro, 10))
+
+    def test_acquire_release(self):
+        async def go():
+            aclient = AsyncClient(self.client)
+            lock = AsyncLock(aclient, "test_lock")
+            self.assertTrue(await lock.acquire(lock_ttl=60))
+            self.assertTrue(await lock.is_acquired())
+            self.assertEqual(self.client.read(lock.lock_key).value, lock.uuid)
+            other = AsyncLock(aclient, "test_lock")
+            self.assertFalse(await other.acquire(blocking=False))
+            await lock.release()
+            self.assertFalse(await lock.is_acquired())
+            self.assertTrue(await other._acquired(blocking=False))
+            await other.release()
+            await aclient.close()
+
+        self.run_async(go())
+
+    def test_quoted_names(self):
+        """Lock names with spaces or non-ASCII characters are quoted"""
+
+        async def go():
+            aclient = AsyncClient(self.client)
+            for name in ("锁", "my lock"):
+                lock = AsyncLock(aclient, name)
+                self.assertTrue(await lock.acquire(lock_ttl=60))
+                self.assertEqual(self.client.read(lock.lock_key).value, lock.uuid)
+                self.assertFalse(etcd.Lock(self.client, name).acquire(blocking=False))
+                await lock.release()
+            await aclient.close()
+
+        self.run_async(go())
+
+    def test_contention(self):
+        """Many coroutines wait for the lock without a thread each"""
+        holders = []
+        order = []
+        threads = client_threads()
+
+        async def contend(aclient, i):
+            async with AsyncLock(aclient, "test_lock"):
+                holders.append(i)
+                self.assertEqual(len(holders), 1)
+                order.append(i)
+                await asyncio.sleep(0)
+                holders.remove(i)
+
+        async def go():
+            aclient = AsyncClient(self.client)
+            await asyncio.gather(*[contend(aclient, i) for i in range(30)])
+            self.assertEqual(client_threads(), threads)
+            await aclient.close()
+
+        self.run_async(go())
+        self.assertEqual(sorted(order), list(range(30)))
+
+    def test_sync_holder(self):
+        """Async and sync contenders share the same lock"""
+        lock = etcd.Lock(self.client, "test_lock")
+        lock.acquire(lock_ttl=None)
+
+        async def go():
+            alock = AsyncLock(self.client, "test_lock")
+            waiter = asyncio.ensure_future(alock.acquire())
+            await asyncio.sleep(0.2)
+            self.assertFalse(waiter.done())
+            await asyncio.get_event_loop().run_in_executor(None, lock.release)
+            self.assertTrue(await waiter)
+            await alock.release()
+
+        self.run_async(go())
+
+    def test_timeout(self):
+        lock = etcd.Lock(self.client, "test_lock")
+        lock.acquire(lock_ttl=None)
+
+        async def go():
+            alock = AsyncLock(self.client, "test_lock")
+            with self.assertRaises(etcd.EtcdWatchTimedOut):
+                await alock.acquire(timeout=0.2)
+
+        self.run_async(go())
+
+    def test_own_client_closed(self):
+        """The AsyncClient a lock makes for itself does not leak connections"""
+        lock = etcd.Lock(self.client, "test_lock")
+
+        async def go():
+            alock = AsyncLock(self.client, "test_lock")
+            async with alock:
+                self.assertTrue(await alock.is_acquired())
+            # And again, once closed
+            self.assertTrue(await alock.acquire(lock_ttl=None))
+            await alock.release()
+            lock.acquire(lock_ttl=None)
+            self.assertFalse(await AsyncLock(self.client, "test_lock").acquire(blocking=False))
+            with self.assertRaises(etcd.EtcdWatchTimedOut):
+                await AsyncLock(self.client, "test_lock").acquire(timeout=0.1)
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always", ResourceWarning)
+            self.run_async(go())
+            gc.collect()
+        self.assertEqual([w for w in caught if issubclass(w.category, ResourceWarning)], [])
+
+
+class TestAsyncClient(unittest.TestCase):
+    def test_failover(self):
+        """A member that drops connections is failed over"""
+        fake, servers = fake_cluster(2)
+        try:
+            client = etcd.Client(
+                host=tuple(("127.0.0.1", s.port) for s in servers), allow_reconnect=True
+            )
+            client.write("/testkey", "value")
+            self.assertEqual(client.base_uri, servers[0].base_uri)
+            servers[0].go_down()
+
+            async def go():
+                aclient = AsyncClient(client)
+                res = await aclient.read("/testkey")
+                await aclient.close()
+                return res
+
+            self.assertEqual(asyncio.run(go()).value, "value")
+            self.assertEqual(client.base_uri, servers[1].base_uri)
+        finally:
+            for server in servers:
+                server.stop()
+
+    def test_append_not_retried(self):
+        """An append that may have reached a member is not sent again"""
+        fake, servers = fake_cluster(2)
+        try:
+            client = etcd.Client(
+                host=tuple(("127.0.0.1", s.port) for s in servers), allow_reconnect=True
+            )
+            servers[0].go_down()
+
+            async def go():
+                aclient = AsyncClient(client)
+                try:
+                    with self.assertRaises(etcd.EtcdConnectionFailed):
+                        await aclient.write("/queue", "value", append=True)
+                finally:
+                    await aclient.close()
+
+            asyncio.run(go())
+            self.assertNotIn("POST", [method for (method, _, _) in servers[1].log])
+        finally:
+            for server in servers:
+                server.stop()
+
+    def test_lazy_client(self):
+        """The client is connected before the first request"""
+        fake, servers = fake_cluster(2)
+        try:
+            client = etcd.Client(
+                host=(("127.0.0.1", servers[0].port),), allow_reconnect=True, lazy=True
+            )
+
+            async def go():
+                aclient = AsyncClient(client)
+                await aclient.write("/testkey", "value")
+                await aclient.close()
+
+            asyncio.run(go())
+            self.assertTrue(client._connected)
+            self.assertIn(servers[1].base_uri, client._machines_cache)
+        finally:
+            for server in servers:
+                server.stop()
+
+    def test_credentials_reloaded(self):
+        """Rejected credentials are asked again to the provider"""
+        credentials = iter([("user", "old"), ("user", "new")])
+        client = etcd.Client(credentials_provider=lambda: next(credentials), lazy=True)
+        client._connected = True
+        aclient = AsyncClient(client)
+        sent = []
+
+        async def request(method, url, fields=None, body=None, headers=None, timeout=None):
+            sent.append(client.password)
+            if client.password == "old":
+                return Response(401, {}, lambda: b'{"message": "Insufficient credentials"}')
+            data = b'{"action": "get", "node": {"key": "/testkey", "value": "value"}}'
+            return Response(200, {}, lambda: data)
+
+        aclient._transport.request = request
+        self.assertEqual(asyncio.run(aclient.read("/testkey")).value, "value")
+        self.assertEqual(sent, ["old", "new"])
+
+    def test_deadline(self):
+        """Failover stops at the deadline of the client"""
+        fake, servers = fake_cluster(3)
+        try:
+            client = etcd.Client(
+                host=tuple(("127.0.0.1", s.port) for s in servers),
+                allow_reconnect=True,
+                retry_policy=etcd.RetryPolicy(backoff_base=1, jitter=False),
+            )
+            for server in servers:
+                server.go_down()
+
+            async def go():
+                aclient = AsyncClient(client)
+                with client.deadline(0.5):
+                    with self.assertRaises(etcd.EtcdDeadlineExceeded):
+                        await aclient.read("/testkey")
+                await aclient.close()
+
+            asyncio.run(go())
+        finally:
+            for server in servers:
+                server.stop()
+
+    def test_deadline_per_task(self):
+        """The deadline of a task does not apply to the other tasks"""
+        fake, servers = fake_cluster(1)
+        try:
+            client = etcd.Client(port=servers[0].port)
+            client.write("/testkey", "value")
+
+            async def bounded(aclient):
+                with client.deadline(0.2):
+                    with self.assertRaises(etcd.EtcdDeadlineExceeded):
+                        await aclient.watch("/testkey", timeout=2)
+
+            async def unbounded(aclient):
+                await asyncio.sleep(0.5)
+                await aclient.write("/testkey", "new")
+
+            async def watch(aclient):
+                return await aclient.watch("/testkey", timeout=2)
+
+            async def go():
+                aclient = AsyncClient(client)
+                try:
+                    tasks = (bounded(aclient), watch(aclient), unbounded(aclient))
+                    return await asyncio.gather(*tasks)
+                finally:
+                    await aclient.close()
+
+            self.assertEqual(asyncio.run(go())[1].value, "new")
+        finally:
+            for server in servers:
+                server.stop()
+
+    def test_lock_gives_up(self):
+        """Waiting for a lock stops when no member can be reached"""
+        fake, servers = fake_cluster(1)
+        try:
+            client = etcd.Client(port=servers[0].port)
+            lock = etcd.Lock(client, "test_lock")
+            lock.acquire(lock_ttl=None)
+
+            async def go():
+                alock = AsyncLock(client, "test_lock")
+                self.assertFalse(await alock.acquire(blocking=False, lock_ttl=None))
+                servers[0].go_down()
+                with self.assertRaises(etcd.EtcdConnectionFailed):
+                    await alock._acquired()
+                await alock.client.close()
+
+            asyncio.run(asyncio.wait_for(go(), 10))
+        finally:
+            servers[0].stop()
+
+
+class TestAsyncTransports(unittest.TestCase):
+    def test_executor(self):
+        """Transports without an asyncio version are run in the executor"""
+        client = etcd.Client(transport=FakeTransport(FakeEtcd()))
+
+        async def go():
+            aclient = AsyncClient(client)
+            self.assertIsInstance(aclient._transport, aio.ExecutorTransport)
+            async with AsyncLock(aclient, "test_lock") as lock:
+                self.assertTrue(await lock.is_acquired())
+            with self.assertRaises(etcd.EtcdWatchTimedOut):
+                await aclient.watch("/_locks/test_lock", timeout=0.1)
+            await aclient.close()
+
+        asyncio.run(go())
+
+    def test_settings(self):
+        """The streams have the settings of the urllib3 transport"""
+        client = etcd.Client(per_host_pool_size=3, allow_redirect=False, lazy=True)
+        transport = AsyncClient(client)._transport
+        self.assertIsInstance(transport, aio.StreamTransport)
+        self.assertEqual(transport.maxsize, 3)
+        self.assertFalse(transport.allow_redirect)
+        self.assertIsNone(transport.ssl_context)
+        client = etcd.Client(protocol="https", lazy=True)
+        self.assertIs(AsyncClient(client)._transport.ssl_context, client.ssl_context)
+
+    def test_redirect(self):
+        """Redirects are followed like urllib3 does"""
+        transport = aio.StreamTransport()
+        sent = []
+
+        async def send(method, url, body, headers, timeout):
+            sent.append((method, url, body))
+            if len(sent) == 1:
+                return Response(307, {"location": "http://other:2379/v2/keys/a"}, lambda: b"")
+            return Response(200, {}, lambda: b"{}")
+
+        transport._send = send
+        response = asyncio.run(transport.request("PUT", "http://one:2379/v2/keys/a", {"value": 1}))
+        self.assertEqual(response.status, 200)
+        self.assertEqual(
+            sent,
+            [
+                ("PUT", "http://one:2379/v2/keys/a", b"value=1"),
+                ("PUT", "http://other:2379/v2/keys/a", b"value=1"),
+            ],
+        )
+        transport.allow_redirect = False
+        del sent[:]
+        response = asyncio.run(transport.request("GET", "http://one:2379/v2/keys/a"))
+        self.assertEqual(response.status, 307)
+        self.assertEqual(len(sent), 1)
+
+    def test_too_many_redirects(self):
+        transport = aio.StreamTransport()
+
+        async def send(method, url, body, headers, timeout):
+            return Response(307, {"location": url}, lambda: b"")
+
+        transport._send = send
+        with self.assertRaises(etcd.transport.TransportError):
+            asyncio.run(transport.request("GET", "http://one:2379/v2/keys/a"))
+
+
+@unittest.skipUnless(httpx and h2, "needs httpx with its http2 extra")
+class TestHTTPXTransport(FakeClusterTestBase):
+    def make_client(self, **kwargs):
+        kwargs.setdefault("transport", etcd.transport.HTTP2Transport())
+        return super(TestHTTPXTransport, self).make_client(**kwargs)
+
+    def test_lock(self):
+        async def go():
+            aclient = AsyncClient(self.client)
+            self.assertIsInstance(aclient._transport, aio.HTTPXTransport)
+            lock = AsyncLock(aclient, "锁")
+            self.assertTrue(await lock.acquire(lock_ttl=60))
+            self.assertEqual(self.client.read(lock.lock_key).value, lock.uuid)
+            await lock.release()
+            with self.assertRaises(etcd.EtcdWatchTimedOut):
+                await aclient.watch("/_locks/锁", timeout=0.1)
+            await aclient.close()
+            # A closed client opens new connections
+            await aclient.write("/testkey", "value")
+            await aclient.close()
+
+        asyncio.run(go())
@@ -0,0 +1,211 @@
+import unittest
+
+import etcd
+from etcd import auth
+from etcd.tests.unit.fake_server import fake_cluster
+
+
+def user(client, name, roles, password=None):
+    u = auth.EtcdUser(client, name)
+    u.roles = roles
+    if password:
+        u.password = password
+    return u
+
+
+def role(client, name, acls):
+    r = auth.EtcdRole(client, name)
+    r.acls = acls
+    return r
+
+
+class TestAuthApply(unittest.TestCase):
+    def setUp(self):
+        self.etcd, self.servers = fake_cluster(1)
+        self.client = etcd.Client(port=self.servers[0].port)
+        self.auth = auth.Auth(self.client)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def writes(self):
+        return [
+            (method, path, params)
+            for (method, path, params) in self.servers[0].log
+            if method != "GET"
+        ]
+
+    def desired(self):
+        roles = [
+            role(self.client, "readers", {"/data/*": "R"}),
+            role(self.client, "writers", {"/data/*": "RW", "/tmp": "W"}),
+        ]
+        users = [
+            user(self.client, "alice", ["readers"], password="a"),
+            user(self.client, "bob", ["readers", "writers"], password="b"),
+        ]
+        return users, roles
+
+    def test_create(self):
+        progress = []
+        users, roles = self.desired()
+        stats = self.auth.apply(users, roles, progress=lambda *a: progress.append(a))
+        self.assertEqual(
+            stats, {"created": 4, "updated": 0, "deleted": 0, "unchanged": 0, "requests": 6}
+        )
+        self.assertEqual(progress, [(1, 4), (2, 4), (3, 4), (4, 4)])
+        self.assertEqual(self.etcd.users["bob"], {"password": "b", "roles": {"readers", "writers"}})
+        self.assertEqual(
+            self.etcd.roles["writers"], {"read": {"/data/*"}, "write": {"/data/*", "/tmp"}}
+        )
+        u = auth.EtcdUser(self.client, "bob")
+        u.read()
+        self.assertEqual(u.roles, {"readers", "writers"})
+
+    def test_unchanged(self):
+        """Applying the current state only lists users and roles"""
+        self.auth.apply(*self.desired())
+        del self.servers[0].log[:]
+        users, roles = self.desired()
+        for u in users:
+            u.password = None
+        stats = self.auth.apply(users, roles)
+        self.assertEqual(
+            stats, {"created": 0, "updated": 0, "deleted": 0, "unchanged": 4, "requests": 2}
+        )
+        self.assertEqual(self.writes(), [])
+
+    def test_update(self):
+        """Only the differences are written"""
+        self.auth.apply(*self.desired())
+        del self.servers[0].log[:]
+        users = [user(self.client, "alice", ["readers"]), user(self.client, "bob", ["writers"])]
+        roles = [
+            role(self.client, "readers", {"/data/*": "R"}),
+            role(self.client, "writers", {"/data/*": "RW", "/logs": "W"}),
+        ]
+        stats = self.auth.apply(users, roles)
+        self.assertEqual(
+            stats, {"created": 0, "updated": 2, "deleted": 0, "unchanged": 2, "requests": 4}
+        )
+        self.assertEqual(self.etcd.users["bob"]["roles"], {"writers"})
+        self.assertEqual(self.etcd.roles["writers"]["write"], {"/data/*", "/logs"})
+        payloads = sorted((path, sorted(params)) for (_, path, params) in self.writes())
+        self.assertEqual(
+            payloads,
+            [
+                ("/v2/auth/roles/writers", ["grant", "revoke", "role"]),
+                ("/v2/auth/users/bob", ["revoke", "user"]),
+            ],
+        )
+
+    def test_single_request(self):
+        """The password, grants and revokes of a user are written at once"""
+        self.auth.apply(*self.desired())
+        del self.servers[0].log[:]
+        stats = self.auth.apply([user(self.client, "alice", ["writers"], password="new")])
+        self.assertEqual(stats["requests"], 2)
+        self.assertEqual(
+            [(method, path, sorted(params)) for (method, path, params) in self.servers[0].log],
+            [
+                ("GET", "/v2/auth/users", []),
+                ("PUT", "/v2/auth/users/alice", ["grant", "password", "revoke", "user"]),
+            ],
+        )
+        self.assertEqual(self.etcd.users["alice"], {"password": "new", "roles": {"writers"}})
+
+    def test_prune(self):
+        self.auth.apply(*self.desired())
+        self.auth.apply(users=[user(self.client, "root", ["root"], password="r")])
+        stats = self.auth.apply(
+            [user(self.client, "alice", ["readers"])],
+            [role(self.client, "readers", {"/data/*": "R"})],
+            prune=True,
+        )
+        self.assertEqual(stats["deleted"], 2)
+        self.assertEqual(sorted(self.etcd.users), ["alice", "root"])
+        self.assertEqual(sorted(self.etcd.roles), ["readers", "root"])
+
+    def test_failure(self):
+        """A failed change is raised once the others of its step are made"""
+        users, roles = self.desired()
+        users[0].password = None
+        users.append(user(self.client, "carol", ["readers"], password="c"))
+        self.assertRaises(etcd.EtcdException, self.auth.apply, users, roles, prune=True)
+        self.assertEqual(sorted(self.etcd.users), ["bob", "carol"])
+
+
+class TestAuthBase(unittest.TestCase):
+    def test_delete_failure(self):
+        _, servers = fake_cluster(1)
+        client = etcd.Client(port=servers[0].port)
+        try:
+            servers[0].go_down()
+            u = auth.EtcdUser(client, "alice")
+            self.assertRaises(etcd.EtcdException, u.delete)
+        finally:
+            servers[0].stop()
+
+
+class TestPermissions(unittest.TestCase):
+    def test_index(self):
+        index = auth.PermissionIndex(["/data/*", "/config", "/tmp*"])
+        self.assertTrue(index.matches("/data/a/b"))
+        self.assertTrue(index.matches("/data/"))
+        self.assertFalse(index.matches("/data"))
+        self.assertTrue(index.matches("/config"))
+        self.assertFalse(index.matches("/config/a"))
+        self.assertFalse(index.matches("/conf"))
+        self.assertTrue(index.matches("/tmp"))
+        self.assertTrue(index.matches("/tmpfiles/a"))
+        self.assertFalse(index.matches("/other"))
+        # Only prefixes allow recursive operations
+        self.assertTrue(index.matches("/data/a", recursive=True))
+        self.assertFalse(index.matches("/config", recursive=True))
+        self.assertTrue(auth.PermissionIndex(["*"]).matches("/anything", recursive=True))
+        self.assertFalse(auth.PermissionIndex().matches("/"))
+
+    def test_role(self):
+        r = auth.EtcdRole(etcd.Client(lazy=True), "role")
+        r.acls = {"/data/*": "RW", "/config": "R"}
+        self.assertTrue(r.can_read("/config"))
+        self.assertFalse(r.can_write("/config"))
+        self.assertTrue(r.can_write("/data/a"))
+        r.revoke("/data/*", "W")
+        self.assertFalse(r.can_write("/data/a"))
+        self.assertTrue(r.can_read("/data/a"))
+        r.grant("/config", "W")
+        self.assertTrue(r.can_write("/config"))
+        self.assertEqual(r.acls, {"/data/*": "R", "/config": "RW"})
+
+    def test_user(self):
+        """A user can do what any of its roles allow"""
+        fake, servers = fake_cluster(1)
+        client = etcd.Client(port=servers[0].port)
+        try:
+            auth.Auth(client).apply(
+                users=[user(client, "alice", ["readers", "logs"], password="a")],
+                roles=[
+                    role(client, "readers", {"/data/*": "R"}),
+                    role(client, "logs", {"/logs/*": "RW"}),
+                ],
+            )
+            u = auth.EtcdUser(client, "alice")
+            u.read()
+            del servers[0].log[:]
+            self.assertTrue(u.can_read("/data/a"))
+            self.assertFalse(u.can_write("/data/a"))
+            self.assertTrue(u.can_write("/logs/a"))
+            self.assertFalse(u.can_read("/other"))
+            # The permissions of the roles came with the user
+            self.assertEqual(servers[0].log, [])
+
+            # Otherwise, they are read
+            u = auth.EtcdUser(client, "alice")
+            u.roles = ["readers"]
+            self.assertTrue(u.can_read("/data/a"))
+            self.assertFalse(u.can_write("/logs/a"))
+            self.assertEqual([path for (_, path, _) in servers[0].log], ["/v2/auth/roles/readers"])
+        finally:
+            servers[0].stop()
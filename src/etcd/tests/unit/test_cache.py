@@ -0,0 +1,156 @@
+import time
+import unittest
+
+import etcd
+from etcd.tests.unit import FakeClusterTestBase
+
+
+def result(key, value, index):
+    r = etcd.EtcdResult(node={"key": key, "value": value, "modifiedIndex": index})
+    r.etcd_index = index
+    return r
+
+
+class TestReadCache(unittest.TestCase):
+    def test_staleness(self):
+        cache = etcd.ReadCache(max_staleness=0.05)
+        cache.put("/a", {}, result("/a", "1", 1), 10)
+        self.assertEqual(cache.get("/a", {}).value, "1")
+        self.assertIsNone(cache.get("/a", {}, max_staleness=0))
+        self.assertIsNone(cache.get("/a", {"recursive": "true"}))
+        time.sleep(0.06)
+        self.assertIsNone(cache.get("/a", {}))
+        self.assertEqual(cache.get("/a", {}, max_staleness=10).value, "1")
+        self.assertEqual(
+            cache.stats,
+            {
+                "hits": 2,
+                "misses": 2,
+                "evictions": 0,
+                "expirations": 0,
+                "entries": 1,
+                "bytes": 10,
+            },
+        )
+
+    def test_ttl(self):
+        """Results are dropped after the TTL, whatever the staleness allowed"""
+        cache = etcd.ReadCache(ttl=0.01)
+        cache.put("/a", {}, result("/a", "1", 1), 10)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("/a", {}, max_staleness=10))
+        self.assertEqual(cache.stats["expirations"], 1)
+        self.assertEqual(cache.stats["entries"], 0)
+
+    def test_copies(self):
+        """Callers can't modify the cached results"""
+        cache = etcd.ReadCache(max_staleness=10)
+        r = result("/a", "1", 1)
+        cache.put("/a", {}, r, 10)
+        r.value = "2"
+        cached = cache.get("/a", {})
+        cached.value = "3"
+        self.assertEqual(cache.get("/a", {}).value, "1")
+        # Nor the nodes of a directory
+        d = etcd.EtcdResult(
+            node={"key": "/d", "dir": True, "nodes": [{"key": "/d/x", "value": "x"}]}
+        )
+        d.etcd_index = 1
+        cache.put("/d", {}, d, 10)
+        d._children[0]["value"] = "y"
+        cached = cache.get("/d", {})
+        cached._children.insert(0, {"key": "/d/t", "value": "tampered"})
+        cached._children[1]["value"] = "z"
+        self.assertEqual([r.value for r in cache.get("/d", {}).leaves], ["x"])
+
+    def test_bounds(self):
+        """The least recently used results are evicted"""
+        cache = etcd.ReadCache(max_entries=3, max_bytes=100, max_staleness=10)
+        for i in range(3):
+            cache.put("/%d" % i, {}, result("/%d" % i, "v", 1), 10)
+        cache.get("/0", {})
+        cache.put("/3", {}, result("/3", "v", 1), 10)
+        self.assertIsNone(cache.get("/1", {}))
+        self.assertIsNotNone(cache.get("/0", {}))
+        cache.put("/4", {}, result("/4", "v", 1), 85)
+        self.assertEqual(cache.stats["entries"], 2)
+        self.assertEqual(cache.stats["bytes"], 95)
+        self.assertEqual(cache.stats["evictions"], 3)
+        # Too big to be cached at all
+        cache.put("/5", {}, result("/5", "v", 1), 101)
+        self.assertIsNone(cache.get("/5", {}))
+
+    def test_invalidate(self):
+        """A change drops the results of its key, parents and children"""
+        cache = etcd.ReadCache(max_staleness=10)
+        for key in ("/", "/dir", "/dir/a", "/dir/a/b", "/dir/ab", "/other"):
+            cache.put(key, {}, result(key, "v", 1), 1)
+        cache.invalidate("/dir/a", 5)
+        self.assertEqual(
+            [
+                key
+                for key in ("/", "/dir", "/dir/a", "/dir/a/b", "/dir/ab", "/other")
+                if cache.get(key, {})
+            ],
+            ["/dir/ab", "/other"],
+        )
+        # Results read before the change are not cached
+        cache.put("/dir/a", {}, result("/dir/a", "v", 4), 1)
+        self.assertIsNone(cache.get("/dir/a", {}))
+        cache.put("/dir/a", {}, result("/dir/a", "v", 5), 1)
+        self.assertIsNotNone(cache.get("/dir/a", {}))
+
+
+class TestClientReadCache(FakeClusterTestBase):
+    def setUp(self):
+        self.cache = etcd.ReadCache()
+        super(TestClientReadCache, self).setUp()
+        self.client.write("/dir/key", "1")
+        del self.servers[0].log[:]
+
+    def make_client(self, **kwargs):
+        return super(TestClientReadCache, self).make_client(read_cache=self.cache, **kwargs)
+
+    def reads(self):
+        return len([entry for entry in self.servers[0].log if entry[0] == "GET"])
+
+    def test_read(self):
+        self.assertEqual(self.client.read("/dir/key").value, "1")
+        self.assertEqual(self.client.read("/dir/key", max_staleness=1).value, "1")
+        self.assertEqual(self.reads(), 1)
+        # Without max_staleness, reads are fresh
+        self.client.read("/dir/key")
+        self.assertEqual(self.reads(), 2)
+        # And so are quorum reads, whatever the staleness allowed
+        self.client.read("/dir/key", quorum=True, max_staleness=1)
+        self.assertEqual(self.reads(), 3)
+        # Their results answer the other reads
+        self.client.read("/dir/key", max_staleness=1)
+        self.assertEqual(self.reads(), 3)
+        self.assertEqual(self.cache.stats["hits"], 2)
+
+    def test_invalidation(self):
+        """Writes and deletes of the client invalidate the cache"""
+        self.client.read("/dir", recursive=True)
+        self.client.read("/dir/key")
+        self.client.write("/dir/key", "2")
+        self.assertEqual(self.client.read("/dir/key", max_staleness=1).value, "2")
+        leaves = self.client.read("/dir", recursive=True, max_staleness=1).leaves
+        self.assertEqual([r.value for r in leaves], ["2"])
+        self.client.delete("/dir/key")
+        self.assertRaises(etcd.EtcdKeyNotFound, self.client.read, "/dir/key", max_staleness=1)
+        self.assertEqual(self.reads(), 5)
+
+    def test_failed_write(self):
+        """A failed compare-and-swap invalidates the key"""
+        self.client.read("/dir/key")
+        self.etcd.handle("PUT", "/v2/keys/dir/key", {"value": "2"})
+        self.assertEqual(self.client.read("/dir/key", max_staleness=10).value, "1")
+        self.assertRaises(etcd.EtcdCompareFailed, self.client.write, "/dir/key", "3", prevValue="1")
+        self.assertEqual(self.client.read("/dir/key", max_staleness=10).value, "2")
+
+    def test_watches(self):
+        """Watches are not cached"""
+        res = self.client.read("/dir/key")
+        self.client.watch("/dir/key", index=res.modifiedIndex)
+        self.assertEqual(self.cache.stats["entries"], 1)
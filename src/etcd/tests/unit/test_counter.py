@@ -0,0 +1,79 @@
+import threading
+
+import etcd
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+from etcd.tests.unit import FakeClusterTestBase
+
+
+class TestCounter(FakeClusterTestBase):
+    client_options = {"per_host_pool_size": 8}
+
+    def test_next(self):
+        counter = etcd.Counter(self.client, "/ids", batch_size=10)
+        self.assertEqual([counter.next() for _ in range(25)], list(range(25)))
+        self.assertEqual(self.client.read("/ids").value, "30")
+        self.assertEqual(counter.stats["transactions"], 3)
+        self.assertEqual(counter.stats["issued"], 25)
+        self.assertEqual(counter.stats["conflicts"], 0)
+
+    def test_requests(self):
+        """A lease costs a single write once the key is known"""
+        counter = etcd.Counter(self.client, "/ids", batch_size=10)
+        counter.next()
+        start = len(self.servers[0].log)
+        for _ in range(29):
+            counter.next()
+        methods = [method for (method, _, _) in self.servers[0].log[start:]]
+        self.assertEqual(methods, ["PUT", "PUT"])
+
+    def test_next_range(self):
+        counter = etcd.Counter(self.client, "/ids", batch_size=10)
+        self.assertEqual(counter.next(), 0)
+        self.assertEqual(counter.next_range(100), (10, 110))
+        self.assertEqual(counter.next(), 1)
+
+    def test_invalid_batch_size(self):
+        self.assertRaises(ValueError, etcd.Counter, self.client, "/ids", batch_size=0)
+
+    def test_contention(self):
+        """Counters sharing a key never hand out the same value"""
+        policy = etcd.RetryPolicy(backoff_base=0.001)
+        counters = [
+            etcd.Counter(self.client, "/ids", batch_size=5, retry_policy=policy) for _ in range(4)
+        ]
+        values = []
+
+        def allocate(counter):
+            for _ in range(50):
+                values.append(counter.next())
+
+        threads = [
+            threading.Thread(target=allocate, args=(counter,))
+            for counter in counters
+            for _ in range(2)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(values), 400)
+        self.assertEqual(len(set(values)), 400)
+        self.assertEqual(sum(c.stats["transactions"] for c in counters), 80)
+
+    def test_max_attempts(self):
+        counter = etcd.Counter(
+            self.client, "/ids", retry_policy=etcd.RetryPolicy(max_attempts=2, backoff_base=0)
+        )
+        counter.next()
+        # Make every lease conflict
+        self.client.write("/ids", "5000")
+        self.client.write = mock.MagicMock(side_effect=etcd.EtcdCompareFailed("Compare failed"))
+        counter._next = counter._end
+        self.assertRaises(etcd.EtcdCompareFailed, counter.next)
+        # The lease based on the last known state, then two attempts
+        self.assertEqual(counter.stats["conflicts"], 3)
+        self.assertEqual(counter.stats["failures"], 1)
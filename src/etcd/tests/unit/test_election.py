@@ -0,0 +1,84 @@
+import threading
+
+import etcd
+from etcd.tests.unit import FakeClusterTestBase
+
+
+class TestElection(FakeClusterTestBase):
+    client_options = {"per_host_pool_size": 4}
+
+    def test_campaign(self):
+        first = etcd.Election(self.client, "test_election", value="first")
+        second = etcd.Election(self.client, "test_election", value="second")
+        self.assertIsNone(first.leader())
+        self.assertTrue(first.campaign())
+        self.assertTrue(first.is_leader)
+        self.assertEqual(second.leader(), "first")
+        self.assertEqual(self.client.read(first.lock_key).ttl, 10)
+
+        t = threading.Thread(target=second.campaign)
+        t.start()
+        first.resign()
+        t.join(5)
+        self.assertFalse(first.is_leader)
+        self.assertTrue(second.is_leader)
+        self.assertEqual(first.leader(), "second")
+        second.resign()
+        self.assertIsNone(first.leader())
+
+    def test_campaign_timeout(self):
+        """Campaigning gives up after the timeout, and the key is kept no more"""
+        first = etcd.Election(self.client, "test_election", value="first")
+        second = etcd.Election(self.client, "test_election", value="second")
+        first.campaign()
+        self.assertRaises(etcd.EtcdWatchTimedOut, second.campaign, timeout=0.3)
+        self.assertFalse(second.is_leader)
+        self.assertTrue(second._keeper._stopped.is_set())
+        self.assertEqual(second.leader(), "first")
+        first.resign()
+
+    def test_observe(self):
+        """Observers see every change of leader, from a single stream of watches"""
+        seen = []
+        changes = threading.Semaphore(0)
+        observer = etcd.Election(self.client, "test_election").observe()
+
+        def observe():
+            try:
+                for leader in observer:
+                    seen.append(leader)
+                    changes.release()
+            except etcd.EtcdException:
+                # The server went away at the end of the test
+                pass
+
+        t = threading.Thread(target=observe)
+        t.daemon = True
+        t.start()
+        self.assertTrue(changes.acquire(timeout=5))
+
+        first = etcd.Election(self.client, "test_election", value="first")
+        second = etcd.Election(self.client, "test_election", value="second")
+        first.campaign()
+        self.assertTrue(changes.acquire(timeout=5))
+        # A new candidate is not a new leader
+        self.assertFalse(second.acquire(blocking=False, lock_ttl=10))
+        first.resign()
+        self.assertTrue(changes.acquire(timeout=5))
+        second.resign()
+        self.assertTrue(changes.acquire(timeout=5))
+        self.assertEqual(seen, [None, "first", "second", None])
+
+        log = self.servers[0].log
+        listings = [
+            params
+            for (method, path, params) in log
+            if method == "GET"
+            and path == "/v2/keys/_locks/test_election"
+            and params.get("wait") != "true"
+        ]
+        # One listing by the observer, and one by each candidate
+        self.assertEqual(len(listings), 3)
+
+    def test_client_election(self):
+        self.assertRaises(NotImplementedError, getattr, self.client, "election")
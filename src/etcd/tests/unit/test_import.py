@@ -0,0 +1,41 @@
+import subprocess
+import sys
+import unittest
+
+# Modules that are only needed for some features, and that "import etcd"
+# should not load.
+OPTIONAL_MODULES = ("dns", "OpenSSL", "urllib3.contrib.pyopenssl", "httpx")
+
+
+def loaded_modules(code):
+    """Runs code in a fresh interpreter, returns the optional modules it loaded."""
+    script = (
+        "import sys\n{}\n"
+        "print(' '.join(m for m in sys.modules if m.split('.')[0] in {!r} or m in {!r}))"
+    ).format(code, OPTIONAL_MODULES, OPTIONAL_MODULES)
+    out = subprocess.check_output([sys.executable, "-c", script])
+    return set(out.decode("utf-8").split())
+
+
+class TestImport(unittest.TestCase):
+    def test_import_is_lightweight(self):
+        """Importing etcd does not load dnspython nor pyopenssl"""
+        self.assertEqual(loaded_modules("import etcd"), set())
+
+    def test_plain_client_is_lightweight(self):
+        """A plain http client does not need them either"""
+        self.assertEqual(loaded_modules("import etcd; etcd.Client(lazy=True)"), set())
+
+    def test_discovery_loads_dns(self):
+        """dnspython is loaded when SRV discovery is used"""
+        code = (
+            "import etcd\n"
+            "class Resolver(object):\n"
+            "    def resolve(self, qname, rdtype):\n"
+            "        return []\n"
+            "try:\n"
+            "    etcd.discovery.SrvDiscovery('example.com', Resolver()).hosts()\n"
+            "except ValueError:\n"
+            "    pass"
+        )
+        self.assertIn("dns.resolver", loaded_modules(code))
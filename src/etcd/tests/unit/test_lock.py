@@ -1,10 +1,13 @@
+import threading
+import time
+
 import etcd
 
 try:
     import mock
 except ImportError:
     from unittest import mock
-from etcd.tests.unit import TestClientApiBase
+from etcd.tests.unit import FakeClusterTestBase, TestClientApiBase
 
 
 class TestClientLock(TestClientApiBase):
@@ -25,10 +28,7 @@ class TestClientLock(TestClientApiBase):
         ]
         d = {
             "action": "get",
-            "node": {
-                "dir": True,
-                "nodes": [{"key": "/_locks/test_lock", "dir": True, "nodes": nodes}],
-            },
+            "node": {"key": "/_locks/test_lock", "dir": True, "nodes": nodes},
         }
         self._mock_api(200, d)
 
@@ -227,3 +227,350 @@ class TestClientLock(TestClientApiBase):
         self.locker.is_taken = True
         self.locker.release()
         self.assertFalse(self.locker.is_taken)
+
+
+class TestLockContention(FakeClusterTestBase):
+    contenders = 12
+    client_options = {"per_host_pool_size": contenders}
+
+    def listings(self):
+        return len(
+            [
+                params
+                for (method, path, params) in self.servers[0].log
+                if method == "GET"
+                and path == "/v2/keys/_locks/test_lock"
+                and params.get("wait") != "true"
+            ]
+        )
+
+    def test_mutual_exclusion(self):
+        """Contenders get the lock one at a time, in order"""
+        holders = []
+        order = []
+        locks = [etcd.Lock(self.client, "test_lock") for _ in range(self.contenders)]
+        # Queue everybody up behind the first one
+        self.assertTrue(locks[0].acquire(lock_ttl=None))
+        for lock in locks[1:]:
+            self.assertFalse(lock.acquire(blocking=False, lock_ttl=None))
+
+        def contend(lock):
+            lock._acquired(blocking=True)
+            holders.append(lock)
+            order.append(lock)
+            self.assertEqual(len(holders), 1)
+            holders.remove(lock)
+            lock.release()
+
+        threads = [threading.Thread(target=contend, args=(lock,)) for lock in locks[1:]]
+        for t in threads:
+            t.start()
+        locks[0].release()
+        for t in threads:
+            t.join()
+        self.assertEqual(order, locks[1:])
+        # One listing when joining the queue, one when starting to wait,
+        # and at most one when woken up
+        self.assertLessEqual(self.listings(), self.contenders + 2 * (self.contenders - 1))
+
+    def test_predecessor_shortcut(self):
+        """No listing is needed when the only key before ours goes away"""
+        first = etcd.Lock(self.client, "test_lock")
+        second = etcd.Lock(self.client, "test_lock")
+        first.acquire(lock_ttl=None)
+        self.assertFalse(second.acquire(blocking=False, lock_ttl=None))
+        listings = self.listings()
+        t = threading.Thread(target=second._acquired)
+        t.start()
+        # Updating the predecessor's key does not wake us up for nothing
+        self.client.write(first.lock_key, first.uuid)
+        first.release()
+        t.join()
+        self.assertTrue(second.is_taken)
+        # Only the listing done when starting to wait
+        self.assertEqual(self.listings(), listings + 1)
+
+    def test_timeout(self):
+        """Waiting for the lock gives up after the timeout, or the deadline"""
+        first = etcd.Lock(self.client, "test_lock")
+        first.acquire(lock_ttl=None)
+        second = etcd.Lock(self.client, "test_lock")
+        start = time.monotonic()
+        self.assertRaises(etcd.EtcdWatchTimedOut, second.acquire, lock_ttl=None, timeout=0.5)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertFalse(second.is_taken)
+        with self.client.deadline(0.3):
+            self.assertRaises(etcd.EtcdDeadlineExceeded, second.acquire, lock_ttl=None)
+        first.release()
+        self.assertTrue(second.acquire(lock_ttl=None, timeout=0.5))
+        second.release()
+
+
+class TestLockKeepalive(FakeClusterTestBase):
+    def test_keepalive(self):
+        """The key outlives its TTL while the lock is held"""
+        lock = etcd.Lock(self.client, "test_lock")
+        self.assertTrue(lock.acquire(lock_ttl=1, keepalive=True))
+        time.sleep(1.5)
+        self.assertTrue(lock.is_acquired)
+        self.assertFalse(lock.lease_lost)
+        lock.release()
+        self.assertTrue(lock._keeper._stopped.is_set())
+        self.assertFalse(lock.lease_lost)
+
+    def test_keepalive_needs_ttl(self):
+        lock = etcd.Lock(self.client, "test_lock")
+        self.assertRaises(ValueError, lock.acquire, lock_ttl=None, keepalive=True)
+
+    def test_lease_lost(self):
+        """The holder is told when its key could not be kept alive"""
+        lost = threading.Event()
+        lock = etcd.Lock(self.client, "test_lock", on_lease_lost=lambda l: lost.set())
+        lock.acquire(lock_ttl=3, keepalive=True)
+        self.client.delete(lock.lock_key)
+        self.assertTrue(lost.wait(3))
+        self.assertTrue(lock.lease_lost)
+
+    def test_context_manager(self):
+        """With keepalive_ttl, the context manager takes a short-lived lock"""
+        with etcd.Lock(self.client, "test_lock", keepalive_ttl=10) as lock:
+            self.assertEqual(self.client.read(lock.lock_key).ttl, 10)
+            self.assertFalse(lock._keeper._stopped.is_set())
+        self.assertTrue(lock._keeper._stopped.is_set())
+        self.assertFalse(lock.is_acquired)
+
+
+class TestLeaseKeeper(TestClientApiBase):
+    def test_connection_errors(self):
+        """Failed refreshes are retried until the key would have expired"""
+        lost = threading.Event()
+        self.client.refresh = mock.MagicMock(side_effect=etcd.EtcdConnectionFailed("down"))
+        keeper = etcd.LeaseKeeper(self.client, "/key", 1, interval=0.1, on_lost=lost.set)
+        keeper.start()
+        self.assertFalse(lost.wait(0.5))
+        self.assertTrue(lost.wait(2))
+        self.assertGreater(self.client.refresh.call_count, 3)
+
+
+class TestRWLock(FakeClusterTestBase):
+    client_options = {"per_host_pool_size": 8}
+
+    def test_shared_readers(self):
+        """Readers share the lock, writers wait for them"""
+        first = etcd.RWLock(self.client, "test_lock")
+        second = etcd.RWLock(self.client, "test_lock")
+        self.assertTrue(first.read_lock.acquire(blocking=False))
+        self.assertTrue(second.read_lock.acquire(blocking=False))
+        writer = etcd.RWLock(self.client, "test_lock").write_lock
+        self.assertFalse(writer.acquire(blocking=False))
+        first.read_lock.release()
+        self.assertFalse(writer._acquired(blocking=False))
+        second.read_lock.release()
+        self.assertTrue(writer._acquired(blocking=False))
+
+    def test_readers_behind_writer(self):
+        """Readers queued behind a writer all get in when it leaves"""
+        writer = etcd.RWLock(self.client, "test_lock").write_lock
+        writer.acquire()
+        readers = [etcd.RWLock(self.client, "test_lock").read_lock for _ in range(3)]
+        for reader in readers:
+            self.assertFalse(reader.acquire(blocking=False))
+        # A writer after the readers has to wait for them
+        late_writer = etcd.Lock(self.client, "test_lock")
+        self.assertFalse(late_writer.acquire(blocking=False))
+        threads = [threading.Thread(target=reader._acquired) for reader in readers]
+        for t in threads:
+            t.start()
+        writer.release()
+        for t in threads:
+            t.join()
+        self.assertTrue(all(reader.is_taken for reader in readers))
+        self.assertFalse(late_writer._acquired(blocking=False))
+
+
+class TestSemaphore(FakeClusterTestBase):
+    client_options = {"per_host_pool_size": 8}
+
+    def test_limit(self):
+        sems = [etcd.Semaphore(self.client, "test_sem", 2) for _ in range(3)]
+        self.assertTrue(sems[0].acquire(blocking=False))
+        self.assertTrue(sems[1].acquire(blocking=False))
+        self.assertFalse(sems[2].acquire(blocking=False))
+        sems[1].release()
+        self.assertTrue(sems[2]._acquired(blocking=False))
+
+    def test_invalid_limit(self):
+        self.assertRaises(ValueError, etcd.Semaphore, self.client, "test_sem", 0)
+
+    def test_history_cleared(self):
+        """Waiters whose events were cleared from the history read them again"""
+        self.etcd.history_size = 5
+        sems = [etcd.Semaphore(self.client, "test_sem", 1) for _ in range(4)]
+        self.assertTrue(sems[0].acquire(blocking=False))
+        for sem in sems[1:]:
+            self.assertFalse(sem.acquire(blocking=False))
+        for i in range(10):
+            self.client.write("/other", i)
+        # The first waiter watches the dir from before the events cleared
+        sems[0].release()
+        sems[1]._wait(None, 1)
+        self.assertTrue(sems[1]._acquired(blocking=False))
+        # The last one watches its predecessor, written long ago
+        for i in range(10):
+            self.client.write("/other", i)
+        acquired = []
+
+        def wait(sem):
+            acquired.append(sem._acquired())
+            sem.release()
+
+        threads = [threading.Thread(target=wait, args=(sem,)) for sem in sems[2:]]
+        for t in threads:
+            t.start()
+        time.sleep(0.2)
+        sems[1].release()
+        for t in threads:
+            t.join(10)
+        self.assertEqual(acquired, [True, True])
+
+    def test_contention(self):
+        """Waiters get in as holders leave, never more than the limit at once"""
+        holders = []
+        seen = []
+        sems = [etcd.Semaphore(self.client, "test_sem", 2) for _ in range(7)]
+        for sem in sems:
+            sem.acquire(blocking=False, lock_ttl=None)
+
+        def contend(sem):
+            sem._acquired()
+            holders.append(sem)
+            seen.append(len(holders))
+            time.sleep(0.01)
+            holders.remove(sem)
+            sem.release()
+
+        threads = [threading.Thread(target=contend, args=(sem,)) for sem in sems]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+            self.assertFalse(t.is_alive())
+        self.assertEqual(len(seen), len(sems))
+        self.assertLessEqual(max(seen), 2)
+
+
+class TestSharedLock(FakeClusterTestBase):
+    threads = 8
+    rounds = 5
+    client_options = {"per_host_pool_size": 4}
+
+    def lock_writes(self):
+        return len([1 for (method, path, _) in self.servers[0].log if method == "POST"])
+
+    def contend(self, **kwargs):
+        holders = []
+        errors = []
+
+        def work():
+            lock = etcd.SharedLock(self.client, "test_lock", **kwargs)
+            for _ in range(self.rounds):
+                with lock:
+                    holders.append(lock)
+                    if len(holders) != 1:
+                        errors.append(len(holders))
+                    time.sleep(0.001)
+                    holders.remove(lock)
+
+        threads = [threading.Thread(target=work) for _ in range(self.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+            self.assertFalse(t.is_alive())
+        self.assertEqual(errors, [])
+
+    def test_local_handoff(self):
+        """Threads of the same process share a single etcd key"""
+        self.contend(max_handoffs=None)
+        self.assertLess(self.lock_writes(), self.threads)
+        # The lock was given back to etcd at the end
+        self.assertEqual(self.client.read("/_locks/test_lock")._children, [])
+
+    def test_max_handoffs(self):
+        """The lock goes back to etcd after max_handoffs local hand-overs"""
+        self.contend(max_handoffs=0)
+        self.assertEqual(self.lock_writes(), self.threads * self.rounds)
+
+    def test_other_host(self):
+        """Another host waits for the local holders"""
+        lock = etcd.SharedLock(self.client, "test_lock")
+        lock.acquire()
+        other = etcd.Lock(etcd.Client(port=self.servers[0].port), "test_lock")
+        self.assertFalse(other.acquire(blocking=False))
+        lock.release()
+        self.assertTrue(other._acquired(blocking=False))
+        self.assertFalse(lock.acquire(blocking=False))
+        other.release()
+
+    def test_keepalive(self):
+        """The etcd key is kept alive while local threads hold the lock"""
+        lock = etcd.SharedLock(self.client, "test_lock", max_handoffs=None)
+        lock.acquire(lock_ttl=1)
+        time.sleep(1.5)
+        other = etcd.Lock(etcd.Client(port=self.servers[0].port), "test_lock")
+        self.assertFalse(other.acquire(blocking=False))
+        lock.release()
+        self.assertTrue(other._acquired(blocking=False))
+        other.release()
+        # Eternal keys need no keepalive
+        lock.acquire(lock_ttl=None)
+        lock.release()
+
+    def test_reentrant(self):
+        lock = etcd.SharedLock(self.client, "test_lock", reentrant=True)
+        self.assertTrue(lock.acquire())
+        self.assertTrue(lock.acquire())
+        lock.release()
+        self.assertTrue(lock.is_taken)
+        lock.release()
+        self.assertFalse(lock.is_taken)
+        self.assertRaises(RuntimeError, lock.release)
+
+    def test_not_reentrant(self):
+        lock = etcd.SharedLock(self.client, "test_lock")
+        lock.acquire()
+        self.assertRaises(RuntimeError, lock.acquire)
+        lock.release()
+
+    def test_timeout(self):
+        lock = etcd.SharedLock(self.client, "test_lock")
+        lock.acquire()
+        errors = []
+
+        def wait():
+            try:
+                etcd.SharedLock(self.client, "test_lock").acquire(timeout=0.1)
+            except etcd.EtcdWatchTimedOut as e:
+                errors.append(e)
+
+        t = threading.Thread(target=wait)
+        t.start()
+        t.join()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(len(lock._queue.waiters), 0)
+        lock.release()
+        self.assertEqual(self.client.read("/_locks/test_lock")._children, [])
+
+    def test_timeout_other_host(self):
+        """Waiting for another host to release the lock times out too"""
+        other = etcd.Lock(etcd.Client(port=self.servers[0].port), "test_lock")
+        other.acquire(lock_ttl=None)
+        lock = etcd.SharedLock(self.client, "test_lock")
+        self.assertRaises(etcd.EtcdWatchTimedOut, lock.acquire, timeout=0.3)
+        self.assertFalse(lock.is_taken)
+        self.assertFalse(lock._queue.busy)
+        # Our key left the etcd queue
+        self.assertEqual(len(self.client.read("/_locks/test_lock")._children), 1)
+        other.release()
+        self.assertTrue(lock.acquire(timeout=1))
+        lock.release()
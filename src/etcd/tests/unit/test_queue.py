@@ -0,0 +1,64 @@
+import threading
+
+import etcd
+from etcd.tests.unit import FakeClusterTestBase
+
+
+class TestQueue(FakeClusterTestBase):
+    client_options = {"per_host_pool_size": 8}
+
+    def setUp(self):
+        super(TestQueue, self).setUp()
+        self.queue = etcd.Queue(self.client, "/jobs")
+
+    def test_fifo(self):
+        self.queue.put("job1")
+        self.queue.put_many(["job2", "job3", "job4"])
+        self.assertEqual(self.queue.qsize(), 4)
+        self.assertEqual(self.queue.get().value, "job1")
+        self.assertEqual([i.value for i in self.queue.get_batch(2)], ["job2", "job3"])
+        self.assertEqual([i.value for i in self.queue.get_batch(10)], ["job4"])
+        self.assertEqual(self.queue.qsize(), 0)
+
+    def test_empty(self):
+        self.assertEqual(self.queue.get_batch(block=False), [])
+        self.assertIsNone(self.queue.get(block=False))
+        self.assertRaises(etcd.EtcdWatchTimedOut, self.queue.get, timeout=0.2)
+
+    def test_batch_requests(self):
+        """A batch costs one listing and one delete per item"""
+        self.queue.put_many(str(i) for i in range(10))
+        log = self.servers[0].log
+        start = len(log)
+        self.assertEqual(len(self.queue.get_batch(10)), 10)
+        methods = [method for (method, _, _) in log[start:]]
+        self.assertEqual(methods, ["GET"] + ["DELETE"] * 10)
+
+    def test_blocking_get(self):
+        """A consumer waiting on an empty queue gets the next item"""
+        items = []
+        t = threading.Thread(target=lambda: items.append(self.queue.get(timeout=5)))
+        t.start()
+        self.queue.put("job1")
+        t.join()
+        self.assertEqual(items[0].value, "job1")
+
+    def test_consumers(self):
+        """Each item goes to a single consumer"""
+        values = [str(i) for i in range(60)]
+        self.queue.put_many(values)
+        consumed = []
+
+        def consume():
+            while True:
+                batch = self.queue.get_batch(7, block=False)
+                if not batch:
+                    return
+                consumed.extend(item.value for item in batch)
+
+        threads = [threading.Thread(target=consume) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(consumed, key=int), values)
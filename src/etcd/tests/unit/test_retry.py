@@ -0,0 +1,179 @@
+import random
+import socket
+import unittest
+
+import urllib3
+
+import etcd
+from etcd.tests.unit import TestClientApiBase
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+
+class TestRetryBudget(unittest.TestCase):
+    def test_budget(self):
+        """Tokens run out, then come back over time"""
+        budget = etcd.RetryBudget(capacity=2, refill_rate=0)
+        self.assertTrue(budget.acquire())
+        self.assertTrue(budget.acquire())
+        self.assertFalse(budget.acquire())
+        budget.refill_rate = 1000
+        budget._last -= 1
+        self.assertTrue(budget.acquire())
+        self.assertLessEqual(budget.tokens, 2)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def setUp(self):
+        self.policy = etcd.RetryPolicy(rng=random.Random(0))
+
+    def test_idempotency(self):
+        p = self.policy
+        self.assertTrue(p.is_idempotent("GET", {"wait": "true"}))
+        self.assertTrue(p.is_idempotent("PUT", {"value": "a"}))
+        self.assertTrue(p.is_idempotent("PUT", {"ttl": 10, "prevExist": "true", "refresh": "true"}))
+        self.assertTrue(p.is_idempotent("DELETE", {}))
+        self.assertFalse(p.is_idempotent("POST", {"value": "a"}))
+        self.assertFalse(p.is_idempotent("PUT", {"value": "a", "prevIndex": 3}))
+        self.assertFalse(p.is_idempotent("PUT", {"value": "a", "prevExist": "false"}))
+        self.assertFalse(p.is_idempotent("DELETE", {"prevValue": "a"}))
+
+    def test_backoff(self):
+        """The backoff grows exponentially, up to a maximum, with jitter"""
+        p = etcd.RetryPolicy(backoff_base=0.1, backoff_max=1, jitter=False)
+        self.assertEqual([p.backoff(i) for i in range(1, 6)], [0.1, 0.2, 0.4, 0.8, 1])
+        for i in range(1, 6):
+            self.assertTrue(0 <= self.policy.backoff(i) <= min(2, 0.05 * 2 ** (i - 1)))
+
+    def test_max_attempts(self):
+        p = etcd.RetryPolicy(max_attempts=2)
+        self.assertTrue(p.should_retry(1, "GET", {}, socket.error()))
+        self.assertFalse(p.should_retry(2, "GET", {}, socket.error()))
+
+    def test_non_idempotent(self):
+        """Non-idempotent requests are retried only if they were not sent"""
+        p = self.policy
+        sent = urllib3.exceptions.ProtocolError("Connection aborted")
+        self.assertFalse(p.should_retry(1, "POST", {"value": "a"}, sent))
+        not_sent = urllib3.exceptions.NewConnectionError(None, "Connection refused")
+        self.assertTrue(p.should_retry(1, "POST", {"value": "a"}, not_sent))
+        wrapped = urllib3.exceptions.MaxRetryError(None, "/", reason=not_sent)
+        self.assertTrue(p.should_retry(1, "POST", {"value": "a"}, wrapped))
+        p.retry_non_idempotent = True
+        self.assertTrue(p.should_retry(1, "POST", {"value": "a"}, sent))
+
+    def test_budget_exhausted(self):
+        p = etcd.RetryPolicy(budget=etcd.RetryBudget(capacity=1, refill_rate=0))
+        self.assertTrue(p.should_retry(1, "GET", {}, socket.error()))
+        self.assertFalse(p.should_retry(1, "GET", {}, socket.error()))
+
+
+class TestClientRetries(TestClientApiBase):
+    def setUp(self):
+        self.client = etcd.Client(
+            host=(("localhost", 4001), ("localhost", 4002), ("localhost", 4003)),
+            allow_reconnect=True,
+            use_proxies=True,
+            retry_policy=etcd.RetryPolicy(backoff_base=0),
+        )
+
+    def _fail_with(self, exc, then=None):
+        effects = [exc] * 3
+        if then is not None:
+            effects[1] = then
+        self.client.http.request = mock.MagicMock(side_effect=effects)
+        self.client.http.request_encode_body = mock.MagicMock(side_effect=effects)
+
+    def test_failover(self):
+        """A read is retried on the next server"""
+        d = {"action": "get", "node": {"key": "/testkey", "value": "test"}}
+        self._fail_with(socket.error(), then=self._prepare_response(200, d))
+        self.assertEqual(self.client.read("/testkey").value, "test")
+        self.assertEqual(self.client.http.request.call_count, 2)
+
+    def test_max_attempts(self):
+        self.client.retry_policy.max_attempts = 2
+        self._fail_with(socket.error())
+        self.assertRaises(etcd.EtcdConnectionFailed, self.client.read, "/testkey")
+        self.assertEqual(self.client.http.request.call_count, 2)
+
+    def test_append_not_retried(self):
+        """An append that may have been applied is not sent again"""
+        self._fail_with(urllib3.exceptions.ProtocolError("Connection aborted"))
+        self.assertRaises(
+            etcd.EtcdConnectionFailed, self.client.write, "/dir", "value", append=True
+        )
+        self.assertEqual(self.client.http.request_encode_body.call_count, 1)
+
+    @mock.patch("time.sleep")
+    def test_backoff(self, sleep):
+        """The client waits between the attempts"""
+        self.client.retry_policy = etcd.RetryPolicy(backoff_base=0.5, jitter=False)
+        self._fail_with(socket.error())
+        self.assertRaises(etcd.EtcdConnectionFailed, self.client.read, "/testkey")
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [0.5, 1.0])
+
+
+class TestDeadlines(TestClientApiBase):
+    def setUp(self):
+        self.timeouts = []
+        self.clock = [1000.0]
+        # The retry budget of the client starts on the fake clock too.
+        patcher = mock.patch("time.monotonic", side_effect=lambda: self.clock[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = etcd.Client(
+            host=tuple(("localhost", port) for port in range(4001, 4006)),
+            allow_reconnect=True,
+            use_proxies=True,
+            read_timeout=10,
+            retry_policy=etcd.RetryPolicy(backoff_base=0),
+        )
+
+        def failing_request(*args, **kwargs):
+            self.timeouts.append(kwargs["timeout"])
+            # Every attempt takes a second before failing
+            self.clock[0] += 1
+            raise socket.error()
+
+        self.client.http.request = mock.MagicMock(side_effect=failing_request)
+        self.client.http.request_encode_body = self.client.http.request
+
+    def test_deadline_bounds_failover(self):
+        """Each attempt only gets what is left of the deadline"""
+        self.assertRaises(etcd.EtcdDeadlineExceeded, self.client.read, "/testkey", deadline=2.5)
+        self.assertEqual(self.timeouts, [2.5, 1.5, 0.5])
+
+    def test_timeout_shorter_than_deadline(self):
+        self.assertRaises(
+            etcd.EtcdDeadlineExceeded, self.client.read, "/testkey", timeout=1, deadline=2.5
+        )
+        self.assertEqual(self.timeouts, [1, 1, 0.5])
+
+    def test_context_deadline(self):
+        """A deadline can be set for all the requests in a block"""
+        with self.client.deadline(2.5):
+            self.assertRaises(etcd.EtcdDeadlineExceeded, self.client.write, "/testkey", "a")
+            self.assertRaises(etcd.EtcdDeadlineExceeded, self.client.delete, "/testkey")
+        self.assertEqual(self.client.http.request.call_count, 3)
+        self.assertIsNone(self.client._deadline.get())
+
+    def test_nested_deadlines(self):
+        """Nested deadlines can only be shorter"""
+        with self.client.deadline(1):
+            with self.client.deadline(5):
+                self.assertEqual(self.client._remaining_timeout(), 1)
+            with self.client.deadline(0.5):
+                self.assertEqual(self.client._remaining_timeout(10), 0.5)
+            self.assertEqual(self.client._remaining_timeout(10), 1)
+
+    @mock.patch("time.sleep")
+    def test_no_backoff_past_deadline(self, sleep):
+        """The client does not wait for a retry that would be past the deadline"""
+        self.client.retry_policy = etcd.RetryPolicy(backoff_base=1, jitter=False)
+        self.assertRaises(etcd.EtcdDeadlineExceeded, self.client.read, "/testkey", deadline=1.5)
+        self.assertEqual(self.timeouts, [1.5])
+        self.assertFalse(sleep.called)
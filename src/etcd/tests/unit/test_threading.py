@@ -0,0 +1,180 @@
+import threading
+import time
+import unittest
+
+import etcd
+from etcd.tests.unit import FakeClusterTestBase
+
+
+class TestThreadSafety(FakeClusterTestBase):
+    threads = 16
+    reads = 20
+    cluster_size = 3
+    client_options = {"per_host_pool_size": threads}
+
+    def setUp(self):
+        super(TestThreadSafety, self).setUp()
+        self.etcd.handle("PUT", "/v2/keys/foo", {"value": "bar"})
+
+    def hammer(self, during=None):
+        errors = []
+        start = threading.Barrier(self.threads + 1)
+
+        def worker():
+            start.wait()
+            for _ in range(self.reads):
+                try:
+                    assert self.client.read("/foo").value == "bar"
+                except Exception as e:
+                    errors.append(e)
+
+        workers = [threading.Thread(target=worker) for _ in range(self.threads)]
+        for w in workers:
+            w.start()
+        start.wait()
+        if during is not None:
+            during()
+        for w in workers:
+            w.join()
+        return errors
+
+    def assertEndpointsConsistent(self):
+        cache = self.client._machines_cache
+        self.assertEqual(len(cache), len(set(cache)))
+        self.assertNotIn(self.client.base_uri, cache)
+        self.assertTrue(set(cache) <= set(s.base_uri for s in self.servers))
+
+    def test_shared_client(self):
+        """One client serves many threads"""
+        self.assertEqual(self.hammer(), [])
+        self.assertEndpointsConsistent()
+        self.assertEqual(self.servers[0].requests, self.threads * self.reads + 1)
+
+    def test_concurrent_failover(self):
+        """Failing over from many threads at once leaves a consistent state"""
+        first = self.client.base_uri
+        down = next(s for s in self.servers if s.base_uri == first)
+        self.assertEqual(self.hammer(during=down.go_down), [])
+        self.assertNotEqual(self.client.base_uri, first)
+        self.assertEndpointsConsistent()
+        # All the threads moved to the same server.
+        alive = [s for s in self.servers if s is not down]
+        self.assertEqual(len([s for s in alive if s.requests > 1]), 1)
+
+
+class TestCoalescedReads(unittest.TestCase):
+    threads = 8
+
+    def setUp(self):
+        self.client = etcd.Client(lazy=True, coalesce_reads=True)
+        self.release = threading.Event()
+        self.calls = []
+        self.client._read = self.slow_read
+
+    def slow_read(self, key, params, timeout):
+        self.calls.append((key, params, timeout))
+        self.release.wait(5)
+        if key == "/missing":
+            raise etcd.EtcdKeyNotFound("Key not found")
+        return etcd.EtcdResult(node={"key": key, "value": "bar", "modifiedIndex": 1})
+
+    def read_concurrently(self, key, **kwdargs):
+        results = []
+
+        def reader():
+            try:
+                results.append(self.client.read(key, **kwdargs))
+            except Exception as e:
+                results.append(e)
+
+        readers = [threading.Thread(target=reader) for _ in range(self.threads)]
+        for r in readers:
+            r.start()
+        # Let the others join the first read before it completes.
+        for _ in range(500):
+            flights = list(self.client._flights.values())
+            if flights and flights[0].followers == self.threads - 1:
+                break
+            time.sleep(0.01)
+        self.release.set()
+        for r in readers:
+            r.join()
+        return results
+
+    def test_coalesced(self):
+        """Identical concurrent reads share one request and its result"""
+        results = self.read_concurrently("/foo", recursive=True)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.calls[0], ("/foo", {"recursive": "true"}, None))
+        self.assertEqual(len(results), self.threads)
+        self.assertTrue(all(r is results[0] for r in results))
+        self.assertEqual(results[0].value, "bar")
+        self.assertEqual(self.client._flights, {})
+        # A later read makes its own request
+        self.client.read("/foo", recursive=True)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_error(self):
+        """The error of the read is raised in all the threads"""
+        results = self.read_concurrently("/missing")
+        self.assertEqual(len(self.calls), 1)
+        self.assertTrue(all(isinstance(r, etcd.EtcdKeyNotFound) for r in results))
+        self.assertEqual(self.client._flights, {})
+
+    def test_different_options(self):
+        """Reads with other options or keys are not coalesced"""
+        self.release.set()
+        self.client.read("/foo")
+        self.client.read("/foo", sorted=True)
+        self.client.read("/bar")
+        self.assertEqual(len(self.calls), 3)
+
+    def test_watches(self):
+        """Watches are never coalesced"""
+        self.release.set()
+        self.client.read("/foo", wait=True)
+        self.client.read("/foo", wait=True)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_deadline(self):
+        """Waiting for the read of another thread is bounded by the deadline"""
+        leader = threading.Thread(target=self.client.read, args=("/foo",))
+        leader.start()
+        while not self.client._flights:
+            time.sleep(0.01)
+        try:
+            self.assertRaises(etcd.EtcdDeadlineExceeded, self.client.read, "/foo", deadline=0.05)
+        finally:
+            self.release.set()
+            leader.join()
+
+    def test_deadline_not_shared(self):
+        """A read under a deadline is not shared, its deadline is its own"""
+        errors = []
+
+        def read_with_deadline():
+            try:
+                self.client.read("/foo", deadline=5)
+            except etcd.EtcdDeadlineExceeded as e:
+                errors.append(e)
+
+        def slow_read(key, params, timeout):
+            self.calls.append((key, params, timeout))
+            if len(self.calls) == 1:
+                self.release.wait(5)
+                raise etcd.EtcdDeadlineExceeded("Deadline exceeded")
+            return etcd.EtcdResult(node={"key": key, "value": "bar", "modifiedIndex": 1})
+
+        self.client._read = slow_read
+        t = threading.Thread(target=read_with_deadline)
+        t.start()
+        while not self.calls:
+            time.sleep(0.01)
+        self.assertEqual(self.client._flights, {})
+        try:
+            self.assertEqual(self.client.read("/foo").value, "bar")
+        finally:
+            self.release.set()
+            t.join()
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(len(errors), 1)
@@ -0,0 +1,104 @@
+import threading
+import unittest
+
+import etcd
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+from etcd.tests.unit import FakeClusterTestBase
+
+
+def increment(value):
+    return str(int(value or 0) + 1)
+
+
+class TestTransact(FakeClusterTestBase):
+    client_options = {"per_host_pool_size": 8}
+
+    def test_transact(self):
+        self.assertEqual(self.client.transact("/counter", increment).value, "1")
+        self.assertEqual(self.client.transact("/counter", increment).value, "2")
+        self.assertEqual(self.client.read("/counter").value, "2")
+        stats = self.client.transaction_stats
+        self.assertEqual(stats["transactions"], 2)
+        self.assertEqual(stats["conflicts"], 0)
+        self.assertEqual(stats["conflict_rate"], 0)
+
+    def test_prev(self):
+        """A known state of the key saves the first read"""
+        res = self.client.transact("/counter", increment)
+        start = len(self.servers[0].log)
+        res = self.client.transact("/counter", increment, prev=res)
+        self.assertEqual(res.value, "2")
+        self.assertEqual([m for (m, _, _) in self.servers[0].log[start:]], ["PUT"])
+        # A stale state only costs a read
+        self.client.write("/counter", "10")
+        stats = {}
+        res = self.client.transact("/counter", increment, prev=res, stats=stats)
+        self.assertEqual(res.value, "11")
+        self.assertEqual(stats, {"conflicts": 1, "backoff": 0, "transactions": 1})
+
+    def test_contention(self):
+        """Concurrent transactions are all applied, once"""
+
+        def work():
+            for _ in range(10):
+                self.client.transact("/counter", increment, max_retries=None, backoff=0.001)
+
+        threads = [threading.Thread(target=work) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.client.read("/counter").value, "60")
+        stats = self.client.transaction_stats
+        self.assertEqual(stats["transactions"], 60)
+        self.assertEqual(stats["failures"], 0)
+
+    def test_max_retries(self):
+        def conflicting(value):
+            # Someone else always gets there first
+            self.client.write("/counter", "other")
+            return "mine"
+
+        self.assertRaises(
+            etcd.EtcdCompareFailed,
+            self.client.transact,
+            "/counter",
+            conflicting,
+            max_retries=2,
+            backoff=0,
+        )
+        stats = self.client.transaction_stats
+        self.assertEqual(stats["conflicts"], 3)
+        self.assertEqual(stats["failures"], 1)
+        self.assertEqual(stats["conflict_rate"], 1)
+
+
+class TestTransactReads(unittest.TestCase):
+    def test_quorum_reread(self):
+        """After a conflict, a member behind the conflict is not trusted"""
+        client = etcd.Client(lazy=True)
+
+        def result(value, index, etcd_index):
+            r = etcd.EtcdResult(node={"key": "/k", "value": value, "modifiedIndex": index})
+            r.etcd_index = etcd_index
+            return r
+
+        reads = [result("1", 3, 5), result("1", 3, 5), result("4", 9, 10)]
+        client.read = mock.MagicMock(side_effect=reads)
+        client.write = mock.MagicMock(
+            side_effect=[
+                etcd.EtcdCompareFailed("Compare failed", {"index": 10}),
+                result("5", 11, 11),
+            ]
+        )
+        res = client.transact("/k", increment, backoff=0)
+        self.assertEqual(res.value, "5")
+        self.assertEqual(
+            client.read.call_args_list,
+            [mock.call("/k"), mock.call("/k"), mock.call("/k", quorum=True)],
+        )
+        client.write.assert_called_with("/k", "5", prevIndex=9)
@@ -0,0 +1,380 @@
+import json
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import time
+import unittest
+
+import urllib3
+
+import etcd
+from etcd import transport
+from etcd.tests.unit import FakeClusterTestBase
+from etcd.tests.unit.fake_server import FakeEtcd, FakeTransport, fake_cluster
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+try:
+    import httpx
+    import h2
+except ImportError:
+    httpx = h2 = None
+
+
+class StubTransport(transport.Transport):
+    """Answers the requests with handler(method, url, fields, body)."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = []
+        self.cleared = 0
+
+    def request(self, method, url, fields=None, body=None, headers=None, timeout=None):
+        self.requests.append((method, url, fields, body, headers, timeout))
+        status, data = self.handler(method, url, fields, body)
+        if isinstance(data, transport.ConnectError):
+            raise data
+
+        def read():
+            if isinstance(data, Exception):
+                raise data
+            if isinstance(data, str):
+                return data.encode("utf-8")
+            return json.dumps(data).encode("utf-8")
+
+        return transport.Response(status, {"x-etcd-cluster-id": "abcd", "x-etcd-index": "2"}, read)
+
+    def clear(self):
+        self.cleared += 1
+
+
+def get_response(key="/testkey", value="value"):
+    return 200, {"action": "get", "node": {"key": key, "value": value, "modifiedIndex": 2}}
+
+
+class TestTransport(unittest.TestCase):
+    def test_requests(self):
+        """The client sends its requests with the transport"""
+        stub = StubTransport(lambda *args: get_response())
+        client = etcd.Client(transport=stub, username="user", password="pass", lazy=True)
+        self.assertEqual(client.read("/testkey", recursive=True).value, "value")
+        client.write("/testkey", "value")
+        self.assertEqual(
+            [request[:4] for request in stub.requests],
+            [
+                ("GET", "http://127.0.0.1:4001/v2/keys/testkey", {"recursive": "true"}, None),
+                ("PUT", "http://127.0.0.1:4001/v2/keys/testkey", {"value": "value"}, None),
+            ],
+        )
+        self.assertEqual(stub.requests[0][4], {"authorization": "Basic dXNlcjpwYXNz"})
+        self.assertEqual(stub.requests[0][5], 60)
+
+    def test_json(self):
+        stub = StubTransport(lambda *args: (200, {"user": "alice", "roles": []}))
+        client = etcd.Client(transport=stub, lazy=True)
+        client.api_execute_json("/v2/auth/users/alice", "PUT", params={"user": "alice"})
+        method, _, fields, body, headers, _ = stub.requests[0]
+        self.assertEqual((method, fields, json.loads(body)), ("PUT", None, {"user": "alice"}))
+        self.assertEqual(headers["Content-Type"], "application/json")
+
+    def test_watch_timeout(self):
+        stub = StubTransport(lambda *args: (200, transport.ReadTimeout("timed out")))
+        client = etcd.Client(transport=stub, lazy=True)
+        self.assertRaises(etcd.EtcdWatchTimedOut, client.watch, "/testkey", timeout=1)
+
+    def test_failover(self):
+        """Requests that could not be sent are retried on the other members"""
+
+        def handler(method, url, fields, body):
+            if url.startswith("http://127.0.0.1:4001"):
+                return 200, transport.ConnectError("connection refused")
+            if url.endswith("/machines"):
+                return 200, "http://127.0.0.1:4001, http://127.0.0.1:4002"
+            return 201, {"action": "create", "node": {"key": "/dir/2", "value": "v"}}
+
+        stub = StubTransport(handler)
+        client = etcd.Client(
+            host=(("127.0.0.1", 4001), ("127.0.0.1", 4002)),
+            allow_reconnect=True,
+            transport=stub,
+            retry_policy=etcd.RetryPolicy(backoff_base=0),
+            lazy=True,
+        )
+        self.assertEqual(client.write("/dir", "v", append=True).key, "/dir/2")
+        self.assertEqual(client.base_uri, "http://127.0.0.1:4002")
+        self.assertEqual(client._machines_cache, ["http://127.0.0.1:4001"])
+
+    def test_cluster_id_change(self):
+        """The connections of the transport are dropped for a new cluster"""
+        stub = StubTransport(lambda *args: get_response())
+        client = etcd.Client(transport=stub, expected_cluster_id="dcba", lazy=True)
+        self.assertRaises(etcd.EtcdClusterIdChanged, client.read, "/testkey")
+        self.assertEqual(stub.cleared, 1)
+
+    def test_ssl_context(self):
+        """The SSL context is only made for https"""
+        self.assertIsNone(etcd.Client(lazy=True).ssl_context)
+        self.assertIsNotNone(etcd.Client(protocol="https", lazy=True).ssl_context)
+
+    def test_response(self):
+        reads = []
+        response = transport.Response(200, {"x-etcd-index": "3"}, lambda: reads.append(1) or b"{}")
+        self.assertEqual(response.getheader("X-Etcd-Index"), "3")
+        self.assertEqual(reads, [])
+        self.assertEqual(response.data, b"{}")
+        self.assertEqual(response.data, b"{}")
+        self.assertEqual(reads, [1])
+
+
+class TestUrllib3Transport(unittest.TestCase):
+    def test_errors(self):
+        """The errors of urllib3 are mapped to transport errors"""
+        http = urllib3.PoolManager()
+        t = transport.Urllib3Transport(http)
+        not_sent = urllib3.exceptions.NewConnectionError(None, "refused")
+        timeout = urllib3.exceptions.ReadTimeoutError(http, "/", "timed out")
+        for error, expected in (
+            (urllib3.exceptions.MaxRetryError(None, "/", reason=not_sent), transport.ConnectError),
+            (socket.gaierror(), transport.ConnectError),
+            (timeout, transport.ReadTimeout),
+            (urllib3.exceptions.ProtocolError("reset"), transport.TransportError),
+            (socket.error(), transport.TransportError),
+        ):
+            http.request = mock.MagicMock(side_effect=error)
+            with self.assertRaises(expected) as raised:
+                t.request("GET", "http://127.0.0.1:4001/v2/keys/foo")
+            self.assertIs(raised.exception.cause, error)
+
+    def test_read_errors(self):
+        """Errors reading the body are transport errors too"""
+        response = mock.MagicMock(status=200)
+        type(response).data = mock.PropertyMock(
+            side_effect=urllib3.exceptions.ProtocolError("reset")
+        )
+        http = mock.MagicMock()
+        http.request.return_value = response
+        r = transport.Urllib3Transport(http).request("GET", "http://127.0.0.1:4001/v2/keys/foo")
+        self.assertEqual(r.status, 200)
+        self.assertRaises(transport.TransportError, getattr, r, "data")
+
+    def test_warm_up(self):
+        """Connections are opened ahead of the requests, up to the pool size"""
+        _, servers = fake_cluster(1)
+        try:
+            client = etcd.Client(port=servers[0].port, prewarm_connections=3)
+            pool = client.http.connection_from_url(client.base_uri)
+            self.assertIsNotNone(pool.pool.queue[-1].sock)
+            self.assertEqual(client.warm_up(20), {client.base_uri: 7})
+            self.assertEqual(pool.num_connections, 10)
+            client.write("/key", "value")
+            self.assertEqual(pool.num_connections, 10)
+            self.assertEqual(client.warm_up(10), {client.base_uri: 0})
+        finally:
+            servers[0].stop()
+
+    def test_warm_up_failure(self):
+        """Members that can't be reached are skipped"""
+        _, servers = fake_cluster(1)
+        servers[0].stop()
+        client = etcd.Client(port=servers[0].port, lazy=True)
+        with mock.patch("etcd.client._log") as log:
+            self.assertEqual(client.warm_up(2), {})
+        self.assertTrue(log.warning.called)
+
+    def test_clear(self):
+        """The connections of the pools dropped are closed"""
+        _, servers = fake_cluster(1)
+        try:
+            client = etcd.Client(port=servers[0].port)
+            client.write("/key", "value")
+            conn = client.http.connection_from_url(client.base_uri).pool.queue[-1]
+            self.assertIsNotNone(conn.sock)
+            client._transport.clear()
+            self.assertIsNone(conn.sock)
+        finally:
+            servers[0].stop()
+
+    def test_close_idle(self):
+        _, servers = fake_cluster(1)
+        try:
+            client = etcd.Client(port=servers[0].port)
+            client.warm_up(2)
+            pool = client.http.connection_from_url(client.base_uri)
+            self.assertEqual(client._transport.close_idle(60), 0)
+            time.sleep(0.01)
+            self.assertEqual(client._transport.close_idle(0.005), 2)
+            self.assertEqual(client._transport.close_idle(0), 0)
+            # Closed connections are opened again when needed
+            client.write("/key", "value")
+            self.assertEqual(client.read("/key").value, "value")
+            self.assertIsNotNone(pool.pool.queue[-1].sock)
+        finally:
+            servers[0].stop()
+
+    def test_idle_reaper(self):
+        """With max_idle_time, a thread closes the idle connections"""
+        _, servers = fake_cluster(1)
+        try:
+            client = etcd.Client(port=servers[0].port, max_idle_time=0.05)
+            client.write("/key", "value")
+            pool = client.http.connection_from_url(client.base_uri)
+            conn = pool.pool.queue[-1]
+            self.assertIsNotNone(conn.sock)
+            time.sleep(0.3)
+            self.assertIsNone(conn.sock)
+            self.assertEqual(client.read("/key").value, "value")
+        finally:
+            servers[0].stop()
+
+
+@unittest.skipUnless(shutil.which("openssl"), "needs openssl to make a certificate")
+class TestTLS(FakeClusterTestBase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.cert = os.path.join(cls.dir, "cert.pem")
+        cls.key = os.path.join(cls.dir, "key.pem")
+        subprocess.check_call(
+            [
+                "openssl",
+                "req",
+                "-x509",
+                "-newkey",
+                "rsa:2048",
+                "-nodes",
+                "-days",
+                "1",
+                "-subj",
+                "/CN=127.0.0.1",
+                "-addext",
+                "subjectAltName=IP:127.0.0.1",
+                "-keyout",
+                cls.key,
+                "-out",
+                cls.cert,
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    client_options = {"protocol": "https", "lazy": True}
+
+    def start_cluster(self):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.cert, self.key)
+        return fake_cluster(1, ssl_context=context)
+
+    def make_client(self, **kwargs):
+        return super(TestTLS, self).make_client(ca_cert=self.cert, **kwargs)
+
+    def test_resumption(self):
+        """New connections to a member resume the session of the last one"""
+        self.client.write("/key", "value")
+        self.client._transport.clear()
+        self.assertEqual(self.client.read("/key").value, "value")
+        self.client._transport.clear()
+        self.assertEqual(self.client.read("/key").value, "value")
+        self.assertEqual(self.client.ssl_context.stats, {"handshakes": 3, "resumed": 2})
+
+    def test_verify(self):
+        """Servers are only verified if there is a CA certificate"""
+        client = etcd.Client(port=self.servers[0].port, protocol="https", lazy=True)
+        client.write("/key", "value")
+        self.assertEqual(client.ssl_context.verify_mode, ssl.CERT_NONE)
+        client = etcd.Client(
+            port=self.servers[0].port, protocol="https", ca_cert=self.cert, lazy=True
+        )
+        self.assertEqual(client.ssl_context.verify_mode, ssl.CERT_REQUIRED)
+        self.assertEqual(client.read("/key").value, "value")
+
+
+class TestFakeTransport(unittest.TestCase):
+    """The in-memory fake etcd behaves like the one behind a socket"""
+
+    def setUp(self):
+        self.etcd = FakeEtcd()
+        self.transport = FakeTransport(self.etcd)
+        self.client = etcd.Client(transport=self.transport)
+
+    def test_keys(self):
+        self.client.write("/dir/key", "value", ttl=10)
+        self.assertEqual(self.client.read("/dir/key").value, "value")
+        res = self.client.write(
+            "/dir/key", "new", prevIndex=self.client.read("/dir/key").modifiedIndex
+        )
+        self.assertRaises(etcd.EtcdCompareFailed, self.client.write, "/dir/key", "x", prevValue="x")
+        self.assertEqual(next(self.client.read("/dir", recursive=True).leaves).value, "new")
+        self.assertEqual(self.client.read("/dir").etcd_index, res.modifiedIndex)
+
+    def test_watch(self):
+        res = self.client.write("/key", "value")
+        self.assertEqual(self.client.watch("/key", index=res.modifiedIndex).value, "value")
+        self.assertRaises(etcd.EtcdWatchTimedOut, self.client.watch, "/key", timeout=0.1)
+
+    def test_recipes(self):
+        lock = etcd.Lock(self.client, "lock")
+        with lock:
+            self.assertTrue(lock.is_acquired)
+        counter = etcd.Counter(self.client, "/counter", batch_size=10)
+        self.assertEqual([counter.next() for _ in range(3)], [0, 1, 2])
+        self.assertEqual(self.client.read("/counter").value, "10")
+        self.assertIn(("GET", "/v2/keys/counter", {}), self.transport.log)
+
+
+class TestHTTP2Transport(unittest.TestCase):
+    @unittest.skipIf(httpx, "httpx is installed")
+    def test_needs_httpx(self):
+        self.assertRaises(ImportError, transport.HTTP2Transport)
+
+
+@unittest.skipUnless(httpx and h2, "needs httpx with its http2 extra")
+class TestHTTP2TransportRequests(FakeClusterTestBase):
+    """The client works over httpx, with HTTP/1.1 on plain HTTP"""
+
+    cluster_size = 2
+    client_options = {"retry_policy": etcd.RetryPolicy(backoff_base=0), "lazy": True}
+
+    def setUp(self):
+        self.transport = transport.HTTP2Transport()
+        super(TestHTTP2TransportRequests, self).setUp()
+
+    def tearDown(self):
+        self.transport.close()
+        super(TestHTTP2TransportRequests, self).tearDown()
+
+    def make_client(self, **kwargs):
+        return super(TestHTTP2TransportRequests, self).make_client(
+            transport=self.transport, **kwargs
+        )
+
+    def test_keys(self):
+        self.client.write("/dir/key", "value", ttl=10)
+        self.assertEqual(self.client.read("/dir/key").value, "value")
+        self.assertEqual(next(self.client.read("/dir", recursive=True).leaves).value, "value")
+        res = self.client.write("/queue", "first", append=True)
+        self.assertTrue(res.key.startswith("/queue/"))
+        self.assertEqual(self.client.read(res.key).value, "first")
+        self.assertRaises(etcd.EtcdKeyNotFound, self.client.read, "/missing")
+
+    def test_watch(self):
+        res = self.client.write("/key", "value")
+        self.assertEqual(self.client.watch("/key", index=res.modifiedIndex).value, "value")
+        self.assertRaises(etcd.EtcdWatchTimedOut, self.client.watch, "/key", timeout=0.1)
+
+    def test_failover(self):
+        """Requests that could not be sent are retried on the other member"""
+        # Stopped before any request, as the open connections outlive it
+        self.servers[0].stop()
+        self.client.write("/key", "value")
+        self.assertEqual(self.client.read("/key").value, "value")
+        self.assertEqual(self.client.base_uri, "http://127.0.0.1:%d" % self.servers[1].port)
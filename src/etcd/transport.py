@@ -0,0 +1,545 @@
+"""
+Transports carry the requests of a client to the members of the cluster.
+
+A transport takes a request (method, url, form fields or body, headers,
+timeout) and returns a Response. The data of the response is only read
+when first accessed, so that the client can check the headers of a watch
+before waiting for its event. Failures are raised as TransportError: the
+errors of the HTTP libraries are only known here.
+
+Clients use an Urllib3Transport by default. The asyncio clients of etcd.aio
+use the asyncio version of the transport of their client, see
+Transport.async_transport.
+
+>>> from etcd.transport import HTTP2Transport
+>>> client = etcd.Client(host='etcd.example.com', port=2379, protocol='https',
+...                      transport=HTTP2Transport(verify='/etc/etcd/ca.pem'))
+"""
+
+import logging
+import socket
+import ssl
+import threading
+import time
+
+try:
+    # Python 3
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+try:
+    # Python 3
+    from http.client import HTTPException
+except ImportError:
+    # Python 2
+    from httplib import HTTPException
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import (
+    ConnectTimeoutError,
+    HTTPError,
+    MaxRetryError,
+    NewConnectionError,
+    ReadTimeoutError,
+)
+from urllib3.util.connection import is_connection_dropped
+
+_log = logging.getLogger(__name__)
+
+
+class TransportError(Exception):
+    """A request could not be sent, or its response could not be read."""
+
+    def __init__(self, message=None, cause=None):
+        super(TransportError, self).__init__(message)
+        self.cause = cause
+
+
+class ConnectError(TransportError):
+    """No connection could be made, the request was not sent."""
+
+
+class ReadTimeout(TransportError):
+    """The response did not come in time."""
+
+
+class Response(object):
+    """The response of a transport, with the interface of a urllib3 one."""
+
+    def __init__(self, status, headers, read):
+        """
+        Args:
+            status (int): The HTTP status.
+
+            headers (dict): The headers, by lower case name.
+
+            read (callable): Reads the whole body, raising TransportError
+                             if it can't.
+        """
+        self.status = status
+        self.headers = headers
+        self._read = read
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._read()
+        return self._data
+
+    def getheaders(self):
+        return self.headers
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+
+class _ResumableSSLSocket(ssl.SSLSocket):
+    """SSLSocket giving its session back to its context when closed."""
+
+    def close(self):
+        self.context._save_session(self)
+        super(_ResumableSSLSocket, self).close()
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """
+    Client SSLContext resuming the TLS session of the last connection to
+    the same server: new connections to a member, or reconnections after
+    it restarted, skip the full handshake while their session is valid.
+
+    A single context, with its certificates loaded once, is shared by all
+    the connections of a client.
+    """
+
+    sslsocket_class = _ResumableSSLSocket
+
+    def __new__(cls, protocol=ssl.PROTOCOL_TLS_CLIENT):
+        return super(ResumingSSLContext, cls).__new__(cls, protocol)
+
+    def __init__(self, protocol=ssl.PROTOCOL_TLS_CLIENT):
+        super(ResumingSSLContext, self).__init__()
+        self._sessions = {}
+        self._stats_lock = threading.Lock()
+        self.stats = {"handshakes": 0, "resumed": 0}
+
+    def wrap_socket(
+        self,
+        sock,
+        server_side=False,
+        do_handshake_on_connect=True,
+        suppress_ragged_eofs=True,
+        server_hostname=None,
+        session=None,
+    ):
+        key = None
+        if not server_side:
+            try:
+                key = (server_hostname, sock.getpeername())
+            except OSError:
+                pass
+            if session is None:
+                session = self._sessions.get(key)
+        ssock = super(ResumingSSLContext, self).wrap_socket(
+            sock,
+            server_side=server_side,
+            do_handshake_on_connect=do_handshake_on_connect,
+            suppress_ragged_eofs=suppress_ragged_eofs,
+            server_hostname=server_hostname,
+            session=session,
+        )
+        ssock._session_key = key
+        if key is not None and do_handshake_on_connect:
+            with self._stats_lock:
+                self.stats["handshakes"] += 1
+                if ssock.session_reused:
+                    self.stats["resumed"] += 1
+        return ssock
+
+    def _save_session(self, ssock):
+        key = getattr(ssock, "_session_key", None)
+        if key is None:
+            return
+        try:
+            session = ssock.session
+        except (AttributeError, ValueError):
+            session = None
+        # With TLS 1.3, the session can only be resumed once its ticket came.
+        if session is not None and (session.has_ticket or session.id):
+            self._sessions[key] = session
+
+
+def ssl_context(cert=None, ca_cert=None):
+    """
+    The ResumingSSLContext of a client.
+
+    Args:
+        cert (mixed): The client certificate: a file name, or a tuple of the
+                      certificate and key file names.
+
+        ca_cert (str): The CA certificate to verify the servers with. They
+                       are not verified without one.
+    """
+    context = ResumingSSLContext()
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    if ca_cert:
+        context.load_verify_locations(ca_cert)
+    else:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if cert:
+        if isinstance(cert, tuple):
+            context.load_cert_chain(cert[0], cert[1])
+        else:
+            context.load_cert_chain(cert)
+    return context
+
+
+class Transport(object):
+    """Base of the transports."""
+
+    def request(self, method, url, fields=None, body=None, headers=None, timeout=None):
+        """
+        Sends a request.
+
+        Args:
+            method (str): The HTTP method.
+
+            url (str): The URL of the request, on a member of the cluster.
+
+            fields (dict): Form fields, sent in the query string of GET and
+                           DELETE requests, and as an urlencoded body
+                           otherwise.
+
+            body (str): The body, if there are no fields.
+
+            headers (dict): The headers of the request.
+
+            timeout (float): Seconds to wait for the response, None to wait
+                             forever.
+
+        Returns:
+            Response.
+
+        Raises:
+            TransportError: If the request failed.
+        """
+        raise NotImplementedError()
+
+    def async_transport(self):
+        """
+        The etcd.aio.AsyncTransport sending the requests of the asyncio
+        clients the way this one does. By default, they are sent by this
+        transport, in the default executor of the event loop.
+        """
+        from etcd.aio import ExecutorTransport
+
+        return ExecutorTransport(self)
+
+    def warm_up(self, base_uri, count):
+        """
+        Opens connections to a member ahead of the requests, up to count,
+        and returns how many were opened. Idle connections the member
+        closed are opened again. Transports without a pool of connections
+        do nothing.
+        """
+        return 0
+
+    def close_idle(self, max_idle):
+        """
+        Closes the connections that have been idle for more than max_idle
+        seconds, or that the member closed, and returns how many were.
+        """
+        return 0
+
+    def clear(self):
+        """Closes the idle connections."""
+
+    def close(self):
+        """Closes all the connections."""
+        self.clear()
+
+
+def urllib3_error(e):
+    """The TransportError for an error of urllib3 or of the socket layer."""
+    if isinstance(e, TransportError):
+        return e
+    # urllib3 wraps the errors it retried itself.
+    reason = e.reason if isinstance(e, MaxRetryError) else e
+    if isinstance(reason, ReadTimeoutError):
+        return ReadTimeout(repr(e), cause=e)
+    if isinstance(
+        reason, (NewConnectionError, ConnectTimeoutError, ConnectionRefusedError, socket.gaierror)
+    ):
+        return ConnectError(repr(e), cause=e)
+    return TransportError(repr(e), cause=e)
+
+
+class _Urllib3Response(Response):
+    """A urllib3 response, whose errors are TransportError."""
+
+    def __init__(self, response):
+        super(_Urllib3Response, self).__init__(response.status, None, self._read_data)
+        self._response = response
+
+    def _read_data(self):
+        try:
+            return self._response.data
+        except (HTTPError, HTTPException, socket.error) as e:
+            raise urllib3_error(e)
+
+    def getheaders(self):
+        return self._response.getheaders()
+
+    def getheader(self, name, default=None):
+        value = self._response.getheader(name)
+        return default if value is None else value
+
+
+class _IdleTrackingPool(object):
+    """Connection pool knowing for how long its connections are idle."""
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn.idle_since = time.monotonic()
+        super(_IdleTrackingPool, self)._put_conn(conn)
+
+    def close_idle(self, max_idle):
+        if self.pool is None:
+            # The pool was closed
+            return 0
+        # Take all the idle connections, the most recently used first, and
+        # put them back in the same order once the stale ones are closed.
+        idle = []
+        while True:
+            try:
+                idle.append(self.pool.get(block=False))
+            except queue.Empty:
+                break
+        limit = time.monotonic() - max_idle
+        closed = 0
+        for conn in reversed(idle):
+            if conn is not None and conn.sock is not None:
+                if conn.idle_since < limit or is_connection_dropped(conn):
+                    conn.close()
+                    closed += 1
+            try:
+                self.pool.put(conn, block=False)
+            except queue.Full:
+                # Requests made new connections in the meantime.
+                if conn is not None:
+                    conn.close()
+        return closed
+
+
+class _IdleTrackingHTTPConnectionPool(_IdleTrackingPool, HTTPConnectionPool):
+    pass
+
+
+class _IdleTrackingHTTPSConnectionPool(_IdleTrackingPool, HTTPSConnectionPool):
+    pass
+
+
+class Urllib3Transport(Transport):
+    """
+    Transport using a pool of HTTP/1.1 connections per member, the one
+    of a urllib3.PoolManager.
+    """
+
+    def __init__(self, http, allow_redirect=True):
+        """
+        Args:
+            http (urllib3.PoolManager): The pool of connections.
+
+            allow_redirect (bool): Follow redirects.
+        """
+        self.http = http
+        self.allow_redirect = allow_redirect
+        http.pool_classes_by_scheme = {
+            "http": _IdleTrackingHTTPConnectionPool,
+            "https": _IdleTrackingHTTPSConnectionPool,
+        }
+
+    def request(self, method, url, fields=None, body=None, headers=None, timeout=None):
+        try:
+            if body is not None:
+                response = self.http.urlopen(
+                    method,
+                    url,
+                    body=body,
+                    timeout=timeout,
+                    redirect=self.allow_redirect,
+                    headers=headers,
+                    preload_content=False,
+                )
+            elif method in ("GET", "DELETE"):
+                response = self.http.request(
+                    method,
+                    url,
+                    timeout=timeout,
+                    fields=fields,
+                    redirect=self.allow_redirect,
+                    headers=headers,
+                    preload_content=False,
+                )
+            else:
+                response = self.http.request_encode_body(
+                    method,
+                    url,
+                    fields=fields,
+                    timeout=timeout,
+                    encode_multipart=False,
+                    redirect=self.allow_redirect,
+                    headers=headers,
+                    preload_content=False,
+                )
+        except (HTTPError, HTTPException, socket.error) as e:
+            raise urllib3_error(e)
+        return _Urllib3Response(response)
+
+    def async_transport(self):
+        # The same connection settings, over asyncio streams.
+        from etcd.aio import StreamTransport
+
+        kw = self.http.connection_pool_kw
+        return StreamTransport(
+            ssl_context=kw.get("ssl_context"),
+            maxsize=kw.get("maxsize", 1),
+            allow_redirect=self.allow_redirect,
+        )
+
+    def warm_up(self, base_uri, count):
+        pool = self.http.connection_from_url(base_uri)
+        count = min(count, pool.pool.maxsize)
+        connections = []
+        opened = 0
+        try:
+            # Take count connections out of the pool, so that we don't get
+            # the same one back, and connect those that are not already.
+            for _ in range(count):
+                conn = pool._get_conn()
+                connections.append(conn)
+                if conn.sock is None or is_connection_dropped(conn):
+                    conn.close()
+                    conn.connect()
+                    opened += 1
+        except (HTTPError, HTTPException, socket.error) as e:
+            raise urllib3_error(e)
+        finally:
+            for conn in connections:
+                pool._put_conn(conn)
+        return opened
+
+    def close_idle(self, max_idle):
+        return sum(pool.close_idle(max_idle) for pool in self._pools())
+
+    def clear(self):
+        # urllib3 2 leaves the pools it forgets to the garbage collector
+        # (1.x closed them), close their connections now.
+        pools = self._pools()
+        self.http.clear()
+        for pool in pools:
+            pool.close()
+
+    def _pools(self):
+        pools = [self.http.pools.get(key) for key in self.http.pools.keys()]
+        return [pool for pool in pools if pool is not None]
+
+
+class HTTP2Transport(Transport):
+    """
+    Transport multiplexing all the requests to a member, watches included,
+    on a single HTTP/2 connection, with httpx.
+
+    HTTP/2 is negotiated with TLS; over plain HTTP, it is only used with
+    prior_knowledge, and HTTP/1.1 otherwise. It needs httpx with its http2
+    extra, which is not a dependency of python-etcd:
+
+        pip install 'httpx[http2]'
+    """
+
+    def __init__(self, verify=True, cert=None, prior_knowledge=False, allow_redirect=True):
+        """
+        Args:
+            verify (mixed): Whether to verify the certificate of the server,
+                            or the file name of the CA certificate to
+                            verify it with.
+
+            cert (mixed): The client certificate: a file name, or a tuple of
+                          the certificate and key file names.
+
+            prior_knowledge (bool): Use HTTP/2 without TLS, for members that
+                                    are known to support it.
+
+            allow_redirect (bool): Follow redirects.
+        """
+        try:
+            import httpx
+        except ImportError:
+            raise ImportError("HTTP2Transport needs httpx: pip install 'httpx[http2]'")
+        self._httpx = httpx
+        self._allow_redirect = allow_redirect
+        # Also those of the httpx.AsyncClient of the asyncio clients.
+        self._options = dict(
+            http1=not prior_knowledge, http2=True, verify=verify, cert=cert, timeout=None
+        )
+        self._client = httpx.Client(**self._options)
+
+    def request(self, method, url, fields=None, body=None, headers=None, timeout=None):
+        httpx = self._httpx
+        try:
+            request = self._build_request(self._client, method, url, fields, body, headers, timeout)
+            response = self._client.send(
+                request, stream=True, follow_redirects=self._allow_redirect
+            )
+        except httpx.HTTPError as e:
+            raise self._error(e)
+
+        def read():
+            try:
+                return response.read()
+            except httpx.HTTPError as e:
+                raise self._error(e)
+            finally:
+                response.close()
+
+        headers = dict((k.lower(), v) for k, v in response.headers.items())
+        return Response(response.status_code, headers, read)
+
+    def async_transport(self):
+        from etcd.aio import HTTPXTransport
+
+        return HTTPXTransport(self)
+
+    def _build_request(self, client, method, url, fields, body, headers, timeout):
+        params = data = None
+        if fields:
+            if method in ("GET", "DELETE"):
+                params = fields
+            else:
+                data = fields
+        return client.build_request(
+            method,
+            url,
+            params=params,
+            data=data,
+            content=body,
+            headers=headers,
+            timeout=self._httpx.Timeout(timeout),
+        )
+
+    def _error(self, e):
+        httpx = self._httpx
+        if isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)):
+            return ConnectError(repr(e), cause=e)
+        if isinstance(e, httpx.ReadTimeout):
+            return ReadTimeout(repr(e), cause=e)
+        return TransportError(repr(e), cause=e)
+
+    def clear(self):
+        # httpx closes idle connections by itself
+        pass
+
+    def close(self):
+        self._client.close()